@@ -0,0 +1,66 @@
+"""Time per history append, suggestion and search as the history grows.
+
+Appends to RotatingFileHistory update a sidecar count instead of recounting the
+whole file, so the time per append should stay flat from 1k to 1M entries.
+Suggestions and searches go through the sqlite history index and should stay
+well under a millisecond.
+
+    python benchmarks/history.py --appends 1000
+"""
+
+import argparse
+import tempfile
+import time
+from pathlib import Path
+
+from gdrepl.history import RotatingFileHistory
+
+
+SIZES = [1_000, 10_000, 100_000, 1_000_000]
+
+
+def measure(entries: int, appends: int) -> float:
+    """Microseconds per append to a history that already has entries lines"""
+    with tempfile.TemporaryDirectory() as temp_dir:
+        history_file = Path(temp_dir) / "history"
+        history_file.write_text("+1 + 1\n" * entries)
+        history = RotatingFileHistory(str(history_file), max_entries=entries * 10)
+
+        started = time.perf_counter()
+        for i in range(appends):
+            history.store_string(f"x = {i}")
+        return (time.perf_counter() - started) / appends * 1_000_000
+
+
+def measure_lookups(entries: int, lookups: int) -> tuple:
+    """Microseconds per prefix suggestion and per substring search over entries distinct entries"""
+    with tempfile.TemporaryDirectory() as temp_dir:
+        history_file = Path(temp_dir) / "history"
+        history_file.write_text("".join(f"\n# 2024-01-01\n+var value_{i} = {i} * 2\n" for i in range(entries)))
+        index = RotatingFileHistory(str(history_file), max_entries=entries * 10, indexed=True).index
+
+        started = time.perf_counter()
+        for i in range(lookups):
+            index.suggest(f"var value_{i * 7 % entries} ")
+        suggest = (time.perf_counter() - started) / lookups * 1_000_000
+
+        started = time.perf_counter()
+        for i in range(lookups):
+            index.search(f"= {i * 7 % entries} *", limit=10)
+        search = (time.perf_counter() - started) / lookups * 1_000_000
+        return suggest, search
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--appends", type=int, default=1000, help="Appends and lookups per history size")
+    args = parser.parse_args()
+
+    print(f"{'entries':>10} {'us/append':>10} {'us/suggest':>11} {'us/search':>10}")
+    for entries in SIZES:
+        suggest, search = measure_lookups(entries, args.appends)
+        print(f"{entries:>10} {measure(entries, args.appends):>10.1f} {suggest:>11.1f} {search:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+"""Round trip latency of trivial expressions against a real godot server.
+
+Compares the fixed 50ms polling of the server (ACTIVE_SPIN=0) with the default
+adaptive polling and prints p50/p99 for both. Needs godot 4 on the path or
+passed with --godot.
+
+    python benchmarks/latency.py --requests 500 --pause 0
+"""
+
+import argparse
+import os
+import shlex
+import statistics
+import subprocess
+import threading
+import time
+
+from gdrepl.client import client
+from gdrepl.find_godot import find_godot
+from gdrepl.find_godot import godot_command
+from gdrepl.find_godot import listening_port
+
+
+MODES = {
+    "fixed": {"ACTIVE_SPIN": "0"},
+    "adaptive": {},
+}
+
+
+def start_server(godot: str, env: dict) -> tuple:
+    env = {**os.environ, **env, "PORT": "0"}
+    proc = subprocess.Popen(
+        shlex.split(godot_command(godot)),
+        env=env,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        text=True,
+    )
+    assert proc.stdout is not None
+    for line in proc.stdout:
+        port = listening_port(line)
+        if port is not None:
+            break
+    else:
+        raise RuntimeError("Godot exited before listening")
+
+    # Keep reading the server output so it never blocks writing it
+    threading.Thread(target=proc.stdout.read, daemon=True).start()
+    return proc, port
+
+
+def measure(port: int, requests: int, pause: float) -> list:
+    c = client(port=port)
+    if not c.protocol:
+        raise RuntimeError("The server doesn't speak the structured protocol")
+
+    for _ in range(10):
+        c.request("eval", code="1+1")
+
+    samples = []
+    for _ in range(requests):
+        started = time.perf_counter()
+        c.request("eval", code="1+1")
+        samples.append((time.perf_counter() - started) * 1000)
+        if pause:
+            time.sleep(pause)
+
+    c.close()
+    return samples
+
+
+def percentile(samples: list, p: int) -> float:
+    return statistics.quantiles(samples, n=100, method="inclusive")[p - 1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--godot", default=find_godot(), help="Godot executable")
+    parser.add_argument("--requests", type=int, default=500, help="Requests per mode")
+    parser.add_argument("--pause", type=float, default=0, help="Milliseconds between requests")
+    args = parser.parse_args()
+
+    print(f"{'mode':<10} {'p50 ms':>8} {'p99 ms':>8} {'max ms':>8}")
+    for mode, env in MODES.items():
+        proc, port = start_server(args.godot, env)
+        try:
+            samples = measure(port, args.requests, args.pause / 1000)
+        finally:
+            if proc.poll() is None:
+                proc.kill()
+        print(f"{mode:<10} {percentile(samples, 50):>8.2f} {percentile(samples, 99):>8.2f} {max(samples):>8.2f}")
+
+
+if __name__ == "__main__":
+    main()
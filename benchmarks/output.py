@@ -0,0 +1,49 @@
+"""Throughput and peak memory of parsing the terminal output of older servers.
+
+The output is parsed line by line as it arrives with at most a bounded piece of a
+line kept, so the peak memory should stay flat whatever the size of the output.
+
+    python benchmarks/output.py --megabytes 100
+"""
+
+import argparse
+import time
+import tracemalloc
+
+from gdrepl.constants import STDOUT_MARKER_END
+from gdrepl.constants import STDOUT_MARKER_START
+from gdrepl.output import CHUNK_SIZE
+from gdrepl.output import OutputParser
+
+
+def measure(megabytes: int, line: bytes) -> tuple:
+    """MB/s and peak KiB parsing megabytes of output made of line"""
+    chunk = line * (CHUNK_SIZE // len(line) or 1)
+    chunks = megabytes * 1024 * 1024 // len(chunk)
+    parser = OutputParser(lambda text: None)
+
+    tracemalloc.start()
+    started = time.perf_counter()
+    parser.feed(f"{STDOUT_MARKER_START}\r\n".encode())
+    for _ in range(chunks):
+        parser.feed(chunk)
+    parser.feed(f"\r\n{STDOUT_MARKER_END}\r\n".encode())
+    elapsed = time.perf_counter() - started
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return chunks * len(chunk) / 1024 / 1024 / elapsed, peak / 1024
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--megabytes", type=int, default=100, help="Output size per kind of line")
+    args = parser.parse_args()
+
+    print(f"{'lines':>12} {'MB/s':>8} {'peak KiB':>9}")
+    for name, line in (("short", b"[1, 2, 3]\r\n"), ("long", b"x" * 4000 + b"\r\n"), ("no newline", b"y" * 4096)):
+        speed, peak = measure(args.megabytes, line)
+        print(f"{name:>12} {speed:>8.1f} {peak:>9.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,232 @@
+"""Client side benchmarks that run without godot, against the python stand-in server.
+
+Measures the round trip of client.send, parsing the terminal output of older servers,
+loading scripts, history appends and searches and completions. Results are written as
+json and compared with a baseline written the same way, a metric that got worse by more
+than the tolerance fails the run so regressions show up in review.
+
+    python benchmarks/suite.py --output latest.json
+    python benchmarks/suite.py --baseline latest.json --tolerance 0.5
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import platform
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from prompt_toolkit.completion import CompleteEvent
+from prompt_toolkit.document import Document
+
+from gdrepl.client import client
+from gdrepl.commands import loadscript
+from gdrepl.constants import STDOUT_MARKER_END
+from gdrepl.constants import STDOUT_MARKER_START
+from gdrepl.history import RotatingFileHistory
+from gdrepl.output import CHUNK_SIZE
+from gdrepl.output import OutputParser
+from gdrepl.repl import CustomCompleter
+from gdrepl.standin import StandinServer
+from gdrepl.symbols import BackgroundIndex
+from gdrepl.symbols import SymbolIndex
+from gdrepl.symbols import parse_api
+
+
+# Version of the results file, results of other versions aren't compared
+FORMAT = 1
+
+
+def percentiles(samples: list) -> tuple:
+    """p50 and p99 of samples in microseconds"""
+    cuts = statistics.quantiles(samples, n=100)
+    return cuts[49] * 1_000_000, cuts[98] * 1_000_000
+
+
+def timed(function, repeat: int) -> list:
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function()
+        samples.append(time.perf_counter() - started)
+    return samples
+
+
+def bench_send(server: StandinServer, scale: int) -> dict:
+    c = client(port=server.port, session="")
+    c.send("var a = 1")
+    for _ in range(50):
+        c.send("a + 1")
+    samples = timed(lambda: c.send("a + 1"), 200 * scale)
+    printing = timed(lambda: c.send("print(a)", on_output=lambda stream, text: None), 200 * scale)
+    c.close()
+    p50, p99 = percentiles(samples)
+    return {
+        "send.p50": (p50, "us", "lower"),
+        "send.p99": (p99, "us", "lower"),
+        "send_output.p50": (percentiles(printing)[0], "us", "lower"),
+    }
+
+
+def bench_output(scale: int) -> dict:
+    results = {}
+    for name, line in (("output.short_lines", b"hello world\r\n"), ("output.long_lines", b"x" * 1000 + b"\r\n")):
+        chunk = line * (CHUNK_SIZE // len(line))
+        parser = OutputParser(lambda text: None)
+        chunks = 10 * scale * 1024 * 1024 // len(chunk)
+        started = time.perf_counter()
+        parser.feed(f"{STDOUT_MARKER_START}\r\n".encode())
+        for _ in range(chunks):
+            parser.feed(chunk)
+        parser.feed(f"{STDOUT_MARKER_END}\r\n".encode())
+        elapsed = time.perf_counter() - started
+        results[name] = (chunks * len(chunk) / 1024 / 1024 / elapsed, "MB/s", "higher")
+    return results
+
+
+def bench_load(server: StandinServer, scale: int) -> dict:
+    lines = 1000 * scale
+    c = client(port=server.port, session="")
+    with tempfile.TemporaryDirectory() as temp_dir:
+        script = Path(temp_dir) / "script.gd"
+        script.write_text("extends Node\n" + "".join(f"func f{i}():\n\treturn {i}\n\n" for i in range(lines // 3)))
+        with contextlib.redirect_stdout(io.StringIO()):
+            samples = timed(lambda: loadscript(c, [str(script)]), 20)
+    c.close()
+    return {"load.lines_per_s": (lines / statistics.median(samples), "lines/s", "higher")}
+
+
+def bench_history(scale: int) -> dict:
+    entries = 10_000 * scale
+    with tempfile.TemporaryDirectory() as temp_dir:
+        history_file = Path(temp_dir) / "history"
+        history_file.write_text("".join(f"\n# 2024-01-01\n+var value_{i} = {i} * 2\n" for i in range(entries)))
+        history = RotatingFileHistory(str(history_file), max_entries=entries * 10, indexed=True)
+        index = history.index
+
+        count = iter(range(1_000_000))
+        append = timed(lambda: history.store_string(f"x = {next(count)}"), 500)
+        search = timed(lambda: index.search(f"= {next(count) % entries} *", limit=10), 500)
+        suggest = timed(lambda: index.suggest(f"var value_{next(count) % entries} "), 500)
+        index.close()
+    return {
+        "history.append": (statistics.median(append) * 1_000_000, "us", "lower"),
+        "history.search": (statistics.median(search) * 1_000_000, "us", "lower"),
+        "history.suggest": (statistics.median(suggest) * 1_000_000, "us", "lower"),
+    }
+
+
+def synthetic_api(classes: int) -> dict:
+    """An api dump the size of the engine's, with classes inheriting in chains"""
+    return {
+        "utility_functions": [{"name": f"util_{i}"} for i in range(100)],
+        "global_enums": [],
+        "classes": [
+            {
+                "name": f"Node{i}",
+                "inherits": f"Node{i - 1}" if i % 10 else "",
+                "methods": [{"name": f"method_{i}_{m}", "return_value": {"type": f"Node{i}"}} for m in range(20)],
+                "properties": [{"name": f"prop_{i}_{p}", "type": "int"} for p in range(10)],
+            }
+            for i in range(classes)
+        ],
+    }
+
+
+def bench_completer(scale: int) -> dict:
+    api = BackgroundIndex("")
+    api.thread.join()
+    api.index = SymbolIndex(parse_api(synthetic_api(1000)))
+    completer = CustomCompleter(api)
+    event = CompleteEvent(completion_requested=True)
+
+    def complete(texts):
+        # Different texts each time, the completer reuses the completions of the same document
+        texts = iter(texts)
+        return lambda: list(completer.get_completions(Document(next(texts)), event))
+
+    repeat = 100 * scale
+    glob = timed(complete(f"var n = Node{i % 1000}" for i in range(repeat)), repeat)
+    member = timed(complete(f"Node{i % 1000}.new().method_{i % 10}" for i in range(repeat)), repeat)
+    return {
+        "complete.global": (statistics.median(glob) * 1_000_000, "us", "lower"),
+        "complete.member": (statistics.median(member) * 1_000_000, "us", "lower"),
+    }
+
+
+def run(scale: int, only: list) -> dict:
+    results = {}
+    with StandinServer() as server:
+        benches = {
+            "send": lambda: bench_send(server, scale),
+            "output": lambda: bench_output(scale),
+            "load": lambda: bench_load(server, scale),
+            "history": lambda: bench_history(scale),
+            "completer": lambda: bench_completer(scale),
+        }
+        for name, bench in benches.items():
+            if only and name not in only:
+                continue
+            for metric, (value, unit, better) in bench().items():
+                results[metric] = {"value": round(value, 3), "unit": unit, "better": better}
+    return results
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list:
+    """Metrics that got worse than the baseline by more than tolerance, as (metric, change) pairs"""
+    regressions = []
+    for metric, result in results.items():
+        if metric not in baseline:
+            continue
+        before, after = baseline[metric]["value"], result["value"]
+        if not before:
+            continue
+        change = (after - before) / before
+        if result["better"] == "higher":
+            change = -change
+        result["change"] = round(change, 3)
+        if change > tolerance:
+            regressions.append((metric, change))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scale", type=int, default=1, help="Multiplies the work of every benchmark")
+    parser.add_argument("--only", nargs="*", default=[], help="Benchmarks to run: send output load history completer")
+    parser.add_argument("--output", help="File to write the results to")
+    parser.add_argument("--baseline", help="Results to compare with, skipped when the file doesn't exist")
+    parser.add_argument("--tolerance", type=float, default=0.3, help="Fraction a metric can get worse by")
+    args = parser.parse_args()
+
+    results = run(args.scale, args.only)
+
+    regressions = []
+    if args.baseline and Path(args.baseline).exists():
+        baseline = json.loads(Path(args.baseline).read_text())
+        if baseline.get("format") == FORMAT:
+            regressions = compare(results, baseline["results"], args.tolerance)
+        else:
+            print(f"{args.baseline} was written by another version of the suite, not comparing")
+
+    print(f"{'metric':<22} {'value':>12} {'unit':<8} {'change':>8}")
+    for metric, result in results.items():
+        change = f"{result['change']:+.0%}" if "change" in result else ""
+        print(f"{metric:<22} {result['value']:>12.1f} {result['unit']:<8} {change:>8}")
+
+    if args.output:
+        Path(args.output).parent.mkdir(parents=True, exist_ok=True)
+        document = {"format": FORMAT, "python": platform.python_version(), "scale": args.scale, "results": results}
+        Path(args.output).write_text(json.dumps(document, indent=2) + "\n")
+
+    for metric, change in regressions:
+        print(f"Regression: {metric} is {change:.0%} worse than the baseline")
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
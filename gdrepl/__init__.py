@@ -3,8 +3,6 @@ from .find_godot import find_godot
 from .find_godot import godot_command
 from .find_godot import script_file
 from .find_godot import script_file_v4
-from .main import run
-from .main import server
 
 
 __all__ = (
@@ -16,3 +14,12 @@ __all__ = (
     "script_file_v4",
     "server",
 )
+
+
+def __getattr__(name):
+    # The cli pulls in click, only load it for whoever asks for its commands
+    if name in ("run", "server"):
+        from . import main
+
+        return getattr(main, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,226 @@
+"""Load generator for `gdrepl bench`, finding out how much a shared server can take.
+
+Each client is a websocket connection with a thread of its own that sends snippets of
+a weighted mix at its share of the target rate. Requests are scheduled ahead of time
+and their latency is measured from when they were due, so a server falling behind shows
+up in the percentiles instead of quietly lowering the rate. The memory of the server is
+sampled from /proc while the clients run.
+"""
+
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+from dataclasses import dataclass
+from dataclasses import field
+from typing import Any
+from typing import Optional
+
+from .client import TIMEOUT_ERROR
+from .client import client
+from .client import websocket
+from .find_godot import listening_port
+
+
+# Snippets sent when no mix is given, with their weights
+DEFAULT_MIX = [
+    ("1 + 1", 5),
+    ("var x = 21\nx * 2", 3),
+    ('print("hello")', 2),
+    ("symbols", 1),
+]
+
+# Seconds between samples of the memory of the server
+RSS_INTERVAL = 1.0
+
+
+@dataclass
+class Sample:
+    # Seconds from the start of the run the request was due and how long it took
+    due: float
+    latency: float
+    error: bool = False
+    timeout: bool = False
+
+
+@dataclass
+class Report:
+    clients: int
+    rate: float
+    duration: float
+    samples: list = field(default_factory=list)
+    # (seconds from the start, rss in KiB) of the server
+    rss: list = field(default_factory=list)
+
+    def summary(self) -> dict:
+        latencies = sorted(s.latency for s in self.samples if not s.error and not s.timeout)
+        total = len(self.samples)
+        summary: dict[str, Any] = {
+            "clients": self.clients,
+            "target_rate": self.rate,
+            "duration": round(self.duration, 3),
+            "requests": total,
+            "throughput": round(total / self.duration, 2) if self.duration else 0.0,
+            "error_rate": round(sum(s.error for s in self.samples) / total, 4) if total else 0.0,
+            "timeout_rate": round(sum(s.timeout for s in self.samples) / total, 4) if total else 0.0,
+            "rss_kib": self.rss,
+        }
+        for name, q in (("p50", 0.50), ("p95", 0.95), ("p99", 0.99)):
+            summary[f"{name}_ms"] = round(percentile(latencies, q) * 1000, 3)
+        return summary
+
+
+def percentile(values: list, q: float) -> float:
+    """Nearest rank percentile of sorted values, 0 when there are none"""
+    if not values:
+        return 0.0
+    return float(values[min(len(values) - 1, int(q * len(values)))])
+
+
+def load_mix(path: str) -> list:
+    """Weighted snippets from a yaml list of {code, weight} mappings"""
+    import yaml
+
+    with open(path) as f:
+        entries = yaml.safe_load(f) or []
+    mix = [(str(entry["code"]), float(entry.get("weight", 1))) for entry in entries]
+    if not mix:
+        raise ValueError(f"{path} has no snippets")
+    return mix
+
+
+def rss_kib(pid: int) -> Optional[int]:
+    """Resident memory of pid in KiB, None when it can't be read"""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def start_standin() -> tuple:
+    """Launches the python stand-in server, returns its process and port"""
+    proc = subprocess.Popen(
+        [sys.executable, "-m", "gdrepl.standin"],
+        env={**os.environ, "PORT": "0"},
+        stdout=subprocess.PIPE,
+        text=True,
+    )
+    assert proc.stdout is not None
+    for line in proc.stdout:
+        port = listening_port(line)
+        if port is not None:
+            return proc, port
+    raise RuntimeError("The stand-in server exited before listening")
+
+
+class LoadGenerator:
+    def __init__(
+        self,
+        port: int,
+        clients: int,
+        rate: float,
+        duration: float,
+        mix: list,
+        timeout: float = 10.0,
+        shared: bool = False,
+        pid: Optional[int] = None,
+    ) -> None:
+        self.port = port
+        self.clients = clients
+        # Requests per second of all clients together, 0 sends as fast as the server answers
+        self.rate = rate
+        self.duration = duration
+        self.codes = [code for code, _ in mix]
+        self.weights = [weight for _, weight in mix]
+        self.timeout = timeout
+        self.shared = shared
+        self.pid = pid
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+
+    def run(self) -> Report:
+        # Connect everyone first so the handshakes aren't part of the measurement
+        connections = [client(port=self.port, session=None if self.shared else "") for _ in range(self.clients)]
+        for c in connections:
+            c.ws.settimeout(self.timeout)
+
+        report = Report(self.clients, self.rate, self.duration)
+        started = time.perf_counter()
+        threads = [
+            threading.Thread(target=self._client, args=(c, i, started, report), daemon=True)
+            for i, c in enumerate(connections)
+        ]
+        for thread in threads:
+            thread.start()
+        self._sample_rss(started, report)
+        for thread in threads:
+            thread.join()
+        report.duration = time.perf_counter() - started
+
+        for c in connections:
+            c.close()
+        return report
+
+    def _sample_rss(self, started: float, report: Report) -> None:
+        while not self.stopped.wait(RSS_INTERVAL):
+            elapsed = time.perf_counter() - started
+            if elapsed >= self.duration:
+                self.stopped.set()
+                break
+            rss = rss_kib(self.pid) if self.pid else None
+            if rss is not None:
+                report.rss.append((round(elapsed, 1), rss))
+
+    def _client(self, c: client, index: int, started: float, report: Report) -> None:
+        rng = random.Random(index)
+        # Clients start spread over one interval so they don't all send at once
+        interval = self.clients / self.rate if self.rate else 0.0
+        due = interval * index / self.clients
+        samples = []
+        while due < self.duration and not self.stopped.is_set():
+            delay = started + due - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            sent = due if self.rate else time.perf_counter() - started
+            code = rng.choices(self.codes, self.weights)[0]
+            try:
+                error, timeout = self._send(c, code)
+            except (OSError, websocket().WebSocketException):
+                # The connection is gone, the rest of the requests of this client would fail too
+                samples.append(Sample(due, time.perf_counter() - started - sent, error=True))
+                break
+            samples.append(Sample(due, time.perf_counter() - started - sent, error, timeout))
+            due = due + interval if self.rate else time.perf_counter() - started
+        with self.lock:
+            report.samples += samples
+
+    @staticmethod
+    def _send(c: client, code: str) -> tuple:
+        """Whether sending code failed and whether it timed out"""
+        if not c.protocol:
+            text = c.send(code)
+            return text.startswith("  -> Err") or text == TIMEOUT_ERROR, text == TIMEOUT_ERROR
+        reply = c.request("eval", on_output=lambda stream, text: None, code=code)
+        if reply.get("error") == TIMEOUT_ERROR:
+            return True, True
+        return reply.get("type") == "error" or bool(reply.get("error_code")), False
+
+
+def format_report(summary: dict) -> str:
+    lines = [
+        f"Clients: {summary['clients']}, target rate: {summary['target_rate'] or 'unbounded'} req/s",
+        f"Requests: {summary['requests']} in {summary['duration']:.1f}s, {summary['throughput']:.1f} req/s",
+        f"Latency: p50 {summary['p50_ms']:.2f}ms  p95 {summary['p95_ms']:.2f}ms  p99 {summary['p99_ms']:.2f}ms",
+        f"Errors: {summary['error_rate']:.2%}  timeouts: {summary['timeout_rate']:.2%}",
+    ]
+    if summary["rss_kib"]:
+        rss = [kib for _, kib in summary["rss_kib"]]
+        lines.append(f"Server RSS: {rss[0] / 1024:.1f}MB -> {rss[-1] / 1024:.1f}MB, peak {max(rss) / 1024:.1f}MB")
+        lines += [f"  {t:>6.1f}s {kib / 1024:8.1f}MB" for t, kib in summary["rss_kib"]]
+    return "\n".join(lines)
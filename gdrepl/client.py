@@ -1,33 +1,221 @@
-from websocket import WebSocketTimeoutException
-from websocket import create_connection
+import itertools
+import json
+import sys
 
+from .constants import ERR_PARSE_ERROR
 from .constants import HOST
 from .constants import PORT
+from .constants import PROTOCOL_VERSION
+
+
+TIMEOUT_ERROR = "Error: Server timeout (took longer than 30 seconds to respond)"
+
+
+def websocket():
+    """websocket-client is the slowest import gdrepl has, it is only loaded once something connects"""
+    import websocket
+
+    return websocket
+
+
+def create_connection(url, **kwargs):
+    return websocket().create_connection(url, **kwargs)
 
 
 class client:
-    def __init__(self, host=HOST, port=PORT):
+    def __init__(self, host=HOST, port=PORT, session=None):
+        self.host = host
+        self.port = port
         try:
             self.ws = create_connection(f"ws://{host}:{port}", timeout=30)
         except ConnectionRefusedError:
             print("Could not connect to server")
             exit(1)
 
+        # Negotiated on handshake, protocol 0 means the plain text protocol
+        self.protocol = 0
+        self.engine = ""
+        self.capabilities = []
+        self.commands = {}
+        # Session joined on the server, None on servers without sessions. Clients that don't
+        # ask for one share the server's default session
+        self.session = None
+        # Generation of the session on the server, it changes when the names defined in it change
+        self.generation = None
+
+        self._ids = itertools.count(1)
+        self._replies = {}
+        self._outputs = {}
+        self.handshake(session)
+
     def close(self):
         self.ws.close()
 
-    def send(self, msg: str, get_response=True) -> str:
-        """Converts ';' to '\n' and sends the message to the server, returning its response"""
+    def handshake(self, session=None) -> bool:
+        """Negotiates the structured protocol. Servers that only speak plain text are left on protocol 0.
+
+        session is the name of the session to join, an empty one asks the server for a new session.
+        """
+        hello = {"v": PROTOCOL_VERSION, "id": 0, "op": "hello"}
+        if session is not None:
+            hello["session"] = session
+        self.ws.send(json.dumps(hello))
+        try:
+            reply = self._decode(self.ws.recv())
+        except websocket().WebSocketTimeoutException:
+            return False
+
+        if reply is None:
+            return False
+        if reply.get("type") != "hello":
+            # The server speaks the protocol but can't give us the session, like when it has too many
+            if session is not None and "v" in reply:
+                print(reply.get("error", "Could not join the session"))
+                exit(1)
+            return False
+
+        self.protocol = reply.get("version", PROTOCOL_VERSION)
+        self.engine = reply.get("engine", "")
+        self.capabilities = reply.get("capabilities", [])
+        self.commands = reply.get("commands", {})
+        self.session = reply.get("session")
+        self.generation = reply.get("generation")
+        return True
+
+    @staticmethod
+    def _decode(resp):
+        """Returns the structured reply in resp or None if it is plain text"""
+        if isinstance(resp, bytes):
+            resp = resp.decode()
+        if not resp.startswith("{"):
+            return None
+        try:
+            reply = json.loads(resp)
+        except ValueError:
+            return None
+        return reply if isinstance(reply, dict) else None
+
+    def submit(self, op: str, **fields) -> int:
+        """Sends a request without waiting for its reply, returns the request id to wait on"""
+        request_id = next(self._ids)
+        self.ws.send(json.dumps({"v": PROTOCOL_VERSION, "id": request_id, "op": op, **fields}))
+        return request_id
+
+    @staticmethod
+    def write_output(stream: str, text: str):
+        """Default handler for output frames, writes them to the terminal as they arrive"""
+        out = sys.stderr if stream == "stderr" else sys.stdout
+        out.write(text)
+        out.flush()
+
+    def wait(self, request_id: int, on_output=None) -> dict:
+        """Receives until the reply for request_id arrives, keeping replies of other requests.
+
+        Output frames of the request are passed to on_output(stream, text) as they arrive.
+        """
+        on_output = on_output or self.write_output
+        for frame in self._outputs.pop(request_id, []):
+            on_output(frame.get("stream"), frame.get("text", ""))
+
+        while request_id not in self._replies:
+            try:
+                reply = self._decode(self.ws.recv())
+            except websocket().WebSocketTimeoutException:
+                return {"type": "error", "id": request_id, "error": TIMEOUT_ERROR}
+            if reply is None:
+                continue
+            if reply.get("type") != "output":
+                self._replies[reply.get("id")] = reply
+            elif reply.get("id") == request_id:
+                on_output(reply.get("stream"), reply.get("text", ""))
+            else:
+                self._outputs.setdefault(reply.get("id"), []).append(reply)
+        reply = self._replies.pop(request_id)
+        if "generation" in reply:
+            self.generation = reply["generation"]
+        return reply
+
+    def request(self, op: str, on_output=None, **fields) -> dict:
+        return self.wait(self.submit(op, **fields), on_output)
+
+    def join(self, session: str):
+        """Moves the connection to another session, returns why it couldn't or None"""
+        reply = self.request("hello", session=session)
+        if reply.get("type") != "hello":
+            return reply.get("error", "Could not join the session")
+        self.session = reply.get("session")
+        self.generation = reply.get("generation")
+        return None
+
+    def cancel(self, request_id: int, on_output=None) -> dict:
+        """Asks the server to stop a request and waits for its reply, which is an error once it stopped"""
+        cancel_id = self.submit("cancel", target=request_id)
+        reply = self.wait(request_id, on_output)
+        self.wait(cancel_id)
+        return reply
+
+    def server_commands(self) -> dict:
+        """Commands the server understands with their help messages"""
+        if self.protocol:
+            return dict(self.commands)
+
+        commands = {}
+        for line in self.send("help").split("\n"):
+            helplist = line.split(":")
+            if len(helplist) != 2:
+                continue
+            commands[helplist[0]] = helplist[1]
+        return commands
+
+    @staticmethod
+    def format(reply: dict) -> str:
+        """Turns a structured reply into the text shown on the repl"""
+        kind = reply.get("type")
+        if kind == "result":
+            # Parse errors are shown by the engine itself
+            if reply.get("error_code") == ERR_PARSE_ERROR:
+                return ""
+            if reply.get("error_code"):
+                return "  -> Err: " + str(reply.get("error_code"))
+            return "  -> " + reply.get("result", "") if reply.get("result") else ""
+
+        if kind == "command":
+            if reply.get("output") == "Cleared":
+                return "Environment cleared!"
+            return reply.get("output", "")
+
+        return reply.get("error", "")
+
+    def send(self, msg: str, get_response=True, on_output=None) -> str:
+        """Converts ';' to '\n' and sends the message to the server, returning its response.
+
+        Servers with the output capability stream what the code prints to on_output.
+        """
+        msg = msg.replace(";", "\n")
+
+        if self.protocol:
+            if not get_response:
+                self.submit("eval", code=msg)
+                return ""
+            request_id = self.submit("eval", code=msg)
+            try:
+                return self.format(self.wait(request_id, on_output))
+            except KeyboardInterrupt:
+                # Ctrl-C stops the code on servers that can cancel it instead of leaving the repl
+                if "cancel" not in self.capabilities:
+                    raise
+                reply = self.cancel(request_id, on_output)
+                return reply.get("error") or self.format(reply)
 
-        self.ws.send(msg.replace(";", "\n"))
+        self.ws.send(msg)
 
         if not get_response:
             return ""
 
         try:
             resp = self.ws.recv()
-        except WebSocketTimeoutException:
-            return "Error: Server timeout (took longer than 30 seconds to respond)"
+        except websocket().WebSocketTimeoutException:
+            return TIMEOUT_ERROR
 
         if isinstance(resp, bytes):
             resp = resp.decode()
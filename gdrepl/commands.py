@@ -48,15 +48,31 @@ def _mode(*args):
     print(f"Current editing mode: {mode}")
 
 
-def _history(*args):
+def _history(c, args):
     from .config import ConfigManager
 
     config_manager = ConfigManager()
+    if args:
+        from .history import HistoryIndex
+
+        config = config_manager.config
+        index = HistoryIndex(os.path.expanduser(config.history_file), config.backup_count)
+        for entry in reversed(index.search(" ".join(args))):
+            print(entry)
+        index.close()
+        return
+
     print(f"History file: {config_manager.config.history_file}")
     print(f"Max entries: {config_manager.config.max_history}")
     print(f"Rotation: {'enabled' if config_manager.config.history_rotation else 'disabled'}")
 
 
+def expand_indent(line: str) -> str:
+    """Replaces the tabs indenting line with spaces, the repl indents with spaces"""
+    stripped = line.lstrip("\t")
+    return "    " * (len(line) - len(stripped)) + stripped
+
+
 def loadscript(c: client, args):
     """Reads all contents from each of the args file and sends it to the server."""
     for file in args:
@@ -65,10 +81,22 @@ def loadscript(c: client, args):
             print("File does not exist")
             return
         with open(file) as f:
-            for line in f.readlines():
-                if line.strip() and line.split()[0] in SCRIPT_LOAD_REMOVE_KWDS:
-                    continue
-                c.send(line)
+            lines = [
+                expand_indent(line)
+                for line in f.readlines()
+                if not (line.strip() and line.split()[0] in SCRIPT_LOAD_REMOVE_KWDS)
+            ]
+
+        # Servers that can load whole scripts take it in a single request and compile
+        if "load" in c.capabilities:
+            reply = c.request("load", code="".join(lines))
+            if reply.get("error_code") or reply.get("type") == "error":
+                print(f"Failed to load {file}: {reply.get('error')}")
+                return
+            continue
+
+        for line in lines:
+            c.send(line)
         c.send("\n")
     print("\n\nSuccessfully loaded script(s)")
 
@@ -96,6 +124,22 @@ def savescript(c: client, args):
     print("\n\nSuccessfully saved script to " + args[0])
 
 
+def _fork(c: client, args):
+    """Copies the session into a new one on the server and moves over to it"""
+    if len(args) != 1:
+        print("Usage: !fork <new-session>")
+        return
+    output = c.send(f"fork {args[0]}")
+    print(output)
+    if output.startswith("Error") or c.session is None:
+        return
+    error = c.join(args[0])
+    if error:
+        print(error)
+        return
+    print(f"Now on session {c.session}, the previous one is still there")
+
+
 COMMANDS = {
     "load": Command(completer=PathCompleter(), help="Load .gd file into this session", do=loadscript),
     "save": Command(completer=PathCompleter(), help="Save this session to .gd file", do=savescript),
@@ -103,5 +147,10 @@ COMMANDS = {
     "help": Command(help="Displays this message", do=_help),
     "clear": Command(help="Clears the screen", do=lambda _, __: clear()),
     "mode": Command(help="Show current editing mode", do=_mode),
-    "history": Command(help="Show history configuration", do=_history),
+    "history": Command(help="Show history configuration, or search it with !history <substring>", do=_history),
+    "checkpoint": Command(help="Save the session as !checkpoint <name>, list them without a name", send_to_server=True),
+    "restore": Command(help="Bring the session back to a checkpoint with !restore <name>", send_to_server=True),
+    "fork": Command(help="Copy the session into a new one and switch to it with !fork <new-session>", do=_fork),
+    "snapshot": Command(help="Write the session to disk on the server, !snapshot [name]", send_to_server=True),
+    "resume": Command(help="Replace the session with a snapshot from disk, !resume <name>", send_to_server=True),
 }
@@ -11,9 +11,12 @@ class REPLConfig:
     max_history: int = 10000
     history_rotation: bool = True
     backup_count: int = 3
+    history_index: bool = True
     toolbar_style: str = "colorful"
     auto_suggest: bool = True
     temp_suffix: str = ".gd"
+    pool_size: int = 2
+    pool_max_idle_age: float = 600
 
 
 class ConfigManager:
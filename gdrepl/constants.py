@@ -5,6 +5,18 @@ GODOT = "godot"
 PORT = 1580
 HOST = "127.0.0.1"
 
+# Seconds the repl waits for godot's terminal output on servers that don't stream it
+TIMEOUT = 0
+
+# Version of the structured json protocol spoken with the godot server
+PROTOCOL_VERSION = 1
+
+# Godot's ERR_PARSE_ERROR, the server reports it when the code doesn't compile
+ERR_PARSE_ERROR = 43
+# Godot's ERR_TIMEOUT and ERR_BUSY, code stopped at its deadline and code that didn't stop and was abandoned
+ERR_TIMEOUT = 24
+ERR_BUSY = 44
+
 # When trying to find a port the godot server can bind on
 # This also means that this is the maximum simultaneous repls that can run
 MAX_PORT_BIND_ATTEMPTS = 100
@@ -74,7 +86,7 @@ KEYWORDS = [
     "printerr",
 ]
 
-SCRIPT_LOAD_REMOVE_KWDS = ["tool", "extends", "onready", "@onready"]
+SCRIPT_LOAD_REMOVE_KWDS = ["tool", "@tool", "extends", "class_name", "onready", "@onready"]
 
 
 STDOUT_MARKER_START = "----------------STDOUT-----------------------"
@@ -1,13 +1,20 @@
+import json
 import os
+import re
+import shlex
 import socket
 import subprocess
 from pathlib import Path
 from shutil import which
 
 from .constants import MAX_PORT_BIND_ATTEMPTS
+from .constants import PORT
 from .constants import POSSIBLE_COMMANDS
 
 
+LISTENING = re.compile(r"Gdrepl Listening on (\d+)")
+
+
 def is_tool(name):
     """Check whether `name` is on PATH and marked as executable."""
     # Check if name is a path that exists as executable or is a command
@@ -22,35 +29,114 @@ def script_file_v4():
     return str(Path(__file__).parent.resolve() / Path("gdserverv4.gd"))
 
 
+def cache_file() -> Path:
+    """Where what was found about godot executables is kept between runs"""
+    cache_home = os.environ.get("XDG_CACHE_HOME") or str(Path.home() / ".cache")
+    return Path(cache_home) / "gdrepl" / "godot.json"
+
+
+def load_cache() -> dict:
+    try:
+        with open(cache_file()) as f:
+            cache = json.load(f)
+        return cache if isinstance(cache, dict) else {}
+    except (OSError, ValueError):
+        return {}
+
+
+def save_cache(cache: dict):
+    path = cache_file()
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_suffix(f".{os.getpid()}.tmp")
+        with open(tmp, "w") as f:
+            json.dump(cache, f, indent=2)
+        os.replace(tmp, path)
+    except OSError:
+        pass
+
+
+def resolve(cmd: str):
+    """Returns the executable path of the godot command and its mtime or None if it doesn't exist"""
+    exe = cmd.split()[0] if cmd.split() else ""
+    path = which(exe) or (exe if os.path.exists(exe) else None)
+    if path is None:
+        return None
+    path = os.path.realpath(path)
+    try:
+        return path, os.stat(path).st_mtime
+    except OSError:
+        return None
+
+
+def search_key() -> str:
+    """What finding godot depends on besides the executables, the cache is dropped when it changes"""
+    return json.dumps([os.environ.get("PATH", ""), POSSIBLE_COMMANDS])
+
+
 def find_godot():
     """Finds the godot executable."""
+    cache = load_cache()
+    found = cache.get("find")
+    if (
+        found
+        and found.get("key") == search_key()
+        and resolve(found["command"]) == (found["path"], found["mtime"])
+        # A command that comes first may have been installed since
+        and not any(is_tool(cmd.split()[0]) for cmd in POSSIBLE_COMMANDS[: POSSIBLE_COMMANDS.index(found["command"])])
+    ):
+        return found["command"]
+
     for cmd in POSSIBLE_COMMANDS:
         if is_tool(cmd.split()[0]):
+            resolved = resolve(cmd)
+            if resolved:
+                cache["find"] = {"command": cmd, "path": resolved[0], "mtime": resolved[1], "key": search_key()}
+                save_cache(cache)
             return cmd
     print("Cannot find godot executable. You may use --godot")
     return ""
 
 
-def godot_command(godot: str) -> str:
-    """Fixes the arguments for godot based on the version"""
-    output = None
+def godot_version(godot: str) -> str:
+    """Version godot reports, probed only when the executable changed since it was last cached"""
+    resolved = resolve(godot)
+    cache = load_cache()
+    versions = cache.setdefault("versions", {})
+    if resolved:
+        entry = versions.get(resolved[0])
+        if entry and entry["mtime"] == resolved[1]:
+            return entry["version"]
+
     try:
         output = (
             subprocess.run(
-                f"{godot} --version",
+                [*shlex.split(godot), "--version"],
                 stdout=subprocess.PIPE,
                 timeout=None,
                 check=False,
-                shell=True,
                 stderr=subprocess.STDOUT,
             )
             .stdout.decode()
             .strip()
         )
-    except subprocess.CalledProcessError:
-        if not output:
-            print("Failed to check godot version!")
-            return godot
+    except (OSError, subprocess.CalledProcessError):
+        print("Failed to check godot version!")
+        return ""
+
+    # Only the last line, older versions print warnings before it
+    version = output.splitlines()[-1] if output else ""
+    if resolved and version:
+        versions[resolved[0]] = {"mtime": resolved[1], "version": version}
+        save_cache(cache)
+    return version
+
+
+def godot_command(godot: str) -> str:
+    """Fixes the arguments for godot based on the version"""
+    output = godot_version(godot)
+    if not output:
+        return godot
 
     script = script_file()
 
@@ -67,6 +153,23 @@ def godot_command(godot: str) -> str:
     return f"{godot} --script {script}"
 
 
+def ephemeral_ports(godot: str) -> bool:
+    """Whether the server can listen on port 0 and print the port the OS gave it.
+    Godot 3 servers can't tell which port they got."""
+    return bool(godot) and godot_version(shlex.split(godot)[0]).startswith("4")
+
+
+def server_port(godot: str) -> int:
+    """Port to pass to a new server, 0 unless a free one has to be probed for it"""
+    return 0 if ephemeral_ports(godot) else find_available_port(PORT)
+
+
+def listening_port(line: str):
+    """Port from the line the server prints once it listens, None for other lines"""
+    match = LISTENING.match(line)
+    return int(match.group(1)) if match else None
+
+
 def find_available_port(start_port: int) -> int:
     """Starts checking if start_port is available to bind and increments 1 until it finds an available port."""
     port = start_port
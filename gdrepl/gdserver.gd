@@ -16,6 +16,7 @@ const commands = {
   "delline_global": "Deletes certain line number from the global script",
   "delglobal": "Deletes the entire global scope",
   "dellocal": "Deletes the entire local scope",
+  "stats": "Shows the compiled script cache statistics",
   "quit": "stops this server",
 }
 
@@ -31,6 +32,10 @@ var port = PORT
 var sessions = {}
 var debug = false
 
+# How many compiled scripts are kept around to be reused
+const CACHE_SIZE = 128
+var cache = ScriptCache.new(CACHE_SIZE)
+
 var loop = true
 
 # These are scope initializer keywords_global. In gdscript these can't
@@ -45,6 +50,52 @@ const keywords_local = ["if", "else", "while", "for", "break", "continue", "var"
 const mainfunc = "___eval"
 const main = "func " + mainfunc + "():\n"
 
+# Compiled scripts indexed by the hash of their source code. Least recently
+# used entries are evicted when the cache is full
+class ScriptCache:
+  var capacity
+  var entries = {}
+  var hits = 0
+  var misses = 0
+  var last_error = OK
+
+  func _init(size):
+    capacity = size
+
+  func lookup(key: String):
+    if not key in entries:
+      misses += 1
+      return null
+    hits += 1
+    var script = entries[key]
+    entries.erase(key)
+    entries[key] = script
+    return script
+
+  func insert(key: String, script):
+    entries[key] = script
+    while len(entries) > capacity:
+      entries.erase(entries.keys()[0])
+
+  # Returns the compiled script for the source or null setting last_error
+  func compile(source: String):
+    var key = source.md5_text()
+    var script = lookup(key)
+    if script != null:
+      return script
+
+    script = GDScript.new()
+    script.source_code = source
+    last_error = script.reload()
+    if last_error != OK:
+      return null
+    insert(key, script)
+    return script
+
+  func stats() -> String:
+    return "Script cache: %d/%d entries, %d hits, %d misses" % [len(entries), capacity, hits, misses]
+
+
 enum Scope {
   Global,
   Yellow,
@@ -160,12 +211,12 @@ class Session:
 
 
 # Useful for debuging
-func print_script(script, session):
+func print_script(source, session):
   if not debug:
     return
   print(">>>> ", session)
   print("-----------------------------------")
-  print(script.source_code)
+  print(source)
   print("-----------------------------------\n")
 
 func add_code(code: String, session: String = "main"):
@@ -206,14 +257,14 @@ func exec(input: String, session: String = "main") -> String:
     sessions[session].scope = Scope.Local
     return ""
 
-  var script = GDScript.new()
-  script.source_code = sessions[session].code()
-  print_script(script, session)
+  var source = sessions[session].code()
+  print_script(source, session)
 
-  var err = script.reload()
-  if err != OK:
+  # Identical sources reuse the script compiled for them before
+  var script = cache.compile(source)
+  if script == null:
     sessions[session].dellast_local()
-    return "Err: " + str(err)
+    return "Err: " + str(cache.last_error)
 
   var obj = Reference.new()
   obj.set_script(script)
@@ -241,6 +292,9 @@ func _init():
   if OS.has_environment("PORT"):
     port = int(OS.get_environment("PORT"))
 
+  if OS.has_environment("CACHE_SIZE"):
+    cache.capacity = int(OS.get_environment("CACHE_SIZE"))
+
 
   # We dont need those but good to know
   #_server.connect("client_connected", self, "_connected")
@@ -317,6 +371,14 @@ func _on_data(id):
   if OS.has_environment("SESSION") and session == "main":
     session = OS.get_environment("SESSION")
 
+  # This server only speaks the plain text protocol, tell structured clients
+  # so they can fall back to it instead of evaluating their requests
+  if data.begins_with("{"):
+    var request = JSON.parse(data)
+    if request.error == OK and typeof(request.result) == TYPE_DICTIONARY and "op" in request.result:
+      send(id, to_json({"type": "error", "id": request.result.get("id"), "error": "Unsupported protocol"}))
+      return
+
 
   # Commands without arguments
   var cmd = data.strip_edges().to_lower()
@@ -356,6 +418,9 @@ func _on_data(id):
     "delglobal":
       sessions[session].global = ""
 
+    "stats":
+      response = cache.stats()
+
     "dellocal": 
       sessions[session].local = ""
 
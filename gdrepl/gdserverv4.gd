@@ -12,15 +12,59 @@ const commands = {
   "reset": "clears the script buffer for the current session",
   "script_local": "Sends back the generated local",
   "script_global": "Sends back the generated global",
-  "script_code": "Sends back the generated full runtime script code",
+  "script_code": "Sends back the last generated runtime script code",
   "dellast_local": "Deletes last local scope or code block",
   "delline_local": "Deletes certain line number from the local script",
   "delline_global": "Deletes certain line number from the global script",
   "delglobal": "Deletes the entire global scope",
   "dellocal": "Deletes the entire local scope",
+  "stats": "Shows the compiled script cache and session statistics",
+  "symbols": "Lists the names defined in the current session",
+  "checkpoint": "Saves the current session under a name, lists the saved ones without it",
+  "restore": "Brings the current session back to a checkpoint",
+  "fork": "Copies the current session into a new session with the given name",
+  "snapshot": "Writes the current session to disk under its own name or the given one",
+  "resume": "Replaces the current session with a snapshot read from disk",
   "quit": "stops this server",
 }
 
+# Version of the structured json protocol and what this server supports
+const PROTOCOL_VERSION = 1
+var capabilities = ["eval", "load", "sessions", "cancel", "snapshots"]
+
+# Captures print, printerr and script errors while structured requests run so
+# they are streamed to the client as output frames. Built at runtime because
+# the Logger class only exists since godot 4.5
+const capture_source = """extends Logger
+
+var sink: Callable
+
+func _log_message(message: String, error: bool) -> void:
+  sink.call(message, "stderr" if error else "stdout")
+
+func _log_error(function: String, file: String, line: int, code: String, rationale: String, editor_notify: bool, error_type: int, script_backtraces: Array[ScriptBacktrace]) -> void:
+  var message = rationale if len(rationale) > 0 else code
+  match error_type:
+    ERROR_TYPE_WARNING:
+      message = "WARNING: " + message
+    ERROR_TYPE_SCRIPT:
+      message = "SCRIPT ERROR: " + message
+    ERROR_TYPE_SHADER:
+      message = "SHADER ERROR: " + message
+    _:
+      message = "ERROR: " + message
+  sink.call(message + "\n", "stderr")
+"""
+
+# Output is sent when this much is buffered or this long passed since the last frame
+const OUTPUT_FLUSH_BYTES = 16384
+const OUTPUT_FLUSH_MSEC = 20
+
+var logger = null
+var capture: Capture = null
+var capture_mutex = Mutex.new()
+var flushing = false
+
 const STDOUT_MARKER_START = "----------------STDOUT-----------------------"
 const STDOUT_MARKER_END = "----------------STDOUT END-----------------------"
 
@@ -33,12 +77,55 @@ var port = PORT
 var sessions = {}
 var debug = false
 
+# Session each connection joined with hello. Connections that didn't ask for one,
+# like the plain text clients, share the default session
+var connections = {}
+var default_session = "main"
+
+# Most sessions kept at once, 0 for no limit. The default session is always allowed
+const MAX_SESSIONS = 64
+var max_sessions = MAX_SESSIONS
+# Longest source code a session can accumulate, 0 for no limit
+const MAX_SESSION_SOURCE = 1048576
+var max_session_source = MAX_SESSION_SOURCE
+# Seconds a session nobody is connected to is kept, so clients can reconnect to it
+const SESSION_TTL = 600
+var session_ttl = SESSION_TTL
+var last_expiry = 0
+# Copies of sessions saved with checkpoint, by session and then by name
+var checkpoints = {}
+# Most checkpoints a session keeps, 0 for no limit
+const MAX_CHECKPOINTS = 16
+var max_checkpoints = MAX_CHECKPOINTS
+# Where sessions are written by the snapshot command, they outlive the server
+const SNAPSHOT_FORMAT = 2
+var snapshot_dir = "user://gdrepl_snapshots"
+# Snapshots being written by the worker thread pool, waited for once they are done
+var snapshot_tasks = []
+
+# How many compiled scripts are kept around to be reused
+const CACHE_SIZE = 128
+var cache = ScriptCache.new(CACHE_SIZE)
+
 var loop = true
 
+# Longest time in milliseconds the server sleeps between polls while idle
+const IDLE_DELAY = 50
+var idle_delay = IDLE_DELAY
+# For how many milliseconds after a message the server keeps polling without backing off
+const ACTIVE_SPIN = 100
+var active_spin = ACTIVE_SPIN
+const ACTIVE_DELAY_USEC = 100
+var last_active = 0
+var handled = 0
+
 # These are scope initializer keywords_global. In gdscript these can't
 # go inside another one of themselves
 const keywords_global = ["func", "class", "enum", "static", "const", "export"]
 
+# Also go to the global scope when a whole script is loaded
+const keywords_declaration = ["var", "signal"]
+
 # Wont try to return if last line starts with any of those
 const keywords_local = ["if", "else", "while", "for", "break", "continue", "var", "const"]
 
@@ -47,6 +134,123 @@ const keywords_local = ["if", "else", "while", "for", "break", "continue", "var"
 const mainfunc = "___eval"
 const main = "func " + mainfunc + "():\n"
 
+# Bumped whenever the names defined in a session change so clients can cache
+# them until the generation of the session changes
+var generations = 0
+
+# Evaluations run on a thread while the main loop keeps serving everyone else.
+# Generated scripts check this token at the start of every function and loop
+# body, so setting it stops them at the next check
+const CANCEL_META = "gdrepl_cancel"
+var cancel_token = CancelToken.new()
+var busy = false
+# Connection and request id of the running evaluation, and when it has to end
+var running_peer = 0
+var running_id = null
+var running_deadline = 0
+# Milliseconds an evaluation can run when the request doesn't set a deadline, 0 for no limit
+const EVAL_DEADLINE = 0
+var eval_deadline = EVAL_DEADLINE
+# Milliseconds a cancelled evaluation has to reach a check before it is abandoned
+const CANCEL_GRACE = 2000
+var cancel_grace = CANCEL_GRACE
+# Threads of abandoned evaluations, waited for once they end
+var abandoned = []
+# Messages that arrived while evaluating, handled in order once it is done
+var queued = []
+# Commands answered while evaluating since they don't change any session
+const commands_while_busy = ["help", "stats", "symbols", "script_local", "script_global", "script_code", "quit"]
+
+# Where the compiled global scopes are written so scripts can extend them
+var base_dir = "user://gdrepl/" + str(OS.get_process_id())
+
+# Compiled scripts indexed by the hash of their source code. Least recently
+# used entries are evicted when the cache is full
+class ScriptCache:
+  var capacity
+  var entries = {}
+  var hits = 0
+  var misses = 0
+  var last_error = OK
+
+  func _init(size):
+    capacity = size
+
+  func lookup(key: String):
+    if not key in entries:
+      misses += 1
+      return null
+    hits += 1
+    var script = entries[key]
+    entries.erase(key)
+    entries[key] = script
+    return script
+
+  func insert(key: String, script):
+    entries[key] = script
+    while len(entries) > capacity:
+      entries.erase(entries.keys()[0])
+
+  # Returns the compiled script for the source or null setting last_error
+  func compile(source: String):
+    var key = source.md5_text()
+    var script = lookup(key)
+    if script != null:
+      return script
+
+    script = GDScript.new()
+    script.source_code = source
+    last_error = script.reload()
+    if last_error != OK:
+      return null
+    insert(key, script)
+    return script
+
+  func stats() -> String:
+    return "Script cache: %d/%d entries, %d hits, %d misses" % [len(entries), capacity, hits, misses]
+
+
+class CancelToken:
+  var cancelled = false
+  var reason = OK
+  var cancelled_at = 0
+
+  # Cancelled typed functions return this, a bare return doesn't compile there
+  func abort():
+    return null
+
+
+# Output of the structured request being evaluated
+class Capture:
+  var peer: int
+  var request_id
+  # Send output frames as it is produced or only put it in the result
+  var stream = true
+  var chunks = []
+  var size = 0
+  var stdout = ""
+  var errors = PackedStringArray()
+  var last_flush = 0
+
+  func _init(p_peer: int, p_request_id, p_stream: bool):
+    peer = p_peer
+    request_id = p_request_id
+    stream = p_stream
+
+  func write(text: String, stream_name: String):
+    if stream_name == "stderr" and text.begins_with("SCRIPT ERROR: "):
+      errors.append(text.trim_prefix("SCRIPT ERROR: ").strip_edges())
+    if not stream:
+      stdout += text
+      return
+    # Consecutive writes to the same stream go on the same frame
+    if len(chunks) > 0 and chunks[-1][0] == stream_name:
+      chunks[-1][1] += text
+    else:
+      chunks.append([stream_name, text])
+    size += len(text)
+
+
 enum Scope {
   Global,
   Yellow,
@@ -56,8 +260,28 @@ enum Scope {
 class Session:
   var global = ""
   var local = ""
+  # Local code that was typed but not executed yet
+  var pending = ""
+  # Persistent local scope. Top level variables are hoisted into members of the
+  # generated script so only the new input has to run on each exec
+  var members = {}
+  var vars = {}
+  # Copies share members and vars until one of them runs code, see own()
+  var shared = false
+  # Last script source generated for this session
+  var last_code = ""
+  # Compiled global scope the generated scripts extend and the global it was built from
+  var base: GDScript
+  var base_path = ""
+  var base_global = ""
+  # Members declared on the global scope, their values persist like the local ones
+  var base_members = []
   var scope = Scope.Local
-  var last_scope_begin_index
+  var last_scope_begin_index = 0
+  # Changes when the names defined in the session change, see touch()
+  var generation = 0
+  # Last time in milliseconds a message was handled for the session
+  var last_used = 0
 
   # Another reason not to add return is if in a local scope like if, elif, for...
   var local_scope_lock = false
@@ -66,14 +290,18 @@ class Session:
     return scope == Scope.Global
 
   func dellast_local():
+    var last_index = get_last_scope_index()
     var i = 0
     var new_local = ""
+    var removed = ""
     for line in local.strip_edges().split("\n"):
-      if i >= last_scope_begin_index:
-        break
-      new_local += line + "\n"
+      if i >= last_index:
+        removed += line + "\n"
+      else:
+        new_local += line + "\n"
       i += 1
     local = new_local
+    forget(removed)
 
   func check_scope(line: String, index: int):
     var has_keyword = line.split(" ")[0] in keywords_local
@@ -90,51 +318,77 @@ class Session:
 
   func get_last_scope_index():
     var i = 0
+    local_scope_lock = false
     for line in local.strip_edges().split("\n"):
       check_scope(line, i)
       i += 1
     return last_scope_begin_index
 
-
-  # Generates script code for the session
-  func code(with_return: bool = true) -> String:
-    if len(local.strip_edges()) == 0:
-      return global
+  # Rewrites top level "var" declarations of the input into assignments and
+  # returns the member declarations they need, without touching the session
+  func hoist(lines: Array, declared: Dictionary) -> Array:
+    var regex = RegEx.new()
+    regex.compile("^var\\s+(?<name>[A-Za-z_]\\w*)\\s*(?::\\s*(?<type>[^=]*))?\\s*(?<op>:?=)?\\s*(?<value>.*)$")
+    var body = []
+    for line in lines:
+      var result = regex.search(line)
+      if result == null:
+        body.append(line)
+        continue
+      var name = result.get_string("name")
+      var type = result.get_string("type").strip_edges()
+      declared[name] = "var " + name + (": " + type if len(type) > 0 else "")
+      if len(result.get_string("op")) > 0:
+        body.append(name + " = " + result.get_string("value"))
+      else:
+        body.append("pass")
+    return body
+
+  # Generates script code that runs the given input against the persistent scope
+  func code(input: String, declared: Dictionary = {}, with_return: bool = true) -> String:
+    var lines = Array(input.strip_edges(false, true).split("\n"))
+    var body = hoist(lines, declared)
+
+    var _members = ""
+    for name in members:
+      if not name in declared and not name in base_members:
+        _members += members[name] + "\n"
+    for name in declared:
+      if not name in base_members:
+        _members += declared[name] + "\n"
 
     var _local = main
-    var lines = Array(local.strip_edges().split("\n"))
-    var last_stripped = lines[-1].strip_edges()
-
-    # In the local scope
-    var last_index = get_last_scope_index()
-    var i = 0
-    if len(lines) > 1:
-      local_scope_lock = false
-      for line in lines.slice(0, len(lines)-1):
-        var has_keyword = check_scope(line, i)
-
-        if i == last_index:
-          var identation = " ".repeat(len(line.rstrip(" ")) - len(line.rstrip(" ").lstrip(" ")))
-          _local += "  " + identation + "print(\"" + STDOUT_MARKER_START + "\")" + "\n"
-
-        _local += "  " + line + "\n"
-        i += 1
-
-    if i == last_index:
-      _local += "  " + "print(\"" + STDOUT_MARKER_START + "\")" + "\n"
-
-    var has_keyword = check_scope(lines[-1], len(lines) - 1)
+    for line in body.slice(0, len(body) - 1):
+      _local += "  " + line + "\n"
 
     # Only put return on local if it is really needed
-    var is_assignment = "=" in last_stripped and not "==" in last_stripped
-    var is_void_call = last_stripped.begins_with("print(") or last_stripped.begins_with("printerr(")
-    var should_skip_return = has_keyword or is_assignment or local_scope_lock or lines[-1].begins_with(" ") or is_void_call
-    if should_skip_return or not with_return:
-      _local += "  " + lines[-1]
+    var last = body[-1]
+    if with_return:
+      _local += "  return " + last
     else:
-      _local += "  return " + lines[-1]
-
-    return global + "\n" + _local
+      _local += "  " + last
+
+    var header = ""
+    if len(base_path) > 0:
+      header = "extends \"" + base_path + "\"\n"
+    return header + _members + "\n" + _local
+
+  # Copies the persistent scope into a fresh instance of the generated script
+  func restore(obj: Object, declared: Dictionary):
+    own()
+    for name in vars:
+      if not name in declared:
+        obj.set(name, vars[name])
+
+  # Stores back the values of all members after running the generated script
+  func store(obj: Object, declared: Dictionary):
+    for name in declared:
+      if not name in base_members:
+        members[name] = declared[name]
+    for name in members:
+      vars[name] = obj.get(name)
+    for name in base_members:
+      vars[name] = obj.get(name)
 
   func delline(num: int, code: String) -> String:
     var lines = Array(code.split("\n"))
@@ -148,26 +402,79 @@ class Session:
     return new_code
 
   func dellocal(line: int):
+    var lines = local.split("\n")
+    var removed = lines[line - 1] if line >= 1 and line <= len(lines) else ""
     local = delline(line, local)
+    forget(removed)
+
+  # Drops the members declared by deleted local code, unless the code left declares
+  # them too. Values the deleted code changed when it ran stay as they are
+  func forget(removed: String):
+    var regex = RegEx.new()
+    regex.compile("^var\\s+([A-Za-z_]\\w*)")
+    var kept = {}
+    for line in local.split("\n"):
+      var result = regex.search(line)
+      if result != null:
+        kept[result.get_string(1)] = true
+    for line in removed.split("\n"):
+      var result = regex.search(line)
+      if result != null and not result.get_string(1) in kept:
+        own()
+        members.erase(result.get_string(1))
+        vars.erase(result.get_string(1))
+
+  func clear_local():
+    local = ""
+    pending = ""
+    members = {}
+    vars = {}
+    shared = false
 
   func delglobal(line: int):
     global = delline(line, global)
 
+  # Copies are cheap whatever the size of the session: strings are copy on write, the
+  # compiled base script is shared and members and vars are only duplicated by own()
   func copy():
     var s = Session.new()
     s.global = global
     s.local = local
+    s.pending = pending
+    s.scope = scope
+    s.last_code = last_code
+    s.members = members
+    s.vars = vars
+    s.shared = true
+    shared = true
+    s.base = base
+    s.base_path = base_path
+    s.base_global = base_global
+    s.base_members = base_members
+    # Static variables live on the base script, the copy builds its own
+    if "static var" in global:
+      s.base_global = ""
+    s.generation = generation
     return s
-    
+
+  # Takes its own members and vars before running code, which changes them in place.
+  # Values are duplicated deeply so arrays and dictionaries don't change in the copies
+  func own():
+    if not shared:
+      return
+    members = members.duplicate()
+    vars = vars.duplicate(true)
+    shared = false
+
 
 
 # Useful for debuging
-func print_script(script, session):
+func print_script(source, session):
   if not debug:
     return
   print(">>>> ", session)
   print("-----------------------------------")
-  print(script.source_code)
+  print(source)
   print("-----------------------------------\n")
 
 func needs_return(code: String) -> bool:
@@ -205,11 +512,8 @@ func needs_return(code: String) -> bool:
   if lines[-1].begins_with(" ") or lines[-1].begins_with("\t"):
     return false
 
-  # Assignment detection using regex (better than string search)
-  var regex = RegEx.new()
-  # Match: word = value (but not ==, !=, <=, >=)
-  regex.compile("^\\w+\\s*=\\s*[^=]")
-  if regex.search(last_line):
+  # Assignments of any kind: x = 1, x += 1, arr[0] = 5, obj.prop = 1
+  if is_assignment(last_line):
     return false
 
   # Known void function calls
@@ -219,6 +523,69 @@ func needs_return(code: String) -> bool:
   # Default: assume it's an expression that needs return
   return true
 
+# Whether the line has an "=" that isn't part of ==, !=, <= or >=, outside of strings.
+# Compound operators like += and <<= count as assignments
+func is_assignment(line: String) -> bool:
+  var strings = RegEx.new()
+  strings.compile("\"(?:[^\"\\\\]|\\\\.)*\"|'(?:[^'\\\\]|\\\\.)*'")
+  var assignment = RegEx.new()
+  assignment.compile("(?:<<|>>|[^=!<>])=(?!=)")
+  return assignment.search(strings.sub(line, "\"\"", true)) != null
+
+# Returns the session with that name, creating it if needed
+func get_session(session: String) -> Session:
+  if not session in sessions:
+    sessions[session] = Session.new()
+  sessions[session].last_used = Time.get_ticks_msec()
+  return sessions[session]
+
+func session_of(id) -> String:
+  return connections.get(id, default_session)
+
+# Attaches a connection to the requested session, creating it if needed. An empty
+# name gets a new session with a random id. Returns an error message on failure
+func join(id, requested) -> String:
+  if requested == null:
+    return ""
+  var session = str(requested)
+  if len(session) == 0:
+    session = Crypto.new().generate_random_bytes(8).hex_encode()
+  if not session in sessions and session != default_session:
+    expire_sessions()
+    if max_sessions > 0 and len(sessions) >= max_sessions:
+      return "Too many sessions (%d)" % max_sessions
+  get_session(session)
+  connections[id] = session
+  return ""
+
+func _on_disconnect(id):
+  var session = session_of(id)
+  connections.erase(id)
+  if session in sessions:
+    sessions[session].last_used = Time.get_ticks_msec()
+
+# Drops the sessions nobody is connected to that weren't used for session_ttl seconds
+func expire_sessions():
+  var now = Time.get_ticks_msec()
+  last_expiry = now
+  var connected = {}
+  for id in connections:
+    connected[connections[id]] = true
+  for session in sessions.keys():
+    if session == default_session or session in connected:
+      continue
+    if now - sessions[session].last_used > session_ttl * 1000:
+      sessions.erase(session)
+      checkpoints.erase(session)
+
+# Error to evaluate the input with when it would grow the session past its limit
+func check_size(s: Session, input: String) -> int:
+  if max_session_source <= 0:
+    return OK
+  if len(s.global) + len(s.local) + len(s.pending) + len(input) > max_session_source:
+    return ERR_OUT_OF_MEMORY
+  return OK
+
 func add_code(code: String, session: String = "main"):
   # Switch to global scope on keywords_global
   if code != main and code.strip_edges().split(" ")[0] in keywords_global:
@@ -233,15 +600,114 @@ func add_code(code: String, session: String = "main"):
 
   if sessions[session].is_global() or sessions[session].scope == Scope.Yellow:
     sessions[session].global += code
+    touch(sessions[session])
   else:
-    sessions[session].local += code
+    sessions[session].pending += code
+
+func touch(s: Session):
+  generations += 1
+  s.generation = generations
+
+func generation(session: String) -> int:
+  if session in sessions:
+    return sessions[session].generation
+  return 0
+
+# Names defined in the session, one "<keyword> <name>" per line
+func symbols(session: String) -> String:
+  if not session in sessions:
+    return ""
+  var s = sessions[session]
+  var regex = RegEx.new()
+  regex.compile("(?m)^(?:@\\S+\\s+)*(?:static\\s+)?(func|class|const|enum|signal|var)\\s+([A-Za-z_]\\w*)")
+  var names = []
+  for result in regex.search_all(s.global):
+    names.append(result.get_string(1) + " " + result.get_string(2))
+  for name in s.members:
+    names.append("var " + name)
+  return "\n".join(names)
+
+# Compiles the global scope of the session into a base script, only when it changed
+func build_base(s: Session) -> int:
+  if s.global == s.base_global:
+    return OK
+
+  if len(s.global.strip_edges()) == 0:
+    s.base = null
+    s.base_path = ""
+    s.base_global = s.global
+    s.base_members = []
+    return OK
+
+  # Static variables live on the script, sessions only share a base script without them
+  var key = s.global.md5_text()
+  if "static var" in s.global:
+    key = (s.global + str(s.get_instance_id())).md5_text()
+  var path = base_dir + "/base_" + key + ".gd"
+  var base = cache.lookup("base_" + key)
+  if base != null:
+    s.base = base
+    s.base_path = path
+    s.base_global = s.global
+    s.base_members = declared_members(s.global)
+    return OK
+
+  if not FileAccess.file_exists(path):
+    DirAccess.make_dir_recursive_absolute(base_dir)
+    var file = FileAccess.open(path, FileAccess.WRITE)
+    if file == null:
+      return FileAccess.get_open_error()
+    file.store_string(instrument(s.global))
+    file.close()
+
+  base = ResourceLoader.load(path, "GDScript")
+  if base == null or not base.can_instantiate():
+    return ERR_PARSE_ERROR
+
+  cache.insert("base_" + key, base)
+  if debug:
+    print(">>>> base script ", path)
+  s.base = base
+  s.base_path = path
+  s.base_global = s.global
+  s.base_members = declared_members(s.global)
+  return OK
+
+# Names of the member variables declared on the top level of a script
+func declared_members(code: String) -> Array:
+  var regex = RegEx.new()
+  regex.compile("(?m)^(?:@\\S+\\s+)*var\\s+([A-Za-z_]\\w*)")
+  var names = []
+  for result in regex.search_all(code):
+    names.append(result.get_string(1))
+  return names
+
+# Removes the base scripts written by this process
+func clean_base_dir():
+  var dir = DirAccess.open(base_dir)
+  if dir == null:
+    return
+  for file in dir.get_files():
+    dir.remove(file)
+  DirAccess.remove_absolute(base_dir)
 
 # Executes the the input code and returns the output
-# The code will accumulate on the session
+# Only the new input runs, local variables persist on the session
 func exec(input: String, session: String = "main") -> String:
+  var result = evaluate(input, session)
+  if result.error_code != OK:
+    return "Err: " + str(result.error_code)
+  return result.result
+
+# Same as exec but returns a dictionary with the result, error and timing
+func evaluate(input: String, session: String = "main") -> Dictionary:
+  var started = Time.get_ticks_usec()
+  var result = {"result": "", "stdout": "", "error": "", "error_code": OK, "time_us": 0}
+
   # Initializes a script for that session
-  if not session in sessions:
-    sessions[session] = Session.new()
+  var err = check_size(get_session(session), input)
+  if err != OK:
+    return finish(result, started, err)
 
   var lines = Array(input.split("\n"))
 
@@ -251,42 +717,227 @@ func exec(input: String, session: String = "main") -> String:
       add_code(line + "\n", session)
 
   if sessions[session].is_global():
-    return ""
+    return finish(result, started)
 
   if sessions[session].scope == Scope.Yellow:
     sessions[session].scope = Scope.Local
-    return ""
+    return finish(result, started)
 
-  # Smart detection: determine if we need return BEFORE compiling
-  var use_return = needs_return(sessions[session].local)
+  return run_pending(sessions[session], session, result, started, true)
 
-  var script = GDScript.new()
-  script.source_code = sessions[session].code(use_return)
-  print_script(script, session)
+# Loads a whole script at once. Its declarations go to the global scope and
+# the statements between them run once, taking a single compile of each
+func load_script(input: String, session: String = "main") -> Dictionary:
+  var started = Time.get_ticks_usec()
+  var result = {"result": "", "stdout": "", "error": "", "error_code": OK, "time_us": 0}
 
-  # Single reload with smart detection
-  var err = script.reload()
+  var s = get_session(session)
+  var err = check_size(s, input)
+  if err != OK:
+    return finish(result, started, err)
+  touch(s)
+
+  var is_global = false
+  var has_statement = false
+  var state = {"depth": 0, "quote": ""}
+  for line in input.split("\n"):
+    var in_string = len(state.quote) > 0
+    var stripped = line.strip_edges()
+    if len(stripped) == 0 and not in_string:
+      continue
+    # Comments stay with the block they are in, the editor comments lines out at column 0
+    var is_code = in_string or not stripped.begins_with("#")
+    # Only top level lines outside of brackets start a new declaration or statement
+    if is_code and not in_string and state.depth == 0 and not line.begins_with(" ") and not line.begins_with("\t"):
+      var first = stripped.split(" ")[0].split("(")[0].rstrip(":")
+      is_global = first in keywords_global or first in keywords_declaration or first.begins_with("@")
+    if is_global:
+      s.global += line + "\n"
+    else:
+      s.pending += line + "\n"
+      has_statement = has_statement or is_code
+    scan_brackets(line, state)
+
+  # Comments between declarations have nothing to run
+  if not has_statement:
+    s.pending = ""
+    return finish(result, started, build_base(s))
+  return run_pending(s, session, result, started, false)
+
+# Follows the bracket depth and the string a script line leaves open, skipping
+# brackets in strings and comments. Only triple quoted strings span lines
+func scan_brackets(line: String, state: Dictionary):
+  var i = 0
+  while i < len(line):
+    var c = line[i]
+    if len(state.quote) > 0:
+      if c == "\\":
+        i += 1
+      elif line.substr(i, len(state.quote)) == state.quote:
+        i += len(state.quote) - 1
+        state.quote = ""
+    elif c == "#":
+      break
+    elif c == "\"" or c == "'":
+      state.quote = c.repeat(3) if line.substr(i, 3) == c.repeat(3) else c
+      i += len(state.quote) - 1
+    elif c in "([{":
+      state.depth += 1
+    elif c in ")]}":
+      state.depth = max(state.depth - 1, 0)
+    i += 1
+  if len(state.quote) == 1:
+    state.quote = ""
+
+# Compiles and runs the pending local code of the session
+func run_pending(s: Session, session: String, result: Dictionary, started: int, with_return: bool) -> Dictionary:
+  var input_local = s.pending
+  s.pending = ""
+  if len(input_local.strip_edges()) == 0:
+    return finish(result, started)
+
+  # The global scope is only recompiled when it changed since the last exec
+  var err = build_base(s)
   if err != OK:
-    sessions[session].dellast_local()
-    return "Err: " + str(err)
+    return finish(result, started, err)
+
+  # Smart detection: determine if we need return BEFORE compiling
+  var use_return = with_return and needs_return(input_local)
+
+  var declared = {}
+  var source = s.code(input_local, declared, use_return)
+  s.last_code = source
+  print_script(source, session)
+
+  # Single compile with smart detection, identical sources reuse the script compiled before
+  var script = cache.compile(instrument(source))
+  if script == null:
+    return finish(result, started, cache.last_error)
 
   var obj = RefCounted.new()
   obj.set_script(script)
+  s.restore(obj, declared)
 
-  if mainfunc in script.source_code:
+  # Markers let the terminal output be split when it is not being captured
+  if capture == null:
     print(STDOUT_MARKER_START)
-    var res = str(obj.call(mainfunc))
+  err = call_threaded(obj, result)
+  if capture == null:
     print(STDOUT_MARKER_END)
-    return res
-  return ""
+
+  # The thread still uses the scope of the session, it can't be trusted anymore
+  if err == ERR_BUSY:
+    sessions.erase(session)
+    result = finish(result, started, err)
+    result.error = "The code didn't stop after being cancelled, the session was reset"
+    return result
+
+  # Values set before the code was stopped are kept, the names it declared are not since its code isn't
+  s.store(obj, declared if err == OK else {})
+  if err != OK:
+    result = finish(result, started, err)
+    result.error = "Timed out" if err == ERR_TIMEOUT else "Cancelled"
+    return result
+  s.local += input_local
+  if len(declared) > 0:
+    touch(s)
+  return finish(result, started)
+
+# Runs the generated script on a thread while the main loop keeps polling, so
+# other clients are served and the evaluation can be cancelled. Returns OK,
+# ERR_TIMEOUT or FAILED when it was stopped at a check and ERR_BUSY when it
+# didn't reach one in time and was abandoned
+func call_threaded(obj: Object, result: Dictionary) -> int:
+  cancel_token.cancelled = false
+  var thread = Thread.new()
+  thread.start(Callable(obj, mainfunc))
+  busy = true
+  while thread.is_alive():
+    _process(0)
+    flush_output()
+    var now = Time.get_ticks_msec()
+    if not loop:
+      cancel(FAILED)
+    elif running_deadline > 0 and now > running_deadline:
+      cancel(ERR_TIMEOUT)
+    if cancel_token.cancelled and now - cancel_token.cancelled_at > cancel_grace:
+      abandoned.append(thread)
+      busy = false
+      return ERR_BUSY
+    if not thread.is_alive():
+      break
+    OS.delay_usec(ACTIVE_DELAY_USEC)
+  busy = false
+
+  var value = thread.wait_to_finish()
+  if cancel_token.cancelled:
+    return cancel_token.reason
+  result.result = str(value)
+  return OK
+
+func cancel(reason: int):
+  if cancel_token.cancelled:
+    return
+  cancel_token.reason = reason
+  cancel_token.cancelled_at = Time.get_ticks_msec()
+  cancel_token.cancelled = true
+
+# Adds a cancellation check at the start of every function and loop body
+func instrument(code: String) -> String:
+  var typed = RegEx.new()
+  typed.compile("->\\s*([\\w.]+)")
+  var check = "if Engine.get_meta(\"" + CANCEL_META + "\").cancelled: return"
+  var lines = PackedStringArray()
+  # Indentation of the enclosing functions and whether they return a value
+  var funcs = []
+  var pending = ""
+  for line in code.split("\n"):
+    var stripped = line.strip_edges()
+    var indent = len(line) - len(line.lstrip(" \t"))
+    # The check goes before the first line of code of the body, with the indent of the body.
+    # Comments can be at any indent, like at column 0 when commented out by the editor
+    if len(stripped) > 0 and not stripped.begins_with("#"):
+      while len(funcs) > 0 and funcs[-1][0] >= indent:
+        funcs.pop_back()
+      if len(pending) > 0:
+        lines.append(line.substr(0, indent) + pending)
+        pending = ""
+    lines.append(line)
+
+    if not stripped.ends_with(":"):
+      continue
+    var first = stripped.trim_prefix("static ").split(" ")[0].split("(")[0]
+    if first == "func":
+      var returns = typed.search(stripped)
+      funcs.append([indent, returns != null and returns.get_string(1) != "void"])
+    elif not first in ["while", "for"]:
+      continue
+    if len(funcs) > 0 and funcs[-1][1]:
+      pending = check + " Engine.get_meta(\"" + CANCEL_META + "\").abort()"
+    else:
+      pending = check
+  return "\n".join(lines)
+
+func finish(result: Dictionary, started: int, err: int = OK) -> Dictionary:
+  if err != OK:
+    result.error_code = err
+    result.error = error_string(err)
+  if capture != null:
+    if len(capture.errors) > 0:
+      result.error = "\n".join(capture.errors)
+    result.stdout = capture.stdout
+  result.time_us = Time.get_ticks_usec() - started
+  return result
 
 # Clear a session
 func clear(session: String = "main"):
   sessions.erase(session)
 
 func _init():
+  Engine.set_meta(CANCEL_META, cancel_token)
   if OS.has_environment("TEST") and OS.get_environment("TEST").to_lower() in ["true", "1"]:
     test()
+    clean_base_dir()
     quit()
     return
 
@@ -296,22 +947,86 @@ func _init():
   if OS.has_environment("PORT"):
     port = OS.get_environment("PORT").to_int()
 
+  if OS.has_environment("SESSION"):
+    default_session = OS.get_environment("SESSION")
+
+  if OS.has_environment("MAX_SESSIONS"):
+    max_sessions = OS.get_environment("MAX_SESSIONS").to_int()
+
+  if OS.has_environment("MAX_SESSION_SOURCE"):
+    max_session_source = OS.get_environment("MAX_SESSION_SOURCE").to_int()
+
+  if OS.has_environment("SESSION_TTL"):
+    session_ttl = OS.get_environment("SESSION_TTL").to_int()
+
+  if OS.has_environment("SNAPSHOT_DIR"):
+    snapshot_dir = OS.get_environment("SNAPSHOT_DIR")
+
+  if OS.has_environment("MAX_CHECKPOINTS"):
+    max_checkpoints = OS.get_environment("MAX_CHECKPOINTS").to_int()
+
+  if OS.has_environment("EVAL_DEADLINE"):
+    eval_deadline = OS.get_environment("EVAL_DEADLINE").to_int()
+
+  if OS.has_environment("CANCEL_GRACE"):
+    cancel_grace = OS.get_environment("CANCEL_GRACE").to_int()
+
+  if OS.has_environment("CACHE_SIZE"):
+    cache.capacity = OS.get_environment("CACHE_SIZE").to_int()
+
+  if OS.has_environment("IDLE_DELAY"):
+    idle_delay = OS.get_environment("IDLE_DELAY").to_int()
+
+  if OS.has_environment("ACTIVE_SPIN"):
+    active_spin = OS.get_environment("ACTIVE_SPIN").to_int()
+
 
   _server.message_received.connect(_on_message)
+  _server.client_disconnected.connect(_on_disconnect)
+  install_logger()
 
-  # Start listening on the given port.
+  # Start listening on the given port. On port 0 the OS picks a free one and the
+  # port printed is the one we got, so launchers don't have to probe for a port
   var err = _server.listen(port)
   if err != OK:
     print("Unable to start server")
+  else:
+    port = _server.get_local_port()
   print("Gdrepl Listening on ", port)
-  while loop:
-    OS.delay_msec(50)
-    _process(0)
+  serve()
 
   free()
   quit()
 
 
+# Polls the server with no delay while there is traffic and backs off up to
+# idle_delay when there isn't. With active_spin at 0 it always polls every
+# idle_delay milliseconds
+func serve():
+  var delay = 0
+  var seen = 0
+  while loop:
+    _process(0)
+    if len(queued) > 0:
+      var next = queued.pop_front()
+      dispatch(next[0], next[1])
+    if Time.get_ticks_msec() - last_expiry > 1000:
+      expire_sessions()
+      reap_abandoned()
+      wait_snapshots(false)
+    if handled != seen:
+      seen = handled
+      last_active = Time.get_ticks_msec()
+
+    var active = Time.get_ticks_msec() - last_active < active_spin or len(_server.pending_peers) > 0
+    if active_spin > 0 and active:
+      delay = 0
+      OS.delay_usec(ACTIVE_DELAY_USEC)
+      continue
+    delay = clampi(delay * 2, 1, idle_delay) if active_spin > 0 else idle_delay
+    OS.delay_msec(delay)
+
+
 # Tests
 #############
 const cmd0 = "1+1"
@@ -363,13 +1078,319 @@ func test():
 
 
 func _on_message(id, message):
+  handled += 1
   if debug:
     print("Got message from client %d: %s" % [id, message])
 
-  var session = "main"
-  if OS.has_environment("SESSION") and session == "main":
-    session = OS.get_environment("SESSION")
+  if busy and not answered_while_busy(message):
+    queued.append([id, message])
+    return
+  dispatch(id, message)
+
+# Whether a message can be handled while an evaluation runs without waiting for it
+func answered_while_busy(message: String) -> bool:
+  var request = parse_request(message)
+  if request == null:
+    return message.strip_edges().to_lower() in commands_while_busy
+  if request.op in ["hello", "cancel"]:
+    return true
+  if request.op != "eval" or not request.get("commands", true):
+    return false
+  return str(request.get("code", "")).strip_edges().to_lower() in commands_while_busy
+
+func dispatch(id, message: String):
+  var session = session_of(id)
+  if session in sessions:
+    sessions[session].last_used = Time.get_ticks_msec()
 
+  var request = parse_request(message)
+  if request != null:
+    on_request(id, request, session)
+    return
+
+  # Plain text protocol
+  if not busy:
+    begin(id, null, eval_deadline)
+  var reply = handle(message, session)
+  match reply.type:
+    "quit":
+      return
+    "command":
+      var response = reply.output
+      if len(response) == 0:
+        response = "-"
+      send(id, response)
+    "result":
+      if reply.error_code != OK:
+        send(id, ">> Err: " + str(reply.error_code))
+      else:
+        send(id, ">> " + reply.result)
+
+
+# Structured protocol: json objects with a "v" version, an "id" that is sent
+# back on the reply and an "op". Anything else is handled as plain text
+func parse_request(message: String):
+  if not message.begins_with("{"):
+    return null
+  var json = JSON.new()
+  if json.parse(message) != OK:
+    return null
+  if typeof(json.data) != TYPE_DICTIONARY or not "op" in json.data:
+    return null
+  return json.data
+
+# Json numbers are floats, ids are sent back as they were sent
+func request_id_of(value):
+  if typeof(value) == TYPE_FLOAT and value == floor(value):
+    return int(value)
+  return value
+
+# Remembers who the next evaluation is for and when it has to end
+func begin(id, request_id, deadline):
+  running_peer = id
+  running_id = request_id
+  running_deadline = Time.get_ticks_msec() + int(deadline) if deadline and int(deadline) > 0 else 0
+
+func on_request(id, request: Dictionary, session: String):
+  var request_id = request_id_of(request.get("id"))
+  if request.op in ["eval", "load"] and not busy:
+    begin(id, request_id, request.get("deadline", eval_deadline))
+
+  var reply = {}
+  match request.op:
+    "hello":
+      var err = join(id, request.get("session"))
+      session = session_of(id)
+      if len(err) > 0:
+        reply = {"type": "error", "error": err}
+      else:
+        reply = {
+          "type": "hello",
+          "version": PROTOCOL_VERSION,
+          "engine": Engine.get_version_info().string,
+          "capabilities": capabilities,
+          "commands": commands,
+          "session": session,
+          "generation": generation(session),
+        }
+    "eval":
+      # Commands answered while another request evaluates leave its capture alone
+      var captured = logger != null and not busy
+      if captured:
+        set_capture(Capture.new(id, request_id, request.get("stream", true)))
+      reply = handle(str(request.get("code", "")), session, request.get("commands", true))
+      if reply.type == "quit":
+        if captured:
+          set_capture(null)
+        return
+      if captured:
+        flush_output(true)
+        set_capture(null)
+      reply["generation"] = generation(session)
+    "load":
+      if logger != null:
+        set_capture(Capture.new(id, request_id, request.get("stream", true)))
+      reply = load_script(str(request.get("code", "")), session)
+      reply["type"] = "result"
+      flush_output(true)
+      set_capture(null)
+      reply["generation"] = generation(session)
+    "cancel":
+      reply = {"type": "cancel", "cancelled": cancel_request(id, request_id_of(request.get("target")))}
+    _:
+      reply = {"type": "error", "error": "Unknown op: " + str(request.op)}
+
+  reply["v"] = PROTOCOL_VERSION
+  reply["id"] = request_id
+  send(id, JSON.stringify(reply))
+
+
+# Cancels a request of the connection, running or waiting for the running one
+func cancel_request(id, target) -> bool:
+  if busy and running_peer == id and running_id == target:
+    cancel(FAILED)
+    return true
+  for i in len(queued):
+    var request = parse_request(queued[i][1])
+    if queued[i][0] == id and request != null and request_id_of(request.get("id")) == target:
+      queued.remove_at(i)
+      var reply = {"type": "result", "result": "", "stdout": "", "error": "Cancelled", "error_code": FAILED, "time_us": 0}
+      reply["v"] = PROTOCOL_VERSION
+      reply["id"] = target
+      send(id, JSON.stringify(reply))
+      return true
+  return false
+
+# Waits for the threads of abandoned evaluations that ended since
+func reap_abandoned():
+  for thread in abandoned.duplicate():
+    if not thread.is_alive():
+      thread.wait_to_finish()
+      abandoned.erase(thread)
+
+# Text after the command name
+func argument(message: String) -> String:
+  var parts = message.strip_edges().split(" ", false, 1)
+  return parts[1].strip_edges() if len(parts) > 1 else ""
+
+# Saves a copy of the session, without a name lists the saved ones
+func checkpoint(session: String, name: String) -> String:
+  var saved = checkpoints.get(session, {})
+  if len(name) == 0:
+    return "\n".join(saved.keys())
+  if not name in saved and max_checkpoints > 0 and len(saved) >= max_checkpoints:
+    return "Error: Too many checkpoints (%d)" % max_checkpoints
+  saved[name] = get_session(session).copy()
+  checkpoints[session] = saved
+  return "Saved checkpoint " + name
+
+func restore_checkpoint(session: String, name: String) -> String:
+  var saved = checkpoints.get(session, {})
+  if not name in saved:
+    return "Error: No checkpoint named '%s'" % name
+  # The checkpoint stays as it is, the session gets a copy of it
+  var s = saved[name].copy()
+  s.last_used = Time.get_ticks_msec()
+  sessions[session] = s
+  touch(s)
+  return "Restored checkpoint " + name
+
+# Names with a prefix, like irc:nick, belong to the session of that name: such sessions
+# only get to use their own name and no other session gets theirs, for forks and snapshots
+func owns(session: String, name: String) -> bool:
+  if ":" in session or ":" in name:
+    return name == session
+  return true
+
+func fork(session: String, name: String) -> String:
+  if len(name) == 0:
+    return "Error: The new session needs a name"
+  # Otherwise whoever joins that name next would run the globals of the fork
+  if not owns(session, name):
+    return "Error: Session '%s' can't fork into '%s'" % [session, name]
+  if name in sessions or name == default_session:
+    return "Error: Session '%s' already exists" % name
+  expire_sessions()
+  if max_sessions > 0 and len(sessions) >= max_sessions:
+    return "Error: Too many sessions (%d)" % max_sessions
+  var s = get_session(session).copy()
+  s.last_used = Time.get_ticks_msec()
+  sessions[name] = s
+  return "Forked into " + name
+
+# Hex keeps every name apart, irc:a and irc_a would share a file with validate_filename()
+func snapshot_path(name: String) -> String:
+  return snapshot_dir + "/" + name.to_utf8_buffer().hex_encode() + ".snap"
+
+# Whether var_to_bytes can keep the value, objects and what refers to them can't
+func serializable(value) -> bool:
+  match typeof(value):
+    TYPE_OBJECT, TYPE_CALLABLE, TYPE_SIGNAL, TYPE_RID:
+      return false
+    TYPE_ARRAY:
+      for item in value:
+        if not serializable(item):
+          return false
+    TYPE_DICTIONARY:
+      for key in value:
+        if not serializable(key) or not serializable(value[key]):
+          return false
+  return true
+
+# Saves the sources and variables of the session so it can be resumed without running
+# its code again, even by another server. It is encoded right away and written to disk
+# on the worker thread pool
+func snapshot(session: String, name: String) -> String:
+  if len(name) == 0:
+    name = session
+  # Otherwise the session of that name would resume someone else's snapshot
+  if not owns(session, name):
+    return "Error: Session '%s' can't write snapshot '%s'" % [session, name]
+  var s = get_session(session)
+  var vars = {}
+  var skipped = PackedStringArray()
+  for key in s.vars:
+    if serializable(s.vars[key]):
+      vars[key] = s.vars[key]
+    else:
+      skipped.append(key)
+  var data = var_to_bytes({
+    "format": SNAPSHOT_FORMAT,
+    # Session that wrote it, resume checks it like the name
+    "session": session,
+    "global": s.global,
+    "local": s.local,
+    "scope": s.scope,
+    "members": s.members,
+    # Key of the compiled global scope in the script cache
+    "base_key": s.global.md5_text(),
+    "vars": vars,
+  })
+  snapshot_tasks.append(WorkerThreadPool.add_task(write_snapshot.bind(snapshot_path(name), data)))
+  var response = "Saving snapshot " + name
+  if len(skipped) > 0:
+    response += ", without the variables that can't be saved: " + ", ".join(skipped)
+  return response
+
+func write_snapshot(path: String, data: PackedByteArray):
+  DirAccess.make_dir_recursive_absolute(path.get_base_dir())
+  # Written aside and renamed so an interrupted write never replaces a good snapshot
+  var file = FileAccess.open(path + ".tmp", FileAccess.WRITE)
+  if file == null:
+    printerr("Could not write ", path, ": ", error_string(FileAccess.get_open_error()))
+    return
+  file.store_buffer(data)
+  file.close()
+  DirAccess.rename_absolute(path + ".tmp", path)
+
+# Waits for the snapshots being written, or only frees the ones that are done already
+func wait_snapshots(unfinished: bool = true):
+  for task in snapshot_tasks.duplicate():
+    if unfinished or WorkerThreadPool.is_task_completed(task):
+      WorkerThreadPool.wait_for_task_completion(task)
+      snapshot_tasks.erase(task)
+
+# Replaces the session with a snapshot in a single step, the global scope is compiled
+# again but none of the code that was run is
+func resume(session: String, name: String) -> String:
+  if len(name) == 0:
+    name = session
+  if not owns(session, name):
+    return "Error: Session '%s' can't read snapshot '%s'" % [session, name]
+  # A snapshot that is still being written is finished first
+  wait_snapshots()
+  var path = snapshot_path(name)
+  if not FileAccess.file_exists(path):
+    return "Error: No snapshot named '%s'" % name
+  var data = bytes_to_var(FileAccess.get_file_as_bytes(path))
+  if typeof(data) != TYPE_DICTIONARY or data.get("format") != SNAPSHOT_FORMAT:
+    return "Error: Snapshot '%s' can't be read" % name
+  if data.base_key != data.global.md5_text():
+    return "Error: Snapshot '%s' is damaged" % name
+  if not owns(session, data.session):
+    return "Error: Session '%s' can't read snapshot '%s'" % [session, name]
+
+  var s = Session.new()
+  s.global = data.global
+  s.local = data.local
+  s.scope = data.scope
+  s.members = data.members
+  s.vars = data.vars
+  s.last_used = Time.get_ticks_msec()
+  var err = build_base(s)
+  if err != OK:
+    return "Error: The global scope of snapshot '%s' doesn't compile: %s" % [name, error_string(err)]
+  sessions[session] = s
+  touch(s)
+  return "Resumed snapshot " + name
+
+# Runs a server command or evaluates the message as code. Without commands it is only
+# evaluated, so code sent on behalf of others can't run commands like quit
+func handle(message: String, session: String, with_commands: bool = true) -> Dictionary:
+  if not with_commands:
+    var evaluated = evaluate(message, session)
+    evaluated["type"] = "result"
+    return evaluated
 
   # Commands without arguments
   var cmd = message.strip_edges().to_lower()
@@ -377,10 +1398,11 @@ func _on_message(id, message):
   var has_command = true
   match cmd :
     "quit":
+      wait_snapshots()
       _server.stop()
       loop = false
       quit()
-      return
+      return {"type": "quit"}
     "help":
       response = "GDREPL Server Help\n"
       for c in commands:
@@ -401,51 +1423,146 @@ func _on_message(id, message):
 
     "script_code":
       if session in sessions:
-        response = sessions[session].code()
+        response = sessions[session].last_code
 
     "dellast_local":
-      sessions[session].dellast_local()
+      get_session(session).dellast_local()
+      touch(sessions[session])
 
     "delglobal":
-      sessions[session].global = ""
+      get_session(session).global = ""
+      touch(sessions[session])
+
+    "stats":
+      response = cache.stats() + "\nSessions: %d/%d, %d connections" % [len(sessions), max_sessions, len(connections)]
+
+    "symbols":
+      response = symbols(session)
 
     "dellocal": 
-      sessions[session].local = ""
+      get_session(session).clear_local()
+      touch(sessions[session])
 
     _: 
       has_command = false
 
   if has_command:
-    if len(response) == 0:
-      response = "-"
-    send(id, response)
-    return
+    return {"type": "command", "command": cmd, "output": response}
 
   # Commands with arguments
   cmd = message.strip_edges().split(" ")[0].to_lower()
   match cmd:
     "delline_local":
-      sessions[session].dellocal((message.split(" ")[1]).to_int())
+      get_session(session).dellocal((message.split(" ")[1]).to_int())
+      touch(sessions[session])
       response = "Deleted line"
 
     "delline_global":
-      sessions[session].delglobal((message.split(" ")[1]).to_int())
+      get_session(session).delglobal((message.split(" ")[1]).to_int())
+      touch(sessions[session])
       response = "Deleted line"
 
+    "checkpoint":
+      response = checkpoint(session, argument(message))
+
+    "restore":
+      response = restore_checkpoint(session, argument(message))
+
+    "fork":
+      response = fork(session, argument(message))
+
+    "snapshot":
+      response = snapshot(session, argument(message))
+
+    "resume":
+      response = resume(session, argument(message))
+
     _:
-      response = exec(message, session)
-      send(id, ">> " + response)
-      return
+      var result = evaluate(message, session)
+      result["type"] = "result"
+      return result
 
-  send(id, response)
+  return {"type": "command", "command": cmd, "output": response}
 
 
 func send(id, data):
-  _server.peers.get(id).put_packet(data.to_utf8_buffer())
+  var peer = _server.peers.get(id)
+  if peer != null:
+    peer.put_packet(data.to_utf8_buffer())
+
+
+func install_logger():
+  if not ClassDB.class_exists("Logger"):
+    return
+  var script = GDScript.new()
+  script.source_code = capture_source
+  if script.reload() != OK:
+    return
+  logger = script.new()
+  logger.sink = _on_log
+  OS.call("add_logger", logger)
+  capabilities.append("output")
+
+
+# Abandoned evaluations can still be logging into the capture from their thread
+func set_capture(value: Capture):
+  capture_mutex.lock()
+  capture = value
+  capture_mutex.unlock()
+
+# Called by the logger for everything godot prints, from any thread
+func _on_log(message: String, stream: String):
+  # Sending frames can log, that shouldn't be captured. Evaluations log from their thread
+  if capture == null or (flushing and OS.get_thread_caller_id() == OS.get_main_thread_id()):
+    return
+  # Returning the value of a void call logs this but the call still runs, like the
+  # terminal output parser the reply doesn't show it as an error
+  if "Cannot get return value" in message:
+    return
+  capture_mutex.lock()
+  if capture != null:
+    capture.write(message, stream)
+  capture_mutex.unlock()
+  if OS.get_thread_caller_id() == OS.get_main_thread_id():
+    flush_output()
+
+
+# Sends the captured output as frames tied to the request
+func flush_output(force: bool = false):
+  if capture == null or not capture.stream:
+    return
+  var now = Time.get_ticks_msec()
+  if not force and capture.size < OUTPUT_FLUSH_BYTES and now - capture.last_flush < OUTPUT_FLUSH_MSEC:
+    return
+
+  capture_mutex.lock()
+  var chunks = capture.chunks
+  capture.chunks = []
+  capture.size = 0
+  capture.last_flush = now
+  capture_mutex.unlock()
+
+  flushing = true
+  for chunk in chunks:
+    send(capture.peer, JSON.stringify({
+      "v": PROTOCOL_VERSION,
+      "id": capture.request_id,
+      "type": "output",
+      "stream": chunk[0],
+      "text": chunk[1],
+    }))
+  # Write the frames now instead of on the next poll
+  var peer = _server.peers.get(capture.peer)
+  if peer != null and len(chunks) > 0:
+    peer.poll()
+  flushing = false
 
 func _process(_delta):
   _server.poll()
 
 func free():
   _server.stop()
+  clean_base_dir()
+  if logger != null:
+    OS.call("remove_logger", logger)
   # super().free()
@@ -1,22 +1,211 @@
+import contextlib
 import os
 import shutil
+import sqlite3
+import sys
+import threading
+from collections.abc import Iterable
 from pathlib import Path
+from typing import Optional
 
+from prompt_toolkit.auto_suggest import AutoSuggest
+from prompt_toolkit.auto_suggest import Suggestion
+from prompt_toolkit.buffer import Buffer
+from prompt_toolkit.document import Document
 from prompt_toolkit.history import FileHistory
 
 
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (inode INTEGER PRIMARY KEY, size INTEGER NOT NULL);
+CREATE TABLE IF NOT EXISTS entries (text TEXT PRIMARY KEY, seq INTEGER NOT NULL, file INTEGER NOT NULL);
+CREATE INDEX IF NOT EXISTS entries_seq ON entries (seq);
+CREATE INDEX IF NOT EXISTS entries_file ON entries (file);
+"""
+
+# Trigram full text index kept in sync with entries, needs sqlite 3.34+ built with fts5
+FTS_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS entries_fts USING fts5(text, content='entries', tokenize='trigram');
+CREATE TRIGGER IF NOT EXISTS entries_ai AFTER INSERT ON entries BEGIN
+  INSERT INTO entries_fts(rowid, text) VALUES (new.rowid, new.text);
+END;
+CREATE TRIGGER IF NOT EXISTS entries_ad AFTER DELETE ON entries BEGIN
+  INSERT INTO entries_fts(entries_fts, rowid, text) VALUES ('delete', old.rowid, old.text);
+END;
+"""
+
+
+def parse_entries(data: bytes) -> list[str]:
+    """Entries in a chunk of a history file, in the format FileHistory writes"""
+    entries = []
+    lines: list[str] = []
+    for line in data.decode("utf-8", errors="replace").splitlines():
+        if line.startswith("+"):
+            lines.append(line[1:])
+        elif lines:
+            entries.append("\n".join(lines))
+            lines = []
+    if lines:
+        entries.append("\n".join(lines))
+    return entries
+
+
+def prefix_end(prefix: str) -> Optional[str]:
+    """First string after all the ones starting with prefix, None when nothing sorts after them.
+
+    It is prefix with its last character bumped, characters that can't be bumped are dropped
+    and surrogates, which can't be stored, are skipped.
+    """
+    stripped = prefix.rstrip(chr(sys.maxunicode))
+    if not stripped:
+        return None
+    bumped = ord(stripped[-1]) + 1
+    if 0xD800 <= bumped <= 0xDFFF:
+        bumped = 0xE000
+    return stripped[:-1] + chr(bumped)
+
+
+class HistoryIndex:
+    """SQLite index of every distinct entry in a history file and its rotated backups.
+
+    Each entry is kept once with the sequence number of its latest use. Prefix lookups are
+    range scans of the primary key and substring searches go through a trigram index, or
+    LIKE when sqlite has no trigram tokenizer. Files are tracked by inode so rotating them
+    doesn't index them again, and only what was appended since the last refresh is read.
+    """
+
+    def __init__(self, filename: str, backup_count: int = 3) -> None:
+        self.history_path = Path(filename)
+        self.backup_count = backup_count
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(str(self.history_path.with_suffix(".db")), check_same_thread=False)
+        self.db.executescript(SCHEMA)
+        try:
+            self.db.executescript(FTS_SCHEMA)
+            self.fts = True
+        except sqlite3.OperationalError:
+            self.fts = False
+        self.refresh()
+
+    def close(self) -> None:
+        self.db.close()
+
+    def files(self) -> list[Path]:
+        """History files oldest first"""
+        backups = [self.history_path.with_suffix(f".{i}") for i in range(self.backup_count, 0, -1)]
+        return [path for path in [*backups, self.history_path] if path.exists()]
+
+    def refresh(self) -> None:
+        """Indexes what was appended to the history files since the last refresh"""
+        with self.lock, self.db:
+            current = {}
+            for path in self.files():
+                stat = path.stat()
+                current[stat.st_ino] = (path, stat.st_size)
+
+            indexed = dict(self.db.execute("SELECT inode, size FROM files").fetchall())
+            for inode in indexed.keys() - current.keys():
+                self._drop(inode)
+
+            (seq,) = self.db.execute("SELECT COALESCE(MAX(seq), 0) FROM entries").fetchone()
+            for inode, (path, size) in current.items():
+                offset = indexed.get(inode, 0)
+                if size < offset:
+                    # Rewritten rather than appended to
+                    self._drop(inode)
+                    offset = 0
+                if size == offset:
+                    continue
+
+                with open(path, "rb") as f:
+                    f.seek(offset)
+                    data = f.read(size - offset)
+                for text in parse_entries(data):
+                    seq += 1
+                    self.db.execute(
+                        "INSERT INTO entries (text, seq, file) VALUES (?, ?, ?) "
+                        "ON CONFLICT (text) DO UPDATE SET seq = excluded.seq, file = excluded.file",
+                        (text, seq, inode),
+                    )
+                self.db.execute("INSERT OR REPLACE INTO files (inode, size) VALUES (?, ?)", (inode, size))
+
+    def _drop(self, inode: int) -> None:
+        self.db.execute("DELETE FROM entries WHERE file = ?", (inode,))
+        self.db.execute("DELETE FROM files WHERE inode = ?", (inode,))
+
+    def suggest(self, prefix: str) -> Optional[str]:
+        """Most recent entry starting with prefix"""
+        if not prefix:
+            return None
+        end = prefix_end(prefix)
+        query = "SELECT text FROM entries WHERE text >= ? AND text < ? ORDER BY seq DESC LIMIT 1"
+        args: tuple = (prefix, end)
+        if end is None:
+            query = "SELECT text FROM entries WHERE text >= ? ORDER BY seq DESC LIMIT 1"
+            args = (prefix,)
+        with self.lock:
+            row = self.db.execute(query, args).fetchone()
+        return row[0] if row else None
+
+    def search(self, substring: str, limit: int = 20) -> list[str]:
+        """Most recent entries containing substring, case insensitive"""
+        # Trigrams can't match less than 3 characters
+        if self.fts and len(substring) >= 3:
+            query = (
+                "SELECT e.text FROM entries_fts JOIN entries e ON e.rowid = entries_fts.rowid "
+                "WHERE entries_fts MATCH ? ORDER BY e.seq DESC LIMIT ?"
+            )
+            args: tuple = ('"' + substring.replace('"', '""') + '"', limit)
+        else:
+            escaped = substring.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+            query = "SELECT text FROM entries WHERE text LIKE ? ESCAPE '\\' ORDER BY seq DESC LIMIT ?"
+            args = ("%" + escaped + "%", limit)
+        with self.lock:
+            return [row[0] for row in self.db.execute(query, args)]
+
+    def recent(self, limit: int) -> list[str]:
+        """Latest entries, newest first"""
+        with self.lock:
+            return [row[0] for row in self.db.execute("SELECT text FROM entries ORDER BY seq DESC LIMIT ?", (limit,))]
+
+
+class IndexedAutoSuggest(AutoSuggest):
+    """Suggests the most recent history entry starting with the current line, from the history index"""
+
+    def __init__(self, history: "RotatingFileHistory") -> None:
+        self.history = history
+
+    def get_suggestion(self, buffer: Buffer, document: Document) -> Optional[Suggestion]:
+        text = document.text.rsplit("\n", 1)[-1]
+        if not text.strip():
+            return None
+        match = self.history.index.suggest(text)
+        if match is None:
+            return None
+        # Suggest the rest of the line, like AutoSuggestFromHistory
+        return Suggestion(match[len(text) :].split("\n", 1)[0])
+
+
 class RotatingFileHistory(FileHistory):
-    def __init__(self, filename: str, max_entries: int = 10000, backup_count: int = 3) -> None:
+    def __init__(self, filename: str, max_entries: int = 10000, backup_count: int = 3, indexed: bool = False) -> None:
         expanded_filename = os.path.expanduser(filename)
         # Ensure parent directory exists
         Path(expanded_filename).parent.mkdir(parents=True, exist_ok=True)
         super().__init__(expanded_filename)
         self.max_entries = max_entries
         self.backup_count = backup_count
+        # Serve loading, suggestions and searches from a HistoryIndex, opened on first use
+        self.indexed = indexed
+        self._index: Optional[HistoryIndex] = None
+
+        # Lines in the history file and its size when they were counted. Kept in a sidecar
+        # file so appending doesn't have to read the whole history again
+        self.count_path = Path(expanded_filename).with_suffix(".count")
+        self._entries, self._size = self._load_count()
+        self._save_count()
         self._ensure_rotation()
 
     def _ensure_rotation(self) -> None:
-        if self._count_entries() > self.max_entries:
+        if self._entries > self.max_entries:
             self._rotate_history()
 
     def _rotate_history(self) -> None:
@@ -31,6 +220,9 @@ class RotatingFileHistory(FileHistory):
         if history_path.exists():
             shutil.move(str(history_path), str(history_path.with_suffix(".1")))
 
+        self._entries, self._size = 0, 0
+        self._save_count()
+
     def _count_entries(self) -> int:
         try:
             with open(self.filename) as f:
@@ -38,6 +230,56 @@ class RotatingFileHistory(FileHistory):
         except FileNotFoundError:
             return 0
 
+    def _file_size(self) -> int:
+        try:
+            return os.stat(self.filename).st_size
+        except FileNotFoundError:
+            return 0
+
+    def _load_count(self) -> tuple[int, int]:
+        """Entries from the sidecar, the history is only counted again if it changed size since"""
+        size = self._file_size()
+        try:
+            entries, counted_size = (int(n) for n in self.count_path.read_text().split())
+            if counted_size == size:
+                return entries, size
+        except (OSError, ValueError):
+            pass
+
+        return self._count_entries(), size
+
+    def _save_count(self) -> None:
+        with contextlib.suppress(OSError):
+            self.count_path.write_text(f"{self._entries} {self._size}\n")
+
+    def _count_appended(self, offset: int) -> int:
+        """Lines written to the history after offset"""
+        with open(self.filename, "rb") as f:
+            f.seek(offset)
+            return f.read().count(b"\n")
+
     def store_string(self, string: str) -> None:
+        size = self._file_size()
         super().store_string(string)
+
+        # Another repl wrote to the same history since it was last counted
+        if size != self._size:
+            self._entries = self._count_entries()
+        else:
+            self._entries += self._count_appended(size)
+        self._size = self._file_size()
+        self._save_count()
         self._ensure_rotation()
+        if self._index is not None:
+            self._index.refresh()
+
+    @property
+    def index(self) -> HistoryIndex:
+        if self._index is None:
+            self._index = HistoryIndex(str(self.filename), self.backup_count)
+        return self._index
+
+    def load_history_strings(self) -> Iterable[str]:
+        if not self.indexed:
+            return super().load_history_strings()
+        return self.index.recent(self.max_entries)
@@ -26,6 +26,10 @@ class REPLKeyBindings:
             else:
                 buffer.insert_text("    ")
 
+        @self.bindings.add("c-space")
+        def complete(event: Any) -> None:
+            event.current_buffer.start_completion(select_first=False)
+
         @self.bindings.add("f4")
         def toggle_mode(event: Any) -> None:
             app = event.app
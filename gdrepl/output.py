@@ -0,0 +1,150 @@
+"""Output of servers that don't stream it over the websocket.
+
+Those servers print what the code prints to their terminal between the stdout markers.
+The terminal is read in a thread as it is written and the lines between the markers are
+printed right away, so a snippet printing hundreds of MB neither fills memory nor blocks
+godot on a full pty while the repl waits for its reply.
+"""
+
+import codecs
+import sys
+import threading
+from collections.abc import Callable
+from typing import Any
+from typing import Optional
+
+from .constants import STDOUT_MARKER_END
+from .constants import STDOUT_MARKER_START
+
+
+# Longest piece of a line kept while waiting for its end, longer lines are printed in parts
+MAX_LINE = 64 * 1024
+CHUNK_SIZE = 64 * 1024
+
+# Seconds the reader waits on the terminal before considering it idle
+IDLE_WAIT = 0.05
+# Longest the repl waits for the output of a run to be printed
+SETTLE_TIMEOUT = 1.0
+
+# Lines of trace godot prints after the error of calling a void function for its return value
+VOID_TRACE_LINES = 10
+
+# Text of the lines that change what is written, chunks without them are written as they are
+SPECIAL = ("STDOUT", "SCRIPT ERROR:", "Cannot get return value")
+
+
+class OutputParser:
+    """Splits the terminal output into lines in a single pass, keeping at most MAX_LINE of it.
+
+    Lines between the stdout markers are written out, script errors outside of them are
+    written without their prefix. The errors of returning the value of void calls, which
+    still run, are left out with their traces.
+    """
+
+    def __init__(self, write: Callable[[str], None]) -> None:
+        self.write = write
+        self.decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        self.partial = ""
+        self.inside = False
+        # Lines left to drop from a void return error trace
+        self.skip = 0
+        # Script error line kept until the next line tells if it is about a void return
+        self.held: Optional[str] = None
+
+    def feed(self, data: bytes) -> None:
+        text = self.partial + self.decoder.decode(data)
+        end = text.rfind("\n") + 1
+        lines, self.partial = text[:end], text[end:]
+        if self.inside and not self.skip and self.held is None and not any(s in lines for s in SPECIAL):
+            # Plain output, written in one go
+            self.write(lines.replace("\r\n", "\n"))
+        else:
+            for line in lines.split("\n")[:-1]:
+                self._line(line.rstrip("\r"))
+
+        if len(self.partial) > MAX_LINE:
+            # Keep what could be the start of a marker
+            keep = len(STDOUT_MARKER_END)
+            if self.inside and not self.skip:
+                self.write(self.partial[:-keep])
+            self.partial = self.partial[-keep:]
+
+    def _line(self, line: str) -> None:
+        if self.held is not None:
+            held, self.held = self.held, None
+            if "Cannot get return value" in line:
+                self.skip = VOID_TRACE_LINES
+                return
+            self._show(held)
+
+        if self.skip:
+            self.skip -= 1
+            return
+
+        stripped = line.strip()
+        if stripped == STDOUT_MARKER_START:
+            self.inside = True
+        elif stripped == STDOUT_MARKER_END:
+            self.inside = False
+        elif "Cannot get return value" in line and 'returns "void"' in line:
+            self.skip = VOID_TRACE_LINES
+        elif "SCRIPT ERROR:" in line:
+            self.held = line
+        else:
+            self._show(line)
+
+    def _show(self, line: str) -> None:
+        if self.inside:
+            self.write(line + "\n")
+        elif "SCRIPT ERROR:" in line:
+            self.write(line.split("SCRIPT ERROR:", 1)[1].strip() + "\n")
+
+
+def write_stdout(text: str) -> None:
+    sys.stdout.write(text)
+    sys.stdout.flush()
+
+
+class TerminalOutput:
+    """Reads the terminal of a pexpect spawned server in a thread, printing the output of each run"""
+
+    def __init__(self, server: Any, write: Callable[[str], None] = write_stdout) -> None:
+        self.server = server
+        self.parser = OutputParser(write)
+        # Reads of the terminal started so far and the last one that found nothing to read
+        self.reads = 0
+        self.idle_read = 0
+        self.closed = False
+        self.changed = threading.Condition()
+        self.thread = threading.Thread(target=self._read, daemon=True)
+        self.thread.start()
+
+    def _read(self) -> None:
+        import pexpect
+
+        while True:
+            with self.changed:
+                self.reads += 1
+                read = self.reads
+            try:
+                data = self.server.read_nonblocking(CHUNK_SIZE, timeout=IDLE_WAIT)
+            except pexpect.exceptions.TIMEOUT:
+                self._idle(read)
+                continue
+            except pexpect.exceptions.EOF:
+                self.closed = True
+                self._idle(read)
+                return
+            self.parser.feed(data)
+
+    def _idle(self, read: int) -> None:
+        with self.changed:
+            self.idle_read = read
+            self.changed.notify_all()
+
+    def settle(self, timeout: float = 0) -> None:
+        """Waits until what the server wrote before its last reply is printed, or timeout seconds"""
+        with self.changed:
+            # A read started once the reply is in finding nothing means everything before it was printed
+            started = self.reads
+            self.changed.wait_for(lambda: self.closed or self.idle_read > started, timeout or SETTLE_TIMEOUT)
@@ -0,0 +1,316 @@
+"""Pool of pre-booted godot servers.
+
+`gdrepl pool start` launches a manager in the background that keeps a number of
+idle godot servers listening, so `gdrepl run` can take one instead of waiting for
+the engine to boot. Taken servers are replaced asynchronously and idle servers
+older than the max idle age are recycled. The manager is controlled through a unix
+socket that takes one json request per connection.
+"""
+
+import contextlib
+import json
+import os
+import re
+import shlex
+import socket
+import stat
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from dataclasses import dataclass
+from dataclasses import field
+from pathlib import Path
+from typing import Any
+from typing import Optional
+
+from .constants import PORT
+from .find_godot import find_available_port
+from .find_godot import listening_port
+
+
+# The runtime dir is private to the user, the shared temp dir is only used without one
+POOL_SOCKET = (
+    Path(os.environ["XDG_RUNTIME_DIR"]) / "gdrepl"
+    if os.environ.get("XDG_RUNTIME_DIR")
+    else Path(tempfile.gettempdir()) / f"gdrepl-{os.getuid()}"
+) / "pool.sock"
+
+# How often the manager reaps exited servers and refills the pool, in seconds
+MAINTAIN_INTERVAL = 1.0
+
+
+@dataclass
+class PooledServer:
+    proc: subprocess.Popen
+    # 0 until a server on an ephemeral port reports the port it got
+    port: int
+    version: str = ""
+    # monotonic time the server started listening, 0 while it boots
+    ready_at: float = 0.0
+    # What the server reported on hello, empty for servers that don't speak the protocol
+    capabilities: list = field(default_factory=list)
+
+    @property
+    def age(self) -> float:
+        return time.monotonic() - self.ready_at if self.ready_at else 0.0
+
+    def info(self) -> dict:
+        return {
+            "port": self.port,
+            "pid": self.proc.pid,
+            "version": self.version,
+            "age": round(self.age, 1),
+            "capabilities": self.capabilities,
+        }
+
+
+def probe_capabilities(port: int) -> list:
+    """Capabilities a server reports on hello, empty when it doesn't answer it"""
+    from .client import client
+    from .client import websocket
+
+    try:
+        c = client(port=port)
+    except (OSError, SystemExit, websocket().WebSocketException):
+        return []
+    c.close()
+    return list(c.capabilities)
+
+
+def private_dir(path: Path, create: bool = False) -> bool:
+    """Whether path is a directory only this user can use, creating it first when asked.
+
+    Another user who made the directory could listen on the socket in it and hand out
+    servers they control.
+    """
+    if create:
+        with contextlib.suppress(FileExistsError):
+            path.mkdir(mode=0o700, parents=True)
+    try:
+        info = os.lstat(path)
+    except OSError:
+        return False
+    return stat.S_ISDIR(info.st_mode) and info.st_uid == os.getuid() and stat.S_IMODE(info.st_mode) == 0o700
+
+
+class ServerPool:
+    def __init__(
+        self,
+        command: str,
+        size: int,
+        max_idle_age: float,
+        socket_path: Path = POOL_SOCKET,
+        ephemeral_ports: bool = True,
+    ) -> None:
+        self.command = command
+        self.size = size
+        # Servers bind port 0 and report the port they got, godot 3 ones can't so ports are probed for them
+        self.ephemeral_ports = ephemeral_ports
+        # Seconds an idle server is kept before being replaced, 0 keeps them forever
+        self.max_idle_age = max_idle_age
+        self.socket_path = Path(socket_path)
+
+        self.idle: list[PooledServer] = []
+        self.booting: list[PooledServer] = []
+        # Servers handed out or being stopped, kept to be reaped and stopped with the pool
+        self.retired: list[PooledServer] = []
+        self.handed_out = 0
+        self.running = True
+        self.lock = threading.Lock()
+        self._next_port = PORT
+
+    def _reserve_port(self) -> int:
+        """Next free port not taken by a server that may still be booting"""
+        if self.ephemeral_ports:
+            return 0
+        with self.lock:
+            taken = {s.port for s in self.idle + self.booting + self.retired}
+            port = find_available_port(self._next_port)
+            while port in taken:
+                port = find_available_port(port + 1)
+            self._next_port = port + 1
+        return port
+
+    def spawn(self) -> None:
+        port = self._reserve_port()
+        proc = subprocess.Popen(
+            shlex.split(self.command),
+            env={**os.environ, "PORT": str(port)},
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            text=True,
+            start_new_session=True,
+        )
+        server = PooledServer(proc, port)
+        with self.lock:
+            self.booting.append(server)
+        threading.Thread(target=self._boot, args=(server,), daemon=True).start()
+
+    def _boot(self, server: PooledServer) -> None:
+        """Waits for the server to listen and keeps reading its output so it never blocks"""
+        assert server.proc.stdout is not None
+        for line in server.proc.stdout:
+            match = re.match(r".*Godot Engine (\S+) ", line)
+            if match:
+                server.version = match.group(1)
+            port = listening_port(line)
+            if port is not None:
+                server.capabilities = probe_capabilities(port)
+                with self.lock:
+                    server.port = port
+                    if server in self.booting:
+                        self.booting.remove(server)
+                        server.ready_at = time.monotonic()
+                        self.idle.append(server)
+                break
+        else:
+            with self.lock:
+                if server in self.booting:
+                    self.booting.remove(server)
+            return
+
+        for _ in server.proc.stdout:
+            pass
+
+    def maintain(self) -> None:
+        """Reaps exited servers, recycles old idle ones and boots new ones to fill the pool"""
+        with self.lock:
+            self.retired = [s for s in self.retired if s.proc.poll() is None]
+            self.idle = [s for s in self.idle if s.proc.poll() is None]
+            stale = [s for s in self.idle if self.max_idle_age and s.age > self.max_idle_age]
+            for server in stale:
+                self.idle.remove(server)
+                self.retired.append(server)
+            missing = self.size - len(self.idle) - len(self.booting) if self.running else 0
+
+        for server in stale:
+            server.proc.terminate()
+        for _ in range(missing):
+            self.spawn()
+
+    def acquire(self) -> Optional[dict]:
+        """Hands out the idle server that booted first and boots its replacement.
+
+        Only servers that stream their output are handed out, the output of the others is
+        printed to a terminal that only the process that launched them can read.
+        """
+        with self.lock:
+            ready = [s for s in self.idle if "output" in s.capabilities]
+            if not ready:
+                return None
+            server = ready[0]
+            self.idle.remove(server)
+            self.retired.append(server)
+            self.handed_out += 1
+        if self.running:
+            self.spawn()
+        return server.info()
+
+    def status(self) -> dict:
+        with self.lock:
+            return {
+                "command": self.command,
+                "size": self.size,
+                "max_idle_age": self.max_idle_age,
+                "idle": [s.info() for s in self.idle],
+                "booting": len(self.booting),
+                "handed_out": self.handed_out,
+            }
+
+    def stop(self) -> None:
+        with self.lock:
+            self.running = False
+            servers = self.idle + self.booting + self.retired
+            self.idle, self.booting, self.retired = [], [], []
+        for server in servers:
+            server.proc.terminate()
+
+    def handle(self, request: dict) -> dict:
+        op = request.get("op")
+        if op == "acquire":
+            server = self.acquire()
+            return server if server else {"error": "No idle server in the pool"}
+        if op == "status":
+            return self.status()
+        if op == "stop":
+            self.stop()
+            return {"stopped": True}
+        return {"error": f"Unknown op: {op}"}
+
+    def serve(self) -> None:
+        """Runs the pool manager until it is stopped"""
+        if not private_dir(self.socket_path.parent, create=True):
+            raise PermissionError(f"{self.socket_path.parent} isn't a directory only this user can use")
+        if self.socket_path.exists():
+            self.socket_path.unlink()
+
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(str(self.socket_path))
+        sock.listen()
+        sock.settimeout(MAINTAIN_INTERVAL)
+        try:
+            while self.running:
+                self.maintain()
+                try:
+                    conn, _ = sock.accept()
+                except socket.timeout:
+                    continue
+                with conn:
+                    try:
+                        request = json.loads(conn.makefile().readline() or "{}")
+                        conn.sendall((json.dumps(self.handle(request)) + "\n").encode())
+                    except (OSError, ValueError):
+                        pass
+        finally:
+            self.stop()
+            sock.close()
+            self.socket_path.unlink(missing_ok=True)
+
+
+def pool_request(op: str, socket_path: Path = POOL_SOCKET, timeout: float = 2.0) -> Optional[dict[str, Any]]:
+    """Sends a request to the pool manager, None if it isn't running"""
+    if not private_dir(Path(socket_path).parent) or not Path(socket_path).exists():
+        return None
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(timeout)
+            sock.connect(str(socket_path))
+            sock.sendall((json.dumps({"op": op}) + "\n").encode())
+            reply: dict[str, Any] = json.loads(sock.makefile().readline())
+            return reply
+    except (OSError, ValueError):
+        return None
+
+
+def acquire() -> Optional[dict]:
+    """Takes a pre-booted server from the pool, None if there is none"""
+    reply = pool_request("acquire")
+    if not reply or "error" in reply:
+        return None
+    return reply
+
+
+def start_manager(godot: str, size: int, max_idle_age: float) -> None:
+    """Launches the pool manager detached from this process"""
+    subprocess.Popen(
+        [
+            sys.executable,
+            "-m",
+            "gdrepl",
+            "pool",
+            "serve",
+            "--godot",
+            godot,
+            "--size",
+            str(size),
+            "--max-idle-age",
+            str(max_idle_age),
+        ],
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        start_new_session=True,
+    )
@@ -0,0 +1,259 @@
+"""The interactive prompt, only imported by the commands that open one since prompt_toolkit is slow to load"""
+
+import os
+from dataclasses import dataclass
+
+from prompt_toolkit.application.current import get_app
+from prompt_toolkit.auto_suggest import AutoSuggestFromHistory
+from prompt_toolkit.completion import Completer
+from prompt_toolkit.completion import Completion
+from prompt_toolkit.completion import WordCompleter
+from prompt_toolkit.cursor_shapes import ModalCursorShapeConfig
+from prompt_toolkit.document import Document
+from prompt_toolkit.enums import EditingMode
+from prompt_toolkit.lexers import PygmentsLexer
+from prompt_toolkit.shortcuts import PromptSession
+from pygments.lexers.gdscript import GDScriptLexer
+
+from .commands import COMMANDS
+from .commands import Command
+from .config import ConfigManager
+from .constants import KEYWORDS
+from .constants import TIMEOUT
+from .history import IndexedAutoSuggest
+from .history import RotatingFileHistory
+from .keybindings import REPLKeyBindings
+from .output import TerminalOutput
+from .styles import REPLStyles
+from .symbols import MEMBER_ACCESS
+from .symbols import BackgroundIndex
+from .symbols import SessionSymbols
+from .ui import ToolbarStyler
+
+
+@dataclass
+class PromptOptions:
+    vi: bool = False
+    timeout: int = TIMEOUT
+    # Godot executable whose api is completed
+    godot: str = ""
+
+
+class CustomCompleter(Completer):
+    """Auto completion and commands"""
+
+    def __init__(self, api=None, session=None):
+        # Add ! prefix to all commands for IPython-style completion
+        command_list = ["!" + cmd for cmd in COMMANDS]
+        self.word_completer = WordCompleter(KEYWORDS + command_list, WORD=True)
+        # BackgroundIndex of the engine api, its index is None until it is loaded
+        self.api = api
+        # SessionSymbols with the names defined in the repl session
+        self.session = session
+        self.document = None
+        self.iterator = None
+
+    def _code_completions(self, document, complete_event):
+        text = document.text_before_cursor
+        # Keywords and commands make no sense after a dot
+        if not MEMBER_ACCESS.search(text):
+            yield from self.word_completer.get_completions(document, complete_event)
+
+            word = document.get_word_before_cursor()
+            if self.session and word:
+                for name in self.session.complete(word):
+                    yield Completion(name, start_position=-len(word), display_meta=self.session.names.get(name, ""))
+
+        index = self.api.index if self.api else None
+        if index is None:
+            return
+        prefix, names, class_name = index.complete_text(text)
+        for name in names:
+            yield Completion(name, start_position=-len(prefix), display_meta=index.describe(class_name, name))
+
+    def _create_iterator(self, completer, document, complete_event):
+        self.iterator = completer.get_completions(document, complete_event)
+
+    def get_completions(self, document, complete_event):
+        # Don't complete at start of line (allow literal tabs for indentation)
+        if document.cursor_position == 0 or document.text_before_cursor.isspace():
+            return
+
+        # Only complete after 1st character of last word
+        if len(document.text_before_cursor.split(" ")[-1]) < 1:
+            return
+
+        cmd = document.text.split()[0] if document.text.strip() else ""
+        # Handle IPython-style commands with ! prefix
+        cmd_name = cmd[1:] if cmd.startswith("!") else cmd
+
+        if cmd_name in COMMANDS and len(document.text_before_cursor.strip()) > len(cmd):
+            sub_doc = Document(document.text[len(cmd) + 1 :])
+            self._create_iterator(COMMANDS[cmd_name].completer, sub_doc, complete_event)
+
+        elif document != self.document:
+            self.document = document
+            self.iterator = self._code_completions(document, complete_event)
+
+        if self.iterator:
+            yield from self.iterator
+
+
+def drain_output(server):
+    """Keeps reading what godot writes to the terminal so it never blocks on a full pty.
+    The output itself already comes through the websocket."""
+    import pexpect
+
+    try:
+        while True:
+            server.read_nonblocking(65536, timeout=None)
+    except pexpect.exceptions.EOF:
+        pass
+
+
+def repl_loop(client, options: PromptOptions, server=None):
+    config_manager = ConfigManager()
+    config = config_manager.config
+
+    history = RotatingFileHistory(
+        os.path.expanduser(config.history_file),
+        max_entries=config.max_history,
+        backup_count=config.backup_count,
+        indexed=config.history_index,
+    )
+
+    key_bindings = REPLKeyBindings(config).bindings
+    auto_suggest = None
+    if config.auto_suggest:
+        auto_suggest = IndexedAutoSuggest(history) if config.history_index else AutoSuggestFromHistory()
+
+    style = getattr(REPLStyles, config.toolbar_style.upper(), REPLStyles.COLORFUL)
+
+    def get_toolbar():
+        app = get_app()
+        if app.editing_mode == EditingMode.VI:
+            # Get Vi mode status (insert, navigation, replace)
+            vi_mode = app.vi_state.input_mode.name.lower()
+            mode = f"Vi [{vi_mode}]"
+        else:
+            mode = "Emacs"
+        toolbar_func = getattr(ToolbarStyler, config.toolbar_style, ToolbarStyler.colorful)
+        return toolbar_func(mode)
+
+    # Fill out our auto completion with server commands as well
+    for cmd, help in client.server_commands().items():
+        # Let us override the server commands help message
+        if cmd in COMMANDS:
+            continue
+        COMMANDS[cmd] = Command(help=help, send_to_server=True)
+
+    # Configure cursor shapes for Vi mode: beam in insert, block in normal, underline in replace
+    cursor_shape_config = ModalCursorShapeConfig()
+
+    # The api of the engine is indexed in the background, completion works without it meanwhile
+    api = BackgroundIndex(options.godot) if options.godot else None
+    session_symbols = SessionSymbols(lambda: type(client)(client.host, client.port, client.session))
+
+    # Note: Tab completion is disabled to allow manual indentation with Tab key, Ctrl-Space completes
+    session: PromptSession[str] = PromptSession(
+        history=history,
+        key_bindings=key_bindings,
+        auto_suggest=auto_suggest,
+        bottom_toolbar=get_toolbar,
+        lexer=PygmentsLexer(GDScriptLexer),
+        completer=CustomCompleter(api, session_symbols),
+        complete_while_typing=False,
+        style=style,
+        cursor=cursor_shape_config,
+        editing_mode=EditingMode.VI if options.vi else EditingMode.EMACS,
+    )
+
+    # Servers that don't stream the output print it to their terminal
+    output = TerminalOutput(server) if server is not None else None
+
+    multiline_buffer = ""
+    multiline = False
+    while True:
+        # Refetches the names of the session in the background if the last request changed them
+        session_symbols.update(client.generation, client.session)
+        try:
+            # Use simple prompts - don't auto-insert indentation as it causes display issues
+            cmd = session.prompt("... ") if multiline else session.prompt(">>> ")
+        except KeyboardInterrupt:
+            multiline = False
+            multiline_buffer = ""
+            continue
+        except EOFError:
+            try:
+                confirm = input("\nAre you sure you want to quit? (y/n): ").strip().lower()
+                if confirm in ["y", "yes"]:
+                    client.close()
+                    break
+                else:
+                    print("Continuing...")
+                    continue
+            except (EOFError, KeyboardInterrupt):
+                client.close()
+                break
+
+        # Handle empty line - execute multiline buffer or skip
+        if len(cmd.strip()) == 0:
+            if not multiline:
+                continue
+            # Empty line in multiline mode - execute the buffer
+            multiline = False
+            # Force execution (semicolon terminates statement in GDScript)
+            # Note: Tab key inserts spaces, but normalize any literal tabs just in case
+            buffer_to_send = multiline_buffer.replace("\t", "    ") + ";"
+            resp = client.send(buffer_to_send)
+            multiline_buffer = ""
+            if resp:
+                print(resp)
+            if output is not None:
+                output.settle(options.timeout)
+            continue
+
+        if cmd.strip() in ["!quit", "!exit"]:
+            client.send(cmd, False)
+            client.close()
+            break
+
+        # Handle commands with ! prefix (IPython-style)
+        if not multiline and cmd.strip().startswith("!"):
+            cmd_name = cmd.strip()[1:].split()[0] if len(cmd.strip()) > 1 else ""
+            if cmd_name in COMMANDS:
+                command = COMMANDS[cmd_name]
+                command.do(client, cmd.strip()[1:].split()[1:])
+                if command.send_to_server:
+                    # Send to server without the ! prefix
+                    resp = client.send(cmd.strip()[1:])
+                    if resp:
+                        print(resp)
+                continue
+            else:
+                print(f"Error: Unknown command '!{cmd_name}'. Type '!help' for available commands.")
+                continue
+
+        # Switch to multiline until return is pressed twice
+        if cmd.strip().endswith(":"):
+            multiline = True
+
+        multiline_buffer += cmd
+        if multiline:
+            multiline_buffer += "\n"
+            continue
+
+        resp = client.send(multiline_buffer)
+        multiline_buffer = ""
+
+        if resp:
+            print(resp)
+
+        if output is not None:
+            output.settle(options.timeout)
+
+    session_symbols.close()
+
+
+def start_message():
+    pass
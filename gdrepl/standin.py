@@ -0,0 +1,440 @@
+"""Stand-in for the godot server that speaks its websocket protocol without godot.
+
+It answers the plain text and the json protocols like gdserverv4.gd, with sessions,
+output frames and the server commands, but it doesn't run gdscript: only integer and
+float arithmetic, strings, `var` and `print` are understood, anything else is kept in
+the session and evaluates to nothing. It is meant to measure and test the client side,
+where the time goes between sending a request and showing its reply, in benchmarks and
+CI where there is no engine.
+
+    with StandinServer() as server:
+        c = client(port=server.port)
+"""
+
+import ast
+import base64
+import contextlib
+import copy
+import hashlib
+import json
+import operator
+import os
+import socket
+import struct
+import threading
+import uuid
+from collections.abc import Callable
+from typing import Any
+from typing import Optional
+
+from .constants import PROTOCOL_VERSION
+
+
+GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+OP_CONTINUATION = 0x0
+OP_TEXT = 0x1
+OP_BINARY = 0x2
+OP_CLOSE = 0x8
+OP_PING = 0x9
+OP_PONG = 0xA
+
+COMMANDS = {
+    "reset": "clears the script buffer for the current session",
+    "script_local": "Sends back the generated local",
+    "script_global": "Sends back the generated global",
+    "script_code": "Sends back the last generated runtime script code",
+    "dellocal": "Deletes the entire local scope",
+    "delglobal": "Deletes the entire global scope",
+    "stats": "Shows the compiled script cache and session statistics",
+    "symbols": "Lists the names defined in the current session",
+    "checkpoint": "Saves the current session under a name, lists the saved ones without it",
+    "restore": "Brings the current session back to a checkpoint",
+    "fork": "Copies the current session into a new session with the given name",
+    "quit": "stops this server",
+}
+# Commands followed by an argument, the others are only commands on their own
+ARGUMENT_COMMANDS = ("checkpoint", "restore", "fork")
+CAPABILITIES = ["eval", "load", "output", "sessions"]
+
+OPERATORS: dict[type, Callable[..., Any]] = {
+    ast.Add: operator.add,
+    ast.Sub: operator.sub,
+    ast.Mult: operator.mul,
+    ast.Div: operator.truediv,
+    ast.Mod: operator.mod,
+    ast.USub: operator.neg,
+    ast.UAdd: operator.pos,
+}
+# Words that start the global scope of a script
+GLOBAL_KEYWORDS = ("func", "static", "class", "class_name", "extends", "signal", "enum", "const", "@")
+
+
+class Session:
+    def __init__(self) -> None:
+        self.global_scope: list[str] = []
+        self.local: list[str] = []
+        self.values: dict[str, Any] = {}
+        self.last_code = ""
+        self.generation = 0
+
+    def symbols(self) -> str:
+        names = [f"var {name}" for name in self.values]
+        for line in self.global_scope:
+            words = line.split()
+            if len(words) > 1 and words[0] in ("func", "class", "const", "signal", "enum"):
+                names.append(f"{words[0]} {words[1].split('(')[0].rstrip(':')}")
+        return "\n".join(names)
+
+
+def gdscript_str(value: Any) -> str:
+    """Value as godot prints it"""
+    if isinstance(value, bool):
+        return str(value).lower()
+    if value is None:
+        return "<null>"
+    return str(value)
+
+
+def evaluate(expression: str, values: dict[str, Any]) -> Any:
+    """Value of a literal, arithmetic or name expression, ValueError for anything else"""
+
+    def visit(node: ast.AST) -> Any:
+        if isinstance(node, ast.Constant):
+            return node.value
+        if isinstance(node, ast.Name):
+            if node.id in ("true", "false", "null"):
+                return {"true": True, "false": False, "null": None}[node.id]
+            if node.id in values:
+                return values[node.id]
+        elif isinstance(node, ast.BinOp) and type(node.op) in OPERATORS:
+            left, right = visit(node.left), visit(node.right)
+            # Integer division truncates in gdscript
+            if isinstance(node.op, ast.Div) and isinstance(left, int) and isinstance(right, int):
+                return int(left / right)
+            return OPERATORS[type(node.op)](left, right)
+        elif isinstance(node, ast.UnaryOp) and type(node.op) in OPERATORS:
+            return OPERATORS[type(node.op)](visit(node.operand))
+        raise ValueError(ast.dump(node))
+
+    try:
+        return visit(ast.parse(expression.strip(), mode="eval").body)
+    except (SyntaxError, ArithmeticError, TypeError) as e:
+        raise ValueError(expression) from e
+
+
+class Connection:
+    """A websocket client of the stand-in, served by a thread of its own"""
+
+    def __init__(self, server: "StandinServer", sock: socket.socket) -> None:
+        self.server = server
+        self.sock = sock
+        self.file = sock.makefile("rb")
+        self.session = server.default_session
+        self.lock = threading.Lock()
+
+    def handshake(self) -> bool:
+        key = None
+        for line in iter(self.file.readline, b""):
+            if line in (b"\r\n", b"\n"):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            if name.strip().lower() == "sec-websocket-key":
+                key = value.strip()
+        if key is None:
+            return False
+        accept = base64.b64encode(hashlib.sha1((key + GUID).encode()).digest()).decode()
+        self.sock.sendall(
+            (
+                "HTTP/1.1 101 Switching Protocols\r\n"
+                "Upgrade: websocket\r\n"
+                "Connection: Upgrade\r\n"
+                f"Sec-WebSocket-Accept: {accept}\r\n\r\n"
+            ).encode()
+        )
+        return True
+
+    def _read(self, size: int) -> bytes:
+        data = self.file.read(size)
+        if len(data) < size:
+            raise ConnectionError("Closed")
+        return data
+
+    def receive(self) -> Optional[str]:
+        """Next message, None once the client closed the connection"""
+        message = b""
+        while True:
+            first, second = self._read(2)
+            opcode, size = first & 0x0F, second & 0x7F
+            if size == 126:
+                size = struct.unpack("!H", self._read(2))[0]
+            elif size == 127:
+                size = struct.unpack("!Q", self._read(8))[0]
+            mask = self._read(4) if second & 0x80 else None
+            payload = self._read(size)
+            if mask is not None:
+                # Unmask the whole payload at once instead of byte by byte
+                key = int.from_bytes((mask * (size // 4 + 1))[:size], "big")
+                payload = (int.from_bytes(payload, "big") ^ key).to_bytes(size, "big")
+
+            if opcode == OP_CLOSE:
+                self.send_frame(OP_CLOSE, payload[:2])
+                return None
+            if opcode == OP_PING:
+                self.send_frame(OP_PONG, payload)
+                continue
+            if opcode in (OP_TEXT, OP_BINARY, OP_CONTINUATION):
+                message += payload
+                if first & 0x80:
+                    return message.decode("utf-8", errors="replace")
+
+    def send_frame(self, opcode: int, payload: bytes) -> None:
+        size = len(payload)
+        if size < 126:
+            header = struct.pack("!BB", 0x80 | opcode, size)
+        elif size < 1 << 16:
+            header = struct.pack("!BBH", 0x80 | opcode, 126, size)
+        else:
+            header = struct.pack("!BBQ", 0x80 | opcode, 127, size)
+        with self.lock:
+            self.sock.sendall(header + payload)
+
+    def send(self, message: str) -> None:
+        self.send_frame(OP_TEXT, message.encode())
+
+    def serve(self) -> None:
+        try:
+            if not self.handshake():
+                return
+            while (message := self.receive()) is not None:
+                self.server.handled += 1
+                self.on_message(message)
+        except OSError:
+            pass
+        finally:
+            self.file.close()
+            self.sock.close()
+            self.server.connections.discard(self)
+
+    def on_message(self, message: str) -> None:
+        request = None
+        if message.startswith("{"):
+            with contextlib.suppress(ValueError):
+                request = json.loads(message)
+        if not isinstance(request, dict) or "op" not in request:
+            self.plain_text(message)
+            return
+
+        request_id = request.get("id")
+        op = request["op"]
+        if op == "hello":
+            reply = self.hello(request.get("session"))
+        elif op == "eval":
+            code = str(request.get("code", ""))
+            reply = self.server.handle(code, self.session, self.output(request), bool(request.get("commands", True)))
+        elif op == "load":
+            reply = self.server.load(str(request.get("code", "")), self.session)
+        else:
+            reply = {"type": "error", "error": f"Unknown op: {op}"}
+
+        if reply["type"] == "quit":
+            return
+        if op != "hello" and self.session in self.server.sessions:
+            reply["generation"] = self.server.sessions[self.session].generation
+        self.send(json.dumps({**reply, "v": PROTOCOL_VERSION, "id": request_id}))
+
+    def output(self, request: dict) -> Any:
+        """Writer of the output of request, as frames or into its result"""
+        request_id = request.get("id")
+
+        def write(text: str) -> None:
+            frame = {"v": PROTOCOL_VERSION, "id": request_id, "type": "output", "stream": "stdout", "text": text}
+            self.send(json.dumps(frame))
+
+        return write if request.get("stream", True) else None
+
+    def hello(self, requested: Optional[str]) -> dict:
+        if requested is not None:
+            self.session = requested or uuid.uuid4().hex[:16]
+        session = self.server.sessions.setdefault(self.session, Session())
+        return {
+            "type": "hello",
+            "version": PROTOCOL_VERSION,
+            "engine": "standin",
+            "capabilities": CAPABILITIES,
+            "commands": COMMANDS,
+            "session": self.session,
+            "generation": session.generation,
+        }
+
+    def plain_text(self, message: str) -> None:
+        reply = self.server.handle(message, self.session, None)
+        if reply["type"] == "command":
+            self.send(reply["output"] or "-")
+        elif reply["type"] == "result":
+            self.send(">> Err: " + str(reply["error_code"]) if reply["error_code"] else ">> " + reply["result"])
+
+
+class StandinServer:
+    """Websocket server answering like the godot one, every connection in a thread.
+
+    latency adds that many seconds to every evaluation, like a slow script would.
+    """
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, latency: float = 0.0) -> None:
+        self.latency = latency
+        self.default_session = "main"
+        self.sessions: dict[str, Session] = {}
+        self.checkpoints: dict[str, dict[str, Session]] = {}
+        self.connections: set[Connection] = set()
+        self.handled = 0
+        self.sock = socket.create_server((host, port))
+        self.port = self.sock.getsockname()[1]
+        self.thread = threading.Thread(target=self._accept, daemon=True)
+        self.stopped = threading.Event()
+
+    def __enter__(self) -> "StandinServer":
+        return self.start()
+
+    def __exit__(self, *exc: object) -> None:
+        self.close()
+
+    def start(self) -> "StandinServer":
+        self.thread.start()
+        return self
+
+    def serve_forever(self) -> None:
+        self.start()
+        self.stopped.wait()
+        self.close()
+
+    def close(self) -> None:
+        self.stopped.set()
+        # Shutting down wakes up the accept and the reads blocked on the sockets
+        for sock in [self.sock] + [c.sock for c in list(self.connections)]:
+            with contextlib.suppress(OSError):
+                sock.shutdown(socket.SHUT_RDWR)
+            sock.close()
+
+    def _accept(self) -> None:
+        while not self.stopped.is_set():
+            try:
+                sock, _ = self.sock.accept()
+            except OSError:
+                return
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            connection = Connection(self, sock)
+            self.connections.add(connection)
+            threading.Thread(target=connection.serve, daemon=True).start()
+
+    def session(self, name: str) -> Session:
+        return self.sessions.setdefault(name, Session())
+
+    def handle(self, message: str, name: str, write: Any, commands: bool = True) -> dict:
+        """Runs a server command or evaluates message, writing what it prints with write"""
+        cmd, _, argument = message.strip().partition(" ")
+        cmd, argument = cmd.lower(), argument.strip()
+        s = self.session(name)
+        if not commands:
+            return self.run(message, s, write)
+        if cmd == "quit":
+            self.stopped.set()
+            return {"type": "quit"}
+        if cmd in ARGUMENT_COMMANDS or ((cmd == "help" or cmd in COMMANDS) and not argument):
+            output = ""
+            if cmd == "help":
+                output = "GDREPL Server Help\n" + "".join(f"{c}: {h}\n" for c, h in COMMANDS.items()) + "\n"
+            elif cmd == "reset":
+                self.sessions.pop(name, None)
+                output = "Cleared"
+            elif cmd == "script_local":
+                output = "\n".join(s.local)
+            elif cmd == "script_global":
+                output = "\n".join(s.global_scope)
+            elif cmd == "script_code":
+                output = s.last_code
+            elif cmd == "dellocal":
+                s.local, s.values = [], {}
+                s.generation += 1
+            elif cmd == "delglobal":
+                s.global_scope = []
+                s.generation += 1
+            elif cmd == "stats":
+                output = f"Sessions: {len(self.sessions)}, {len(self.connections)} connections"
+            elif cmd == "symbols":
+                output = s.symbols()
+            elif cmd == "checkpoint":
+                saved = self.checkpoints.setdefault(name, {})
+                if argument:
+                    saved[argument] = copy.deepcopy(s)
+                output = f"Saved checkpoint {argument}" if argument else "\n".join(saved)
+            elif cmd == "restore":
+                if argument not in self.checkpoints.get(name, {}):
+                    output = f"Error: No checkpoint named '{argument}'"
+                else:
+                    self.sessions[name] = copy.deepcopy(self.checkpoints[name][argument])
+                    self.sessions[name].generation += 1
+                    output = f"Restored checkpoint {argument}"
+            elif cmd == "fork":
+                if (":" in name or ":" in argument) and argument != name:
+                    output = f"Error: Session '{name}' can't fork into '{argument}'"
+                elif not argument or argument in self.sessions:
+                    output = f"Error: Session '{argument}' already exists" if argument else "Error: No name given"
+                else:
+                    self.sessions[argument] = copy.deepcopy(s)
+                    output = f"Forked into {argument}"
+            return {"type": "command", "command": cmd, "output": output}
+        return self.run(message, s, write)
+
+    def run(self, code: str, s: Session, write: Any) -> dict:
+        if self.latency:
+            self.stopped.wait(self.latency)
+        result = {"type": "result", "result": "", "error": "", "error_code": 0, "stdout": "", "time_us": 0}
+        lines = [line for line in code.split("\n") if line.strip()]
+        if lines and lines[0].split()[0] in GLOBAL_KEYWORDS:
+            s.global_scope += lines
+            s.generation += 1
+            return result
+
+        stdout = []
+        for i, line in enumerate(lines):
+            stripped = line.strip()
+            try:
+                if stripped.startswith("var "):
+                    name, _, expression = stripped[4:].partition("=")
+                    name = name.split(":")[0].strip()
+                    s.values[name] = evaluate(expression, s.values) if expression.strip() else None
+                    s.generation += 1
+                elif stripped.startswith("print(") and stripped.endswith(")"):
+                    stdout.append(gdscript_str(evaluate(stripped[6:-1], s.values)) + "\n")
+                elif i == len(lines) - 1:
+                    result["result"] = gdscript_str(evaluate(stripped, s.values))
+            except ValueError:
+                # Whatever isn't understood is kept as it is, like code that returns nothing
+                pass
+        s.local += lines
+        s.last_code = code
+
+        if write is None:
+            result["stdout"] = "".join(stdout)
+        else:
+            for text in stdout:
+                write(text)
+        return result
+
+    def load(self, code: str, name: str) -> dict:
+        s = self.session(name)
+        s.global_scope += [line for line in code.split("\n") if line.strip()]
+        s.generation += 1
+        return {"type": "result", "result": "", "error": "", "error_code": 0, "stdout": "", "time_us": 0}
+
+
+def main() -> None:
+    """Runs a stand-in server on PORT until it gets quit"""
+    server = StandinServer(port=int(os.environ.get("PORT", 0)))
+    print(f"Gdrepl Listening on {server.port}", flush=True)
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,341 @@
+"""Index of the engine's API for completion.
+
+The index is built from the json godot writes with `--dump-extension-api` and cached
+on disk per engine version, so the engine is only asked once. Names are kept in sorted
+arrays and completed with bisect, which keeps completion over tens of thousands of
+symbols instant.
+"""
+
+import json
+import os
+import re
+import shlex
+import subprocess
+import tempfile
+import threading
+from bisect import bisect_left
+from collections.abc import Callable
+from pathlib import Path
+from typing import Any
+from typing import Optional
+
+from .client import websocket
+from .find_godot import cache_file
+from .find_godot import godot_version
+
+
+# Trailing member access like `Node.new().get_child(0).na`: the receiver, then the name being typed
+MEMBER_ACCESS = re.compile(r"((?:[A-Za-z_]\w*(?:\([^()]*\))?\.)*[A-Za-z_]\w*(?:\([^()]*\))?)\.(\w*)$")
+SEGMENT = re.compile(r"([A-Za-z_]\w*)(\(.*\))?$")
+
+# Seconds to wait for the session to settle before asking the server for its names
+DEBOUNCE = 0.3
+
+
+def complete_prefix(names: list[str], prefix: str) -> list[str]:
+    """Names of the sorted list starting with prefix"""
+    # They all sort between prefix and prefix followed by the last code point
+    return names[bisect_left(names, prefix) : bisect_left(names, prefix + "\U0010ffff")]
+
+
+def api_file(version: str) -> Path:
+    return cache_file().parent / "api" / f"{version}.json"
+
+
+def member_type(type_name: str) -> str:
+    """Class a member evaluates to from how the api writes its type, typed arrays are Arrays"""
+    if type_name.startswith("typedarray::"):
+        return "Array"
+    # enum::Error and bitfield::Flags are ints
+    if type_name.startswith(("enum::", "bitfield::")):
+        return "int"
+    return type_name
+
+
+def parse_api(api: dict) -> dict:
+    """Turns an extension api dump into the index cached on disk.
+
+    Globals map to what they are, classes to their parent and members, members to a
+    (kind, type) pair where type is the class the member evaluates to or "".
+    """
+    globals_: dict[str, str] = {}
+    classes: dict[str, dict[str, Any]] = {}
+
+    for constant in api.get("global_constants", []):
+        globals_[constant["name"]] = "constant"
+    for enum in api.get("global_enums", []):
+        for value in enum.get("values", []):
+            globals_[value["name"]] = "constant"
+    for function in api.get("utility_functions", []):
+        globals_[function["name"]] = "function"
+
+    for kind, entries in (("builtin", api.get("builtin_classes", [])), ("class", api.get("classes", []))):
+        for entry in entries:
+            members: dict[str, list[str]] = {}
+            for method in entry.get("methods", []):
+                if method.get("is_virtual"):
+                    continue
+                returns = method.get("return_type") or method.get("return_value", {}).get("type", "")
+                members[method["name"]] = ["method", member_type(returns)]
+            for prop in entry.get("properties", []) + entry.get("members", []):
+                members[prop["name"]] = ["property", member_type(prop.get("type", ""))]
+            for constant in entry.get("constants", []):
+                members[constant["name"]] = ["constant", member_type(constant.get("type", "int"))]
+            for enum in entry.get("enums", []):
+                members[enum["name"]] = ["enum", ""]
+                for value in enum.get("values", []):
+                    members[value["name"]] = ["constant", "int"]
+            for signal in entry.get("signals", []):
+                members[signal["name"]] = ["signal", "Signal"]
+            # new() is looked up on the class itself, it can't be inherited from an instantiable parent
+            instantiable = kind == "class" and entry.get("is_instantiable", True)
+            classes[entry["name"]] = {
+                "inherits": entry.get("inherits", ""),
+                "members": members,
+                "instantiable": instantiable,
+            }
+            globals_[entry["name"]] = kind
+
+    singletons = {}
+    for singleton in api.get("singletons", []):
+        globals_[singleton["name"]] = "singleton"
+        singletons[singleton["name"]] = singleton["type"]
+
+    return {"globals": globals_, "classes": classes, "singletons": singletons}
+
+
+class SymbolIndex:
+    def __init__(self, index: dict) -> None:
+        self.globals: dict[str, str] = index.get("globals", {})
+        self.classes: dict[str, dict[str, Any]] = index.get("classes", {})
+        self.singletons: dict[str, str] = index.get("singletons", {})
+        self.names = sorted(self.globals)
+        # Sorted member names of each class with the inherited ones, built when first completed
+        self._members: dict[str, list[str]] = {}
+
+    def __len__(self) -> int:
+        return len(self.names) + sum(len(c["members"]) for c in self.classes.values())
+
+    def complete(self, prefix: str) -> list[str]:
+        """Global names starting with prefix"""
+        return complete_prefix(self.names, prefix)
+
+    def member(self, class_name: str, name: str) -> Optional[list[str]]:
+        """(kind, type) of a member of class_name or of one of its parents"""
+        if name == "new":
+            return ["method", class_name] if self.classes.get(class_name, {}).get("instantiable") else None
+        while class_name in self.classes:
+            found = self.classes[class_name]["members"].get(name)
+            if found:
+                return list(found)
+            class_name = self.classes[class_name]["inherits"]
+        return None
+
+    def members(self, class_name: str) -> list[str]:
+        if class_name not in self._members:
+            names: set[str] = set()
+            parent = class_name
+            while parent in self.classes:
+                names.update(self.classes[parent]["members"])
+                parent = self.classes[parent]["inherits"]
+            if self.classes.get(class_name, {}).get("instantiable"):
+                names.add("new")
+            self._members[class_name] = sorted(names)
+        return self._members[class_name]
+
+    def complete_member(self, class_name: str, prefix: str) -> list[str]:
+        """Members of class_name, inherited ones included, starting with prefix"""
+        return complete_prefix(self.members(class_name), prefix)
+
+    def resolve(self, expression: str) -> Optional[str]:
+        """Class an expression like `Node.new().get_parent()` evaluates to, None when it is unknown"""
+        class_name = None
+        for i, segment in enumerate(expression.split(".")):
+            match = SEGMENT.match(segment)
+            if not match:
+                return None
+            name = match.group(1)
+            if i == 0:
+                class_name = self.singletons.get(name, name if name in self.classes else None)
+            else:
+                found = self.member(class_name, name) if class_name else None
+                class_name = found[1] if found and found[1] in self.classes else None
+            if class_name is None:
+                return None
+        return class_name
+
+    def complete_text(self, text: str) -> tuple[str, list[str], Optional[str]]:
+        """Completions for the end of text: the prefix being completed, the names and the class of the receiver"""
+        access = MEMBER_ACCESS.search(text)
+        if access:
+            class_name = self.resolve(access.group(1))
+            if class_name is None:
+                return access.group(2), [], None
+            return access.group(2), self.complete_member(class_name, access.group(2)), class_name
+
+        word = re.search(r"\w*$", text)
+        prefix = word.group(0) if word else ""
+        return prefix, self.complete(prefix) if prefix else [], None
+
+    def describe(self, class_name: Optional[str], name: str) -> str:
+        """What a completion is, shown next to it"""
+        if class_name is None:
+            return self.globals.get(name, "")
+        found = self.member(class_name, name)
+        if not found:
+            return ""
+        kind, type_name = found
+        return f"{kind} -> {type_name}" if kind == "method" and type_name else kind
+
+
+def dump_api(godot: str) -> dict:
+    """Asks godot for its api, it writes it to extension_api.json in its working directory"""
+    with tempfile.TemporaryDirectory() as temp_dir:
+        subprocess.run(
+            [*shlex.split(godot), "--headless", "--dump-extension-api"],
+            cwd=temp_dir,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            timeout=120,
+            check=False,
+        )
+        with open(Path(temp_dir) / "extension_api.json") as f:
+            api: dict = json.load(f)
+            return api
+
+
+def load_index(godot: str) -> Optional[SymbolIndex]:
+    """Index for the api of godot, cached per engine version. None if it can't be built"""
+    version = godot_version(godot) if godot else ""
+    # Godot 3 can't dump its api
+    if not version or version.startswith(("2.", "3.")):
+        return None
+
+    path = api_file(version)
+    try:
+        with open(path) as f:
+            return SymbolIndex(json.load(f))
+    except (OSError, ValueError):
+        pass
+
+    try:
+        index = parse_api(dump_api(godot))
+    except (OSError, ValueError, subprocess.TimeoutExpired):
+        return None
+
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_suffix(f".{os.getpid()}.tmp")
+        with open(tmp, "w") as f:
+            json.dump(index, f)
+        os.replace(tmp, path)
+    except OSError:
+        pass
+    return SymbolIndex(index)
+
+
+class BackgroundIndex:
+    """Loads the index in a thread so the prompt doesn't wait for godot to dump its api"""
+
+    def __init__(self, godot: str) -> None:
+        self.index: Optional[SymbolIndex] = None
+        self.thread = threading.Thread(target=self._load, args=(godot,), daemon=True)
+        self.thread.start()
+
+    def _load(self, godot: str) -> None:
+        self.index = load_index(godot)
+
+
+def parse_symbols(output: str) -> dict[str, str]:
+    """Names from the output of the symbols server command, mapped to what they are"""
+    names = {}
+    for line in output.splitlines():
+        kind, _, name = line.partition(" ")
+        if name:
+            names[name] = kind
+    return names
+
+
+class SessionSymbols:
+    """Names defined in the repl session, for completion.
+
+    They are fetched with the symbols server command on a connection of their own, from a
+    background thread, so completing never waits on the server even while it runs code. The
+    names are kept until the generation of the session the server reports changes, and a
+    fetch waits for the session to stay unchanged for the debounce delay.
+    """
+
+    def __init__(self, connect: Callable[[], Any], debounce: float = DEBOUNCE) -> None:
+        self.connect = connect
+        self.debounce = debounce
+        self.client: Any = None
+        self.names: dict[str, str] = {}
+        self.sorted: list[str] = []
+        # Generation the names are from and the latest one the session is known to be at
+        self.generation: Optional[int] = None
+        self.wanted: Optional[int] = None
+        # Session the names are from, the connection is replaced when the repl moves to another
+        self.session: Optional[str] = None
+        self.timer: Optional[threading.Timer] = None
+        self.lock = threading.Lock()
+        self.fetch_lock = threading.Lock()
+
+    def update(self, generation: Optional[int], session: Optional[str] = None) -> None:
+        """Called with the generation of the session after each request, schedules a fetch if it changed"""
+        with self.lock:
+            if session != self.session:
+                self.session = session
+                self.generation = None
+                # A fetch still using the old connection fails and its names are dropped
+                if self.client is not None:
+                    self.client.close()
+                    self.client = None
+            if generation is None or generation == self.generation:
+                return
+            self.wanted = generation
+            if self.timer is not None:
+                self.timer.cancel()
+            self.timer = threading.Timer(self.debounce, self.fetch)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def fetch(self) -> None:
+        # Only fetches wait on fetch_lock, the prompt thread takes the short self.lock alone
+        with self.fetch_lock:
+            with self.lock:
+                if self.wanted == self.generation:
+                    return
+                session, client = self.session, self.client
+            try:
+                if client is None:
+                    client = self.connect()
+                    with self.lock:
+                        if session != self.session:
+                            client.close()
+                            return
+                        self.client = client
+                reply = client.request("eval", lambda stream, text: None, code="symbols")
+            # The client exits when it can't connect, that mustn't end the timer thread with a traceback
+            except (OSError, SystemExit, websocket().WebSocketException):
+                with self.lock:
+                    if self.client is client:
+                        self.client = None
+                return
+            if reply.get("type") != "command":
+                return
+            names = parse_symbols(reply.get("output", ""))
+            with self.lock:
+                if session != self.session:
+                    return
+                self.names, self.sorted = names, sorted(names)
+                self.generation = reply.get("generation", self.wanted)
+
+    def complete(self, prefix: str) -> list[str]:
+        """Names starting with prefix from what was fetched last, never waits for the server"""
+        return complete_prefix(self.sorted, prefix)
+
+    def close(self) -> None:
+        if self.timer is not None:
+            self.timer.cancel()
+        if self.client is not None:
+            self.client.close()
@@ -50,6 +50,11 @@ func listen(port: int) -> int:
 	return tcp_server.listen(port)
 
 
+# The port actually bound, which is an ephemeral one when listening on port 0.
+func get_local_port() -> int:
+	return tcp_server.get_local_port()
+
+
 func stop() -> void:
 	tcp_server.stop()
 	pending_peers.clear()
@@ -1,8 +1,5 @@
 import re
-import signal
-import threading
 from pathlib import Path
-from tempfile import NamedTemporaryFile
 
 import requests
 import trio
@@ -12,22 +9,29 @@ from config import DOCKER_COMMAND
 from config import NICK
 from config import PORT
 from config import PREFIX
+from config import QUEUE_SIZE
 from config import SERVER
+from config import SESSIONS_PER_WORKER
+from config import SNAPSHOTS
 from config import SSL
+from config import WORKER_PORT
+from config import WORKERS
 from IrcBot.bot import IrcBot
 from IrcBot.bot import Message
 from IrcBot.bot import utils
-from message_server import listen_loop
-from pexpect import replwrap
+from message_server import MessageRelay
+from workers import WorkerPool
 
 from gdrepl import script_file
 
 
 REPL_TTL = 60 * 60 * 2
-DOCKER_COMMAND = DOCKER_COMMAND % str(Path(script_file()).parent)
-COMMAND = f'gdrepl --command "{DOCKER_COMMAND}"'
+# The port placeholder is filled in for each worker
+Path(SNAPSHOTS).mkdir(parents=True, exist_ok=True)
+DOCKER_COMMAND = DOCKER_COMMAND.replace("{scripts}", str(Path(script_file()).parent))
+DOCKER_COMMAND = DOCKER_COMMAND.replace("{snapshots}", str(Path(SNAPSHOTS).resolve()))
 
-user_repls = TTLCache(maxsize=4, ttl=REPL_TTL)
+workers = WorkerPool(DOCKER_COMMAND, WORKERS, WORKER_PORT, SESSIONS_PER_WORKER, QUEUE_SIZE)
 user_history = TTLCache(maxsize=128, ttl=REPL_TTL)
 
 utils.setHelpHeader("USE: {PREFIX} [gdscript command here]       - (Notice the space)")
@@ -38,8 +42,6 @@ utils.setPrefix(PREFIX)
 
 info = utils.log
 
-FIFO = NamedTemporaryFile(mode="w+b", prefix="gdrepl-bot", suffix=".fifo", delete=False).name  # noqa: SIM115
-
 
 def ansi2irc(text):
     """Convert ansi colors to irc colors."""
@@ -50,12 +52,7 @@ def ansi2irc(text):
 
 def reply(msg: Message, text: str):
     """Reply to a message."""
-    with open(FIFO, "w") as f:
-        for line in text.splitlines():
-            if not line.strip():
-                continue
-            line = f"<{msg.nick}> {ansi2irc(line)}"
-            f.write(f"[[{msg.channel}]] {line}\n")
+    relay.reply(msg.channel, msg.nick, text)
 
 
 def paste(text):
@@ -71,6 +68,9 @@ def paste(text):
         return "Failed to paste"
 
 
+relay = MessageRelay(paste, ansi2irc)
+
+
 def read_paste(url):
     """Read text from ix.io."""
     response = requests.request("GET", url)
@@ -78,37 +78,26 @@ def read_paste(url):
 
 
 def run_command(msg: Message, text: str):
-    def _run_command(msg: Message, text: str):
-        def __run_command(msg: Message, text: str):
-            global user_repls, user_history
-            user = msg.nick
-            if user not in user_repls:
-                info(f"Creating new repl for {user}")
-                user_repls[user] = replwrap.REPLWrapper(COMMAND, ">>> ", prompt_change=None)
-            reply(msg, user_repls[user].run_command(text, timeout=10))
-
-            if user not in user_history:
-                user_history[user] = []
-            user_history[user].append(text)
-
-        t = threading.Thread(target=__run_command, args=(msg, text), daemon=True)
-        t.start()
-        t.join(10)
-        if t.is_alive():
-            gdscripttop: replwrap.REPLWrapper = user_repls[msg.nick]
-            gdscripttop.child.kill(signal.SIGINT)
-            user_repls.pop(msg.nick, None)
-            reply(msg, "Command timed out. I Cleared your environment")
-
-    threading.Thread(target=_run_command, args=(msg, text)).start()
+    """Queues the code on the worker of the nick, the output is replied once it ran"""
+    refused = workers.submit(msg.nick, text.replace(";", "\n"), lambda output: reply(msg, output))
+    if refused:
+        reply(msg, refused)
+        return
+
+    if msg.nick not in user_history:
+        user_history[msg.nick] = []
+    user_history[msg.nick].append(text)
 
 
 @utils.arg_command("clear", "Clear environment")
 async def clear(bot: IrcBot, match: re.Match, message: Message):
-    global user_repls
-    user_repls.pop(message.nick, None)
     user_history.pop(message.nick, None)
-    reply(message, "Environment cleared")
+    if not workers.has(message.nick):
+        reply(message, "Environment cleared")
+        return
+    refused = workers.submit(message.nick, "reset", lambda output: reply(message, "Environment cleared"), command=True)
+    if refused:
+        reply(message, refused)
 
 
 @utils.regex_cmd_with_messsage(f"^{PREFIX} (.+)$")
@@ -119,10 +108,10 @@ async def run(bot: IrcBot, match: re.Match, message: Message):
 
 @utils.arg_command("paste", "Pastes your environment code")
 async def pipaste(bot: IrcBot, args: re.Match, msg: Message):
-    if msg.nick not in user_repls:
+    if msg.nick not in user_history:
         reply(msg, "You don't have an environment")
         return
-    reply(msg, paste("\n".join(user_history[msg.nick])))
+    reply(msg, await trio.to_thread.run_sync(paste, "\n".join(user_history[msg.nick])))
 
 
 @utils.arg_command("read", "Populates your environment code with code from url")
@@ -141,28 +130,21 @@ async def onConnect(bot: IrcBot):
     for channel in CHANNELS:
         await bot.join(channel)
 
-    async def message_handler(text):
-        for line in text.splitlines():
-            match = re.match(r"^\[\[([^\]]+)\]\] (.*)$", line)
-            if match:
-                channel, text = match.groups()
-                await bot.send_message(text, channel)
-
     async def update_loop():
-        """Update cache to eliminate invalid keys"""
-        global user_repls, user_history
+        """Update cache to eliminate invalid keys and free the workers of idle nicks"""
+        global user_history
         while True:
-            user_repls.pop(None, None)
             user_history.pop(None, None)
+            workers.expire(REPL_TTL)
             await trio.sleep(3)
 
     async with trio.open_nursery() as nursery:
-        nursery.start_soon(listen_loop, FIFO, message_handler)
+        nursery.start_soon(relay.run, bot.send_message)
         nursery.start_soon(update_loop)
+        nursery.start_soon(workers.run)
 
 
 if __name__ == "__main__":
     print("DOCKER COMMAND:", DOCKER_COMMAND)
-    print("REPL COMMAND:", COMMAND)
     bot = IrcBot(SERVER, PORT, NICK, use_ssl=SSL)
     bot.runWithCallback(onConnect)
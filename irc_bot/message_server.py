@@ -11,44 +11,119 @@
 ################################################################################
 
 
-import asyncio
-import atexit
-import os
-import stat
-from typing import Callable
+from collections.abc import Awaitable
+from collections.abc import Callable
+from dataclasses import dataclass
+from typing import Optional
 
 import trio
 
 
-loop = True
-FIFO = "/tmp/gdrepl-bot.fifo"
+# Replies waiting to be sent before new ones are dropped
+QUEUE_SIZE = 256
+# Lines a channel can get at once and how many more it gets per second after that
+CHANNEL_BURST = 4
+CHANNEL_RATE = 1.0
+# The server limits the whole connection too
+CONNECTION_BURST = 5
+CONNECTION_RATE = 2.0
+# Outputs longer than this are pasted and only the link is sent
+PASTE_LINES = 4
+PASTE_CHARS = 1200
+# Longest line sent, longer ones are cut
+MAX_LINE = 400
 
 
-def stop_loop():
-    global loop, FIFO
-    loop = False
-    with open(FIFO, "w") as f:
-        f.write(".")
-    os.remove(FIFO)
+@dataclass
+class Reply:
+    channel: str
+    nick: str
+    text: str
 
 
-atexit.register(stop_loop)
+class TokenBucket:
+    """Allows burst sends at once and rate sends per second after that"""
 
+    def __init__(self, burst: int, rate: float):
+        self.burst = burst
+        self.rate = rate
+        self.tokens = float(burst)
+        self.updated = None
 
-async def listen_loop(fifo_path: str, handler: Callable):
-    global loop, FIFO
-    if os.path.exists(fifo_path):
-        os.remove(fifo_path)
+    def _refill(self):
+        now = trio.current_time()
+        if self.updated is not None:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
 
-    os.mkfifo(fifo_path)
-    os.chmod(fifo_path, stat.S_IRWXO | stat.S_IRWXU | stat.S_IRWXG)
-    FIFO = fifo_path
-    print("Message Relay listening at fifo: " + fifo_path)
-    while loop:
-        async with await trio.open_file(fifo_path) as fifo:
-            async for line in fifo:
-                line = line.strip()
-                if asyncio.iscoroutinefunction(handler):
-                    await handler(line)
-                else:
-                    handler(line)
+    def delay(self) -> float:
+        """Seconds until a token is available"""
+        self._refill()
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+    def take(self):
+        self._refill()
+        self.tokens -= 1
+
+    async def acquire(self):
+        while (delay := self.delay()) > 0:
+            await trio.sleep(delay)
+        self.take()
+
+
+class MessageRelay:
+    """Sends the replies of the bot from its trio loop without flooding the server.
+
+    Each channel has its own queue, so a long reply to one channel doesn't hold up
+    the others, and its own token bucket on top of the one of the connection. The
+    lines of a reply are sent together and replies too long for the channel are
+    pasted and replaced by their link.
+    """
+
+    def __init__(self, paste: Callable[[str], str], format_line: Callable[[str], str] = str):
+        self.send = None
+        self.paste = paste
+        self.format_line = format_line
+        self.connection = TokenBucket(CONNECTION_BURST, CONNECTION_RATE)
+        self.channels = {}
+        self.replies, self.received = trio.open_memory_channel(QUEUE_SIZE)
+
+    def reply(self, channel: str, nick: str, text: str):
+        """Queues a reply, never waits. Replies are dropped when the bot is too far behind"""
+        try:
+            self.replies.send_nowait(Reply(channel, nick, text))
+        except trio.WouldBlock:
+            print(f"Dropped reply to {nick} on {channel}, too many waiting")
+
+    def lines(self, reply: Reply) -> Optional[list]:
+        """Lines to send for the reply, None when it should be pasted"""
+        lines = [line for line in reply.text.splitlines() if line.strip()]
+        if len(lines) > PASTE_LINES or sum(len(line) for line in lines) > PASTE_CHARS:
+            return None
+        return [f"<{reply.nick}> {self.format_line(line)}"[:MAX_LINE] for line in lines]
+
+    async def run(self, send: Callable[[str, str], Awaitable]):
+        """Sends the queued replies with send(text, channel), sorting them into the queue of their channel"""
+        self.send = send
+        async with trio.open_nursery() as nursery, self.received:
+            async for reply in self.received:
+                if reply.channel not in self.channels:
+                    queue, receive = trio.open_memory_channel(QUEUE_SIZE)
+                    self.channels[reply.channel] = queue
+                    nursery.start_soon(self.channel_loop, reply.channel, receive)
+                try:
+                    self.channels[reply.channel].send_nowait(reply)
+                except trio.WouldBlock:
+                    print(f"Dropped reply to {reply.nick} on {reply.channel}, too many waiting")
+
+    async def channel_loop(self, channel: str, receive):
+        bucket = TokenBucket(CHANNEL_BURST, CHANNEL_RATE)
+        async for reply in receive:
+            lines = self.lines(reply)
+            if lines is None:
+                url = await trio.to_thread.run_sync(self.paste, reply.text)
+                lines = [f"<{reply.nick}> {url.strip()}"]
+            for line in lines:
+                await bucket.acquire()
+                await self.connection.acquire()
+                await self.send(line, channel)
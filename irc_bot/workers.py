@@ -0,0 +1,348 @@
+"""Pool of long lived godot workers that run the code of every nick.
+
+Each worker is a godot server hosting one session per nick, so a new user doesn't
+pay for a container and an engine boot. A nick stays on the worker it was placed on,
+new nicks go to the least loaded worker with room. Everything runs as tasks of the
+bot's trio nursery: each nick has a small queue served by a task of its own and
+each worker runs one command at a time. Commands that don't fit in the queues are
+turned away right away instead of waiting behind everyone else.
+
+Servers that can cancel stop a command themselves once it runs out of time, on the
+others it only stops being waited for. The worker is only restarted when the server
+doesn't finish a command for much longer or when it exits. What nicks type is only
+ever evaluated, the server commands are reserved to the bot. That doesn't isolate nicks
+sharing a worker: evaluated code can reach the server and the other sessions through
+`Engine.get_main_loop()`, so workers should host more than one nick only when they trust
+each other.
+
+Workers with snapshots write the session of a nick to disk when it expires and resume
+it when the nick comes back, on whichever worker it lands, without running its code again.
+"""
+
+import itertools
+import json
+import shlex
+import subprocess
+from collections import Counter
+from dataclasses import dataclass
+from typing import Callable
+from typing import Optional
+
+import trio
+from trio_websocket import ConnectionClosed
+from trio_websocket import HandshakeError
+from trio_websocket import connect_websocket_url
+
+from gdrepl.client import client
+from gdrepl.constants import ERR_BUSY
+from gdrepl.constants import ERR_TIMEOUT
+from gdrepl.constants import PROTOCOL_VERSION
+
+
+# Seconds a command is waited for before its nick is told it timed out
+JOB_TIMEOUT = 10
+# Seconds the server gets to answer after cancelling a command at its deadline
+CANCEL_GRACE = 3
+# Seconds the server gets to finish a timed out command before the worker is restarted
+STUCK_TIMEOUT = 60
+# Seconds to wait for a worker to boot and before trying again when it doesn't
+BOOT_TIMEOUT = 60
+BOOT_RETRY = 5
+# Commands a nick can have waiting at once
+PENDING_PER_NICK = 2
+# Seconds to wait for a session to be written to or read from disk
+SNAPSHOT_TIMEOUT = 10
+
+
+def decode(message) -> Optional[dict]:
+    """The json frame in message, None for plain text"""
+    try:
+        frame = json.loads(message)
+    except ValueError:
+        return None
+    return frame if isinstance(frame, dict) else None
+
+
+@dataclass
+class Job:
+    code: str
+    done: Callable[[str], None]
+    # Server commands like reset are only run for the bot itself, code from nicks is only evaluated
+    command: bool = False
+
+
+class Session:
+    """Connection to the session of a nick on a worker, speaking the json protocol"""
+
+    def __init__(self, ws):
+        self.ws = ws
+        self.ids = itertools.count(1)
+        self.capabilities = []
+
+    @classmethod
+    async def connect(cls, nursery, port: int, session: Optional[str] = None) -> "Session":
+        self = cls(await connect_websocket_url(nursery, f"ws://127.0.0.1:{port}"))
+        hello = {"v": PROTOCOL_VERSION, "id": 0, "op": "hello"}
+        if session is not None:
+            hello["session"] = session
+        await self.ws.send_message(json.dumps(hello))
+        reply = decode(await self.ws.get_message()) or {}
+        if reply.get("type") != "hello":
+            await self.ws.aclose()
+            raise ConnectionError(reply.get("error", "The worker doesn't speak the json protocol"))
+        self.capabilities = reply.get("capabilities", [])
+        return self
+
+    async def submit(self, op: str, **fields) -> int:
+        request_id = next(self.ids)
+        await self.ws.send_message(json.dumps({"v": PROTOCOL_VERSION, "id": request_id, "op": op, **fields}))
+        return request_id
+
+    async def wait(self, request_id: int, output: Optional[list] = None) -> dict:
+        """Receives until the reply to request_id, what is left of requests that were given up on is skipped"""
+        while True:
+            reply = decode(await self.ws.get_message())
+            if reply is None or reply.get("id") != request_id:
+                continue
+            if reply.get("type") != "output":
+                return reply
+            if output is not None:
+                output.append(reply.get("text", ""))
+
+    async def aclose(self):
+        await self.ws.aclose()
+
+
+class Worker:
+    def __init__(self, index: int, command: str, port: int, capacity: int, queue_size: int):
+        self.index = index
+        self.command = command
+        self.port = port
+        # Nicks the worker hosts at most and commands that can wait for it
+        self.capacity = capacity
+        self.queue_size = queue_size
+        self.queued = 0
+        # Held while the server runs a command, the server runs one at a time anyway
+        self.slot = trio.Semaphore(1)
+        self.proc = None
+        # Session of each nick, connected on its first command
+        self.sessions = {}
+        self.listening = trio.Event()
+        self.nursery = None
+
+    async def run(self, nursery):
+        self.nursery = nursery
+        async with self.slot:
+            await self.boot()
+
+    async def boot(self):
+        """Launches the server, trying again until it listens"""
+        while True:
+            self.listening = trio.Event()
+            self.proc = await trio.lowlevel.open_process(
+                shlex.split(self.command.format(port=self.port)),
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+                start_new_session=True,
+            )
+            self.nursery.start_soon(self._read, self.proc, self.listening)
+            with trio.move_on_after(BOOT_TIMEOUT):
+                await self.listening.wait()
+                try:
+                    probe = await Session.connect(self.nursery, self.port)
+                except (HandshakeError, OSError) as e:
+                    print(f"Worker {self.index} can't be connected to: {e}")
+                else:
+                    # Servers without sessions share one namespace between connections, they can only host one nick
+                    if "sessions" not in probe.capabilities:
+                        self.capacity = 1
+                    await probe.aclose()
+                    return
+            print(f"Worker {self.index} didn't start, trying again")
+            await self.stop()
+            await trio.sleep(BOOT_RETRY)
+
+    async def _read(self, proc, listening):
+        """Waits for the listening line and keeps reading the output so the server never blocks.
+
+        A server that exits without being stopped, like when it crashes, is booted again.
+        """
+        seen = b""
+        while data := await proc.stdout.receive_some():
+            seen = seen[-64:] + data
+            if b"Gdrepl Listening on" in seen:
+                listening.set()
+        await proc.wait()
+        if proc is not self.proc:
+            return
+        # Waits for the command that was running to fail on the closed connection
+        async with self.slot:
+            if proc is not self.proc:
+                return
+            lost = len(self.sessions)
+            print(f"Worker {self.index} exited with {proc.returncode}, restarting it, {lost} sessions cleared")
+            await self.stop()
+            await self.boot()
+
+    async def stop(self):
+        sessions, self.sessions = self.sessions, {}
+        for session in sessions.values():
+            await session.aclose()
+        # Cleared first so the server exiting isn't taken for a crash
+        proc, self.proc = self.proc, None
+        if proc is not None:
+            proc.terminate()
+            with trio.move_on_after(5):
+                await proc.wait()
+                return
+            proc.kill()
+
+    async def session(self, nick: str) -> Session:
+        if nick not in self.sessions:
+            session = await Session.connect(self.nursery, self.port, f"irc:{nick}")
+            self.sessions[nick] = session
+            if "snapshots" in session.capabilities:
+                # Nicks without a snapshot just get an error back
+                with trio.move_on_after(SNAPSHOT_TIMEOUT):
+                    await session.wait(await session.submit("eval", code=f"resume irc:{nick}"))
+        return self.sessions[nick]
+
+    async def execute(self, nick: str, code: str, command: bool = False) -> str:
+        output = []
+        fields = {"code": code} if command else {"code": code, "commands": False}
+        await self.slot.acquire()
+        try:
+            session = await self.session(nick)
+            if "cancel" in session.capabilities:
+                request_id = await session.submit("eval", deadline=JOB_TIMEOUT * 1000, **fields)
+                timeout = JOB_TIMEOUT + CANCEL_GRACE
+            else:
+                request_id = await session.submit("eval", **fields)
+                timeout = JOB_TIMEOUT
+            with trio.move_on_after(timeout):
+                reply = await session.wait(request_id, output)
+                self.slot.release()
+                # The server stopped the command at its deadline
+                if reply.get("error_code") == ERR_TIMEOUT:
+                    return "".join(output) + "Command timed out"
+                if reply.get("error_code") == ERR_BUSY:
+                    return "".join(output) + "Command timed out and didn't stop, your environment was reset"
+                return "".join(output) + client.format(reply)
+        except (ConnectionClosed, HandshakeError, OSError) as e:
+            self.sessions.pop(nick, None)
+            self.slot.release()
+            return f"Error: {e}"
+
+        # The slot is released once the server is done with the command
+        self.nursery.start_soon(self.drain, nick, session, request_id)
+        return "".join(output) + "Command timed out"
+
+    async def drain(self, nick: str, session: Session, request_id: int):
+        """Waits for the server to finish a timed out command, restarting it when it doesn't"""
+        try:
+            with trio.move_on_after(STUCK_TIMEOUT):
+                await session.wait(request_id)
+                return
+            lost = len(self.sessions)
+            await self.stop()
+            await self.boot()
+            print(f"Worker {self.index} restarted after {nick}'s command got stuck, {lost} sessions cleared")
+        except (ConnectionClosed, OSError):
+            self.sessions.pop(nick, None)
+        finally:
+            self.slot.release()
+
+    async def release(self, nick: str):
+        """Closes the connection of nick, the server drops its session once it expires there"""
+        session = self.sessions.pop(nick, None)
+        if session is None:
+            return
+        try:
+            if "snapshots" in session.capabilities:
+                with trio.move_on_after(SNAPSHOT_TIMEOUT):
+                    await session.wait(await session.submit("eval", code=f"snapshot irc:{nick}"))
+        except (ConnectionClosed, OSError):
+            pass
+        await session.aclose()
+
+
+class WorkerPool:
+    def __init__(self, command: str, workers: int, port: int, sessions_per_worker: int, queue_size: int):
+        self.workers = [Worker(i, command, port + i, sessions_per_worker, queue_size) for i in range(workers)]
+        # Worker each nick was placed on, the queue its task serves and when it last sent a command
+        self.placement = {}
+        self.queues = {}
+        self.last_used = {}
+        self.nursery = None
+
+    async def run(self):
+        async with trio.open_nursery() as nursery:
+            self.nursery = nursery
+            for worker in self.workers:
+                nursery.start_soon(worker.run, nursery)
+
+    def place(self, nick: str) -> Optional[Worker]:
+        """Worker of nick, placing it on the least loaded one with room if it has none"""
+        if nick in self.placement:
+            return self.placement[nick]
+        placed = Counter(self.placement.values())
+        free = [w for w in self.workers if placed[w] < w.capacity]
+        if not free:
+            return None
+        worker = min(free, key=lambda w: (placed[w], w.queued))
+        self.placement[nick] = worker
+        return worker
+
+    def submit(self, nick: str, code: str, done: Callable[[str], None], command: bool = False) -> Optional[str]:
+        """Queues code to run on the session of nick, done is called with its output.
+
+        command lets the code run server commands, only for what the bot sends itself.
+
+        Returns why the command was turned away or None if it was queued.
+        """
+        if self.nursery is None:
+            return "Still starting, try again later"
+        worker = self.place(nick)
+        if worker is None:
+            return "All workers are full, try again later"
+        if worker.queued >= worker.queue_size:
+            return "Too busy right now, try again later"
+
+        if nick not in self.queues:
+            send, receive = trio.open_memory_channel(PENDING_PER_NICK)
+            self.queues[nick] = send
+            self.nursery.start_soon(self.serve, nick, worker, receive)
+        try:
+            self.queues[nick].send_nowait(Job(code, done, command))
+        except trio.WouldBlock:
+            return "Wait for your previous commands to finish"
+        worker.queued += 1
+        self.last_used[nick] = trio.current_time()
+        return None
+
+    async def serve(self, nick: str, worker: Worker, receive):
+        """Runs the commands of nick one after the other until it is released"""
+        async with receive:
+            async for job in receive:
+                try:
+                    job.done(await worker.execute(nick, job.code, job.command))
+                finally:
+                    worker.queued -= 1
+        # Unless the nick came back to the same worker while its last command ran
+        if self.placement.get(nick) is not worker:
+            await worker.release(nick)
+
+    def has(self, nick: str) -> bool:
+        return nick in self.placement
+
+    def expire(self, ttl: float):
+        """Frees the place of the nicks that didn't send anything for ttl seconds"""
+        now = trio.current_time()
+        for nick, last_used in list(self.last_used.items()):
+            send = self.queues[nick]
+            if now - last_used > ttl and not send.statistics().current_buffer_used:
+                del self.last_used[nick]
+                del self.placement[nick]
+                # Ends the task of the nick once its last command is done
+                self.queues.pop(nick).close()
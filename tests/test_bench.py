@@ -0,0 +1,60 @@
+import os
+
+import pytest
+
+from gdrepl.bench import DEFAULT_MIX
+from gdrepl.bench import LoadGenerator
+from gdrepl.bench import load_mix
+from gdrepl.bench import percentile
+from gdrepl.bench import rss_kib
+from gdrepl.standin import StandinServer
+
+
+@pytest.fixture
+def server():
+    with StandinServer() as server:
+        yield server
+
+
+class TestLoadGenerator:
+    def test_target_rate(self, server):
+        """Test the clients together send at the target rate without errors"""
+        summary = LoadGenerator(server.port, 4, 100, 1.0, DEFAULT_MIX).run().summary()
+
+        assert 90 <= summary["requests"] <= 110
+        assert summary["error_rate"] == 0
+        assert summary["timeout_rate"] == 0
+        assert 0 < summary["p50_ms"] <= summary["p95_ms"] <= summary["p99_ms"]
+
+    def test_own_sessions(self, server):
+        """Test each client gets a session of its own unless they share the default one"""
+        LoadGenerator(server.port, 3, 30, 0.2, DEFAULT_MIX).run()
+        assert len(server.sessions) == 3
+
+    def test_timeouts(self):
+        """Test requests the server is too slow for count as timeouts and not in the latency"""
+        with StandinServer(latency=0.3) as slow:
+            summary = LoadGenerator(slow.port, 1, 10, 0.3, [("1 + 1", 1)], timeout=0.05).run().summary()
+
+        assert summary["timeout_rate"] == 1
+        assert summary["p50_ms"] == 0
+
+    def test_server_memory(self, server):
+        """Test the memory of the server is sampled while the clients run"""
+        report = LoadGenerator(server.port, 1, 10, 1.5, DEFAULT_MIX, pid=os.getpid()).run()
+        assert report.rss and report.rss[0][1] == pytest.approx(rss_kib(os.getpid()), rel=0.5)
+
+
+class TestHelpers:
+    def test_percentile(self):
+        """Test percentiles pick the nearest rank"""
+        values = list(range(1, 101))
+        assert percentile(values, 0.5) == 51
+        assert percentile(values, 0.99) == 100
+        assert percentile([], 0.5) == 0
+
+    def test_load_mix(self, tmp_path):
+        """Test snippet mixes are read from yaml with weights defaulting to 1"""
+        mix = tmp_path / "mix.yaml"
+        mix.write_text('- code: "1 + 1"\n  weight: 3\n- code: |\n    var a = 1\n    a\n')
+        assert load_mix(str(mix)) == [("1 + 1", 3.0), ("var a = 1\na\n", 1.0)]
@@ -0,0 +1,191 @@
+import json
+from unittest.mock import patch
+
+import pytest
+
+from gdrepl.client import client
+
+
+class FakeWebSocket:
+    """Replies to each sent message with the next canned response"""
+
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.sent = []
+
+    def send(self, data):
+        self.sent.append(data)
+
+    def recv(self):
+        return self.responses.pop(0)
+
+    def close(self):
+        pass
+
+
+HELLO = json.dumps(
+    {
+        "v": 1,
+        "id": 0,
+        "type": "hello",
+        "version": 1,
+        "engine": "4.5.1",
+        "capabilities": ["eval"],
+        "commands": {"reset": "clears the script buffer for the current session"},
+    }
+)
+
+
+def make_client(responses):
+    ws = FakeWebSocket(responses)
+    with patch("gdrepl.client.create_connection", return_value=ws):
+        return client(), ws
+
+
+class TestClient:
+    def test_handshake(self):
+        """Test the structured protocol is negotiated on connect"""
+        c, ws = make_client([HELLO])
+
+        assert c.protocol == 1
+        assert c.engine == "4.5.1"
+        assert json.loads(ws.sent[0])["op"] == "hello"
+        assert c.server_commands() == {"reset": "clears the script buffer for the current session"}
+
+    def test_legacy_fallback(self):
+        """Test servers without the structured protocol are spoken to in plain text"""
+        c, ws = make_client(['{"type": "error", "id": 0, "error": "Unsupported protocol"}', ">> 2"])
+
+        assert c.protocol == 0
+        assert c.send("1+1") == "  -> 2"
+        assert ws.sent[-1] == "1+1"
+
+    def test_legacy_help_scrape(self):
+        """Test server commands are read from help on the plain text protocol"""
+        c, _ = make_client([">> {}", "GDREPL Server Help\nreset: clears\nquit: stops\n\n"])
+
+        assert c.server_commands() == {"reset": " clears", "quit": " stops"}
+
+    def test_send_result(self):
+        """Test results are formatted like the plain text protocol"""
+        c, ws = make_client([HELLO, json.dumps({"v": 1, "id": 1, "type": "result", "result": "2", "error_code": 0})])
+
+        assert c.send("1+1") == "  -> 2"
+        assert json.loads(ws.sent[-1]) == {"v": 1, "id": 1, "op": "eval", "code": "1+1"}
+
+    def test_send_parse_error(self):
+        """Test parse errors are not shown as results"""
+        c, _ = make_client([HELLO, json.dumps({"v": 1, "id": 1, "type": "result", "result": "", "error_code": 43})])
+
+        assert c.send("1+") == ""
+
+    def test_send_command(self):
+        """Test command replies are formatted"""
+        c, _ = make_client([HELLO, json.dumps({"v": 1, "id": 1, "type": "command", "output": "Cleared"})])
+
+        assert c.send("reset") == "Environment cleared!"
+
+    def test_pipelined_requests(self):
+        """Test replies are matched to their requests by id"""
+        c, _ = make_client(
+            [
+                HELLO,
+                json.dumps({"v": 1, "id": 2, "type": "result", "result": "b"}),
+                json.dumps({"v": 1, "id": 1, "type": "result", "result": "a"}),
+            ]
+        )
+
+        first = c.submit("eval", code="a")
+        second = c.submit("eval", code="b")
+
+        assert c.wait(first)["result"] == "a"
+        assert c.wait(second)["result"] == "b"
+
+    def test_output_frames(self):
+        """Test output frames are passed to the handler of their request as they arrive"""
+        c, _ = make_client(
+            [
+                HELLO,
+                json.dumps({"v": 1, "id": 2, "type": "output", "stream": "stdout", "text": "other\n"}),
+                json.dumps({"v": 1, "id": 1, "type": "output", "stream": "stdout", "text": "hi\n"}),
+                json.dumps({"v": 1, "id": 1, "type": "output", "stream": "stderr", "text": "SCRIPT ERROR: x\n"}),
+                json.dumps({"v": 1, "id": 1, "type": "result", "result": "<null>"}),
+                json.dumps({"v": 1, "id": 2, "type": "result", "result": "<null>"}),
+            ]
+        )
+        output = []
+
+        first = c.submit("eval", code="print('hi')")
+        second = c.submit("eval", code="print('other')")
+
+        assert c.wait(first, lambda stream, text: output.append((stream, text)))["result"] == "<null>"
+        assert output == [("stdout", "hi\n"), ("stderr", "SCRIPT ERROR: x\n")]
+
+        output.clear()
+        c.wait(second, lambda stream, text: output.append((stream, text)))
+        assert output == [("stdout", "other\n")]
+
+    def test_generation(self):
+        """Test the session generation is followed from the replies"""
+        c, _ = make_client(
+            [
+                json.dumps({**json.loads(HELLO), "generation": 4}),
+                json.dumps({"v": 1, "id": 1, "type": "result", "result": "", "generation": 7}),
+            ]
+        )
+        assert c.generation == 4
+
+        c.send("var a = 1")
+        assert c.generation == 7
+
+    def test_session(self):
+        """Test the session is asked for on hello and the one the server gave is kept"""
+        ws = FakeWebSocket([json.dumps({**json.loads(HELLO), "session": "3f2a"})])
+        with patch("gdrepl.client.create_connection", return_value=ws):
+            c = client(session="")
+
+        assert json.loads(ws.sent[0])["session"] == ""
+        assert c.session == "3f2a"
+
+    def test_default_session(self):
+        """Test clients that don't ask for a session don't send one"""
+        c, ws = make_client([HELLO])
+
+        assert "session" not in json.loads(ws.sent[0])
+        assert c.session is None
+
+    def test_session_refused(self):
+        """Test the client gives up when the server can't give it the session"""
+        ws = FakeWebSocket([json.dumps({"v": 1, "id": 0, "type": "error", "error": "Too many sessions (64)"})])
+        with patch("gdrepl.client.create_connection", return_value=ws), pytest.raises(SystemExit):
+            client(session="mine")
+
+    def test_cancel_on_interrupt(self):
+        """Test ctrl-c while waiting cancels the request on servers that can"""
+        c, ws = make_client([json.dumps({**json.loads(HELLO), "capabilities": ["eval", "cancel"]})])
+        replies = [
+            json.dumps({"v": 1, "id": 2, "type": "cancel", "target": 1, "cancelled": True}),
+            json.dumps({"v": 1, "id": 1, "type": "result", "result": "", "error": "Cancelled", "error_code": 1}),
+        ]
+
+        def recv():
+            if not any(json.loads(sent).get("op") == "cancel" for sent in ws.sent):
+                raise KeyboardInterrupt
+            return replies.pop(0)
+
+        ws.recv = recv
+        assert c.send("while true: pass") == "Cancelled"
+        assert json.loads(ws.sent[-1]) == {"v": 1, "id": 2, "op": "cancel", "target": 1}
+        assert not c._replies
+
+    def test_interrupt_without_cancel(self):
+        """Test ctrl-c is left to the repl when the server can't cancel"""
+        c, ws = make_client([HELLO])
+
+        def recv():
+            raise KeyboardInterrupt
+
+        ws.recv = recv
+
+        with pytest.raises(KeyboardInterrupt):
+            c.send("while true: pass")
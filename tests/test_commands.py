@@ -0,0 +1,92 @@
+import tempfile
+from unittest.mock import MagicMock
+
+from gdrepl.client import client
+from gdrepl.commands import COMMANDS
+from gdrepl.commands import expand_indent
+from gdrepl.commands import loadscript
+from gdrepl.standin import StandinServer
+
+
+SCRIPT = """extends Node
+
+var count = 1
+
+func add(a, b):
+\treturn a + b
+"""
+
+
+def make_script():
+    with tempfile.NamedTemporaryFile(mode="w", suffix=".gd", delete=False) as f:
+        f.write(SCRIPT)
+    return f.name
+
+
+class TestLoadScript:
+    def test_expand_indent(self):
+        """Test leading tabs become spaces and the rest of the line is kept"""
+        assert expand_indent("\t\treturn '\t'\n") == "        return '\t'\n"
+        assert expand_indent("var a = 1\n") == "var a = 1\n"
+
+    def test_bulk_load(self):
+        """Test servers that can load scripts get the whole file in one request"""
+        c = MagicMock()
+        c.capabilities = ["eval", "load"]
+        c.request.return_value = {"type": "result", "error_code": 0}
+
+        loadscript(c, [make_script()])
+
+        c.request.assert_called_once_with("load", code="\nvar count = 1\n\nfunc add(a, b):\n    return a + b\n")
+        c.send.assert_not_called()
+
+    def test_line_by_line_load(self):
+        """Test servers without the load capability get the file line by line"""
+        c = MagicMock()
+        c.capabilities = []
+
+        loadscript(c, [make_script()])
+
+        sent = [call.args[0] for call in c.send.call_args_list]
+        assert sent == ["\n", "var count = 1\n", "\n", "func add(a, b):\n", "    return a + b\n", "\n"]
+        c.request.assert_not_called()
+
+
+class TestCheckpoints:
+    def test_fork(self, capsys):
+        """Test forking copies the session into a new one and moves the connection to it"""
+        with StandinServer() as server:
+            c = client(port=server.port, session="first")
+            c.send("var a = 1")
+
+            COMMANDS["fork"].do(c, ["second"])
+            assert c.session == "second"
+            assert c.send("a") == "  -> 1"
+            c.send("var a = 2")
+
+            assert server.sessions["first"].values == {"a": 1}
+            assert "Forked into second" in capsys.readouterr().out
+            c.close()
+
+    def test_fork_existing(self, capsys):
+        """Test the connection stays on its session when the fork is refused"""
+        with StandinServer() as server:
+            c = client(port=server.port, session="first")
+            COMMANDS["fork"].do(c, ["first"])
+
+            assert c.session == "first"
+            assert "already exists" in capsys.readouterr().out
+            c.close()
+
+    def test_checkpoint_restore(self):
+        """Test a session goes back to its checkpoint as often as it is restored"""
+        with StandinServer() as server:
+            c = client(port=server.port)
+            c.send("var a = 1")
+            assert c.send("checkpoint one") == "Saved checkpoint one"
+            for value in (2, 3):
+                c.send(f"var a = {value}")
+                assert c.send("restore one") == "Restored checkpoint one"
+                assert c.send("a") == "  -> 1"
+            assert c.send("checkpoint") == "one"
+            c.close()
@@ -20,6 +20,7 @@ class TestConfigManager:
         assert config.max_history == 10000
         assert config.history_rotation is True
         assert config.backup_count == 3
+        assert config.history_index is True
         assert config.toolbar_style == "colorful"
         assert config.auto_suggest is True
         assert config.temp_suffix == ".gd"
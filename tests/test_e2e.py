@@ -3,6 +3,8 @@
 import pexpect
 import pytest
 
+from gdrepl.client import client
+
 
 class TestREPLE2E:
     """End-to-end tests that spawn the actual REPL and test interactive behavior."""
@@ -14,7 +16,8 @@ class TestREPLE2E:
         child = pexpect.spawn("uv run gdrepl", timeout=15, encoding="utf-8")
 
         # Wait for Godot to start
-        child.expect(r"Godot .* listening on: \d+", timeout=30)
+        child.expect(r"Godot .* listening on: (\d+)", timeout=30)
+        child.port = int(child.match.group(1))
 
         # Wait for the first prompt
         child.expect(">>>", timeout=5)
@@ -43,10 +46,10 @@ class TestREPLE2E:
         repl.expect(">>>")
 
     def test_print_statement(self, repl):
-        """Test print() statements produce stdout."""
+        """Test print() statements produce stdout before the result."""
         repl.sendline("print('hello world')")
-        repl.expect(r"-> <null>")
         repl.expect("hello world")
+        repl.expect(r"-> <null>")
         repl.expect(">>>")
 
     def test_variable_assignment(self, repl):
@@ -62,6 +65,23 @@ class TestREPLE2E:
         repl.expect(r"-> 50")
         repl.expect(">>>")
 
+    def test_assignments_run(self, repl):
+        """Test compound, subscript and attribute assignments run instead of being returned."""
+        c = client(port=repl.port, session="")
+        try:
+            c.send("var n = 1")
+            c.send("var arr = [0, 0]")
+            c.send("var node = Node.new()")
+            c.send("n += 1")
+            c.send("arr[0] = 5")
+            c.send('node.name = "renamed"')
+            assert c.send("n") == "  -> 2"
+            assert c.send("arr") == "  -> [5, 0]"
+            assert c.send("node.name") == "  -> renamed"
+            assert c.send("n == 2") == "  -> true"
+        finally:
+            c.close()
+
     def test_string_operations(self, repl):
         """Test string operations."""
         repl.sendline('"hello" + " " + "world"')
@@ -132,6 +152,187 @@ class TestREPLE2E:
         # Function calls might not work as expected, so just check for prompt
         repl.expect(">>>", timeout=10)
 
+    def test_load_script(self, repl, tmp_path):
+        """Test !load brings the functions and variables of a script into the session."""
+        script = tmp_path / "loaded.gd"
+        script.write_text(
+            "extends Node\n\nvar loaded_count = 2\n\nfunc loaded_add(a, b):\n\treturn a + b + loaded_count\n"
+        )
+
+        repl.sendline(f"!load {script}")
+        repl.expect("Successfully loaded script", timeout=10)
+        repl.expect(">>>", timeout=10)
+
+        repl.sendline("loaded_add(1, 2)")
+        repl.expect(r"-> 5", timeout=10)
+        repl.expect(">>>", timeout=10)
+
+        repl.sendline("loaded_count")
+        repl.expect(r"-> 2", timeout=10)
+        repl.expect(">>>", timeout=10)
+
+    def test_load_commented_script(self, repl, tmp_path):
+        """Test !load keeps comments with their block and ignores brackets in strings and comments."""
+        script = tmp_path / "commented.gd"
+        script.write_text(
+            "extends Node\n\n"
+            "# Counts calls\n"
+            "var calls = 0\n\n"
+            "func count(text):\n"
+            "#\tprint(text)\n"
+            "\tcalls += 1\n"
+            '\treturn "(" + text + "["  # closes ) and ]\n\n'
+            '# count("top level")\n'
+        )
+
+        repl.sendline(f"!load {script}")
+        repl.expect("Successfully loaded script", timeout=10)
+        repl.expect(">>>", timeout=10)
+
+        repl.sendline('count("a")')
+        repl.expect(r"-> \(a\[", timeout=10)
+        repl.expect(">>>", timeout=10)
+
+        repl.sendline("calls")
+        repl.expect(r"-> 1", timeout=10)
+        repl.expect(">>>", timeout=10)
+
+    def test_symbols_command(self, repl):
+        """Test !symbols lists the names defined in the session."""
+        repl.sendline("var fruit = 1")
+        repl.expect(">>>", timeout=10)
+
+        repl.sendline("!symbols")
+        repl.expect("var fruit", timeout=10)
+        repl.expect(">>>", timeout=10)
+
+    def test_sessions(self, repl):
+        """Test connections that ask for their own session don't see each other's names."""
+        repl.sendline("var shared = 1")
+        repl.expect(">>>", timeout=10)
+
+        first, second, main = (
+            client(port=repl.port, session=""),
+            client(port=repl.port, session=""),
+            client(port=repl.port),
+        )
+        try:
+            assert first.session != second.session
+            first.send("var mine = 41")
+            assert first.send("mine + 1") == "  -> 42"
+            assert "Err" in second.send("mine")
+            assert main.send("shared") == "  -> 1"
+        finally:
+            for c in (first, second, main):
+                c.close()
+
+    def test_deadline(self, repl):
+        """Test code past its deadline is stopped while other connections keep being answered."""
+        first, second = client(port=repl.port, session=""), client(port=repl.port, session="")
+        try:
+            first.send("var n = 0")
+            request_id = first.submit("eval", code="while true:\n    n += 1", deadline=1000)
+            assert second.send("1 + 1") == "  -> 2"
+            assert first.wait(request_id)["error"] == "Timed out"
+            assert first.send("n > 0") == "  -> true"
+        finally:
+            first.close()
+            second.close()
+
+    def test_deadline_declarations(self, repl):
+        """Test variables declared by code that timed out aren't kept."""
+        c = client(port=repl.port, session="")
+        try:
+            request_id = c.submit("eval", code="var late = 0\nwhile true:\n    late += 1", deadline=500)
+            assert c.wait(request_id)["error"] == "Timed out"
+            assert "Err" in c.send("late")
+            c.send("var late = 1")
+            assert c.send("late") == "  -> 1"
+        finally:
+            c.close()
+
+    def test_checkpoints(self, repl):
+        """Test sessions go back to a checkpoint and forks don't change the session they came from."""
+        c = client(port=repl.port, session="")
+        try:
+            c.send("var items = [1]")
+            assert c.send("checkpoint start") == "Saved checkpoint start"
+            c.send("items.append(2)")
+            assert c.send("restore start") == "Restored checkpoint start"
+            assert c.send("items") == "  -> [1]"
+
+            original = c.session
+            assert c.send("fork branch") == "Forked into branch"
+            assert c.join("branch") is None
+            c.send("items.append(3)")
+            assert c.join(original) is None
+            assert c.send("items") == "  -> [1]"
+        finally:
+            c.close()
+
+    def test_fork_prefixed_names(self, repl):
+        """Test prefixed sessions like the irc bot's can't fork and nobody can fork into their names."""
+        c, other = client(port=repl.port, session="irc:a"), client(port=repl.port, session="")
+        try:
+            c.send("var secret = 1")
+            assert c.send("fork irc:b").startswith("Error")
+            assert c.send("fork plain").startswith("Error")
+            assert other.send("fork irc:b").startswith("Error")
+        finally:
+            c.close()
+            other.close()
+
+    def test_snapshots(self, repl):
+        """Test a session resumed from its snapshot has its values back without running its code again."""
+        c = client(port=repl.port, session="")
+        try:
+            c.send("var items = [1, 2]")
+            c.send("var node = Node.new()")
+            reply = c.send("snapshot")
+            assert reply.startswith("Saving snapshot") and "node" in reply
+            assert c.send("reset") == "Environment cleared!"
+
+            assert c.send("resume " + c.session) == "Resumed snapshot " + c.session
+            assert c.send("items") == "  -> [1, 2]"
+            assert c.send("resume missing").startswith("Error: No snapshot")
+        finally:
+            c.close()
+
+    def test_snapshot_prefixed_names(self, repl):
+        """Test prefixed sessions only write and resume snapshots under their own name."""
+        owner, other = client(port=repl.port, session="irc:a"), client(port=repl.port, session="irc:b")
+        try:
+            owner.send("var secret = 1")
+            assert owner.send("snapshot").startswith("Saving snapshot irc:a")
+            assert other.send("resume irc:a").startswith("Error")
+            assert other.send("snapshot irc:a").startswith("Error")
+            assert other.send("snapshot plain").startswith("Error")
+            assert "Err" in other.send("secret")
+        finally:
+            owner.close()
+            other.close()
+
+    def test_snapshot_names_kept_apart(self, repl):
+        """Test names that only differ in characters files can't hold get snapshots of their own."""
+        owner, plain = client(port=repl.port, session="irc:a"), client(port=repl.port, session="")
+        try:
+            plain.send("var which = 1")
+            plain.send("snapshot a|b")
+            plain.send("which = 2")
+            plain.send("snapshot a_b")
+            assert plain.send("resume a|b") == "Resumed snapshot a|b"
+            assert plain.send("which") == "  -> 1"
+
+            owner.send("var secret = 1")
+            owner.send("snapshot")
+            plain.send("var secret = 2")
+            assert plain.send("snapshot irc_a").startswith("Saving snapshot irc_a")
+            assert owner.send("resume") == "Resumed snapshot irc:a"
+            assert owner.send("secret") == "  -> 1"
+        finally:
+            owner.close()
+            plain.close()
+
     def test_conditional_logic(self, repl):
         """Test if/else statements."""
         repl.sendline("var test_val = 10")
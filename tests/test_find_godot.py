@@ -0,0 +1,113 @@
+import os
+import stat
+from unittest.mock import patch
+
+import pytest
+
+from gdrepl.constants import PORT
+from gdrepl.find_godot import find_godot
+from gdrepl.find_godot import godot_command
+from gdrepl.find_godot import godot_version
+from gdrepl.find_godot import listening_port
+from gdrepl.find_godot import load_cache
+from gdrepl.find_godot import script_file_v4
+from gdrepl.find_godot import server_port
+
+
+@pytest.fixture
+def fake_godot(tmp_path, monkeypatch):
+    """Executable that prints a godot version and counts how often it ran"""
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+    calls = tmp_path / "calls"
+    godot = tmp_path / "godot"
+    godot.write_text(f"#!/bin/sh\necho x >> {calls}\necho 4.5.1.stable.official\n")
+    godot.chmod(godot.stat().st_mode | stat.S_IEXEC)
+    return str(godot), calls
+
+
+def probes(calls):
+    return len(calls.read_text().splitlines()) if calls.exists() else 0
+
+
+class TestFindGodot:
+    def test_version_probed_once(self, fake_godot):
+        """Test the version is cached between calls"""
+        godot, calls = fake_godot
+
+        assert godot_version(godot) == "4.5.1.stable.official"
+        assert godot_version(godot) == "4.5.1.stable.official"
+        assert probes(calls) == 1
+
+    def test_stale_cache_probes(self, fake_godot):
+        """Test a changed executable is probed again"""
+        godot, calls = fake_godot
+        godot_version(godot)
+
+        mtime = os.stat(godot).st_mtime + 10
+        os.utime(godot, (mtime, mtime))
+
+        godot_version(godot)
+        assert probes(calls) == 2
+
+    def test_command(self, fake_godot):
+        """Test the command gets the flags and script for the cached version"""
+        godot, calls = fake_godot
+
+        assert godot_command(godot) == f"{godot} --headless --script {script_file_v4()}"
+        assert godot_command(godot) == f"{godot} --headless --script {script_file_v4()}"
+        assert probes(calls) == 1
+
+    def test_find_cached(self, fake_godot):
+        """Test the found executable is remembered while it still exists"""
+        godot, _ = fake_godot
+
+        with patch("gdrepl.find_godot.POSSIBLE_COMMANDS", [godot]):
+            assert find_godot() == godot
+        assert load_cache()["find"]["command"] == godot
+
+        with patch("gdrepl.find_godot.POSSIBLE_COMMANDS", [godot]), patch("gdrepl.find_godot.is_tool") as is_tool:
+            assert find_godot() == godot
+        is_tool.assert_not_called()
+
+        os.remove(godot)
+        with patch("gdrepl.find_godot.POSSIBLE_COMMANDS", [godot]):
+            assert find_godot() == ""
+
+    def test_find_preferred_installed(self, fake_godot, tmp_path, monkeypatch):
+        """Test a command that comes first is found once it is installed or put on PATH"""
+        godot, _ = fake_godot
+        commands = ["godot-preferred", godot]
+        first, second = tmp_path / "first", tmp_path / "second"
+        first.mkdir()
+        second.mkdir()
+        monkeypatch.setenv("PATH", f"{first}{os.pathsep}{os.environ['PATH']}")
+
+        with patch("gdrepl.find_godot.POSSIBLE_COMMANDS", commands):
+            assert find_godot() == godot
+
+            # Installed in a directory already on PATH
+            preferred = first / "godot-preferred"
+            preferred.write_text("#!/bin/sh\n")
+            preferred.chmod(0o755)
+            assert find_godot() == "godot-preferred"
+
+            # Only on a directory added to PATH
+            preferred.rename(second / "godot-preferred")
+            assert find_godot() == godot
+            monkeypatch.setenv("PATH", f"{second}{os.pathsep}{os.environ['PATH']}")
+            assert find_godot() == "godot-preferred"
+
+    def test_server_port(self, fake_godot):
+        """Test godot 4 servers are told to listen on port 0 and godot 3 ones get a probed port"""
+        godot, _ = fake_godot
+        assert server_port(godot) == 0
+
+        with open(godot, "w") as f:
+            f.write("#!/bin/sh\necho 3.5.3.stable.official\n")
+        os.utime(godot, (os.stat(godot).st_mtime + 10,) * 2)
+        assert server_port(godot) >= PORT
+
+    def test_listening_port(self):
+        """Test the port is read from the line the server prints once it listens"""
+        assert listening_port("Gdrepl Listening on 41234\n") == 41234
+        assert listening_port("Godot Engine v4.5.1.stable.official") is None
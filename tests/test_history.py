@@ -1,6 +1,11 @@
+import sys
 import tempfile
 from pathlib import Path
+from unittest.mock import patch
 
+from prompt_toolkit.document import Document
+
+from gdrepl.history import IndexedAutoSuggest
 from gdrepl.history import RotatingFileHistory
 
 
@@ -87,3 +92,127 @@ class TestRotatingFileHistory:
             # Should have rotated
             assert not history_file.exists()
             assert (Path(temp_dir) / "history.1").exists()
+
+    def test_count_sidecar(self):
+        """Test the entry count is kept next to the history and reused while the history didn't change"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            history_file = Path(temp_dir) / "history"
+            history_file.write_text("line1\nline2\nline3\n")
+
+            RotatingFileHistory(str(history_file))
+            assert (Path(temp_dir) / "history.count").read_text().split()[0] == "3"
+
+            with patch.object(RotatingFileHistory, "_count_entries", side_effect=AssertionError):
+                history = RotatingFileHistory(str(history_file))
+            assert history._entries == 3
+
+    def test_count_mismatch_rescans(self):
+        """Test the history is counted again when it changed behind the sidecar's back"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            history_file = Path(temp_dir) / "history"
+            history_file.write_text("line1\n")
+            history = RotatingFileHistory(str(history_file))
+
+            with open(history_file, "a") as f:
+                f.write("line2\nline3\n")
+
+            assert RotatingFileHistory(str(history_file))._entries == 3
+
+            history.store_string("line4")
+            assert history._entries == history._count_entries()
+
+    def test_store_string_counts_appended_lines(self):
+        """Test appends update the count without recounting the history"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            history_file = Path(temp_dir) / "history"
+            history = RotatingFileHistory(str(history_file))
+
+            history.store_string("a = 1")
+            history.store_string("func f():\n    return 1")
+            assert history._entries == history._count_entries()
+
+    def test_append_without_rescan_at_100k_entries(self):
+        """Test appending to a 100k entry history never reads the whole history"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            history_file = Path(temp_dir) / "history"
+            history_file.write_text("+1 + 1\n" * 100_000)
+            history = RotatingFileHistory(str(history_file), max_entries=1_000_000)
+
+            with patch.object(history, "_count_entries", side_effect=AssertionError):
+                for i in range(100):
+                    history.store_string(f"x = {i}")
+
+            assert history._entries == history._count_entries()
+
+
+class TestHistoryIndex:
+    def make_history(self, temp_dir, entries, **kwargs):
+        history = RotatingFileHistory(str(Path(temp_dir) / "history"), indexed=True, **kwargs)
+        for entry in entries:
+            history.store_string(entry)
+        return history
+
+    def test_suggest_prefix(self):
+        """Test suggestions are the most recent entry starting with the prefix"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            history = self.make_history(temp_dir, ["print(1)", "var a = 5", "print(2)"])
+
+            assert history.index.suggest("pri") == "print(2)"
+            assert history.index.suggest("var") == "var a = 5"
+            assert history.index.suggest("func") is None
+
+    def test_suggest_last_code_points(self):
+        """Test suggestions for prefixes ending in characters that can't simply be bumped"""
+        top = chr(sys.maxunicode)
+        with tempfile.TemporaryDirectory() as temp_dir:
+            history = self.make_history(temp_dir, [f"a{top}{top}b", "b", "\ud7ffx", "\ue000"])
+
+            assert history.index.suggest(f"a{top}") == f"a{top}{top}b"
+            assert history.index.suggest(top) is None
+            assert history.index.suggest("\ud7ff") == "\ud7ffx"
+
+    def test_search_substring(self):
+        """Test searches match anywhere in the entry, newest first, with and without trigrams"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            history = self.make_history(temp_dir, ["print(1)", "var a = 5", "print(2)", "a_b", "a%b"])
+
+            assert history.index.search("rint") == ["print(2)", "print(1)"]
+            assert history.index.search("_") == ["a_b"]
+            assert history.index.search("%") == ["a%b"]
+
+    def test_duplicates_move_to_front(self):
+        """Test entries are kept once with their latest use"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            history = self.make_history(temp_dir, ["print(1)", "print(2)", "print(1)"])
+
+            assert history.index.recent(10) == ["print(1)", "print(2)"]
+            assert history.index.suggest("print") == "print(1)"
+
+    def test_covers_backups(self):
+        """Test rotated backups stay indexed and dropped ones leave the index"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            # Every entry takes 3 lines so each store rotates
+            history = self.make_history(temp_dir, ["first", "second"], max_entries=2, backup_count=2)
+            assert history.index.recent(10) == ["second", "first"]
+
+            # Rotating again drops the backup with "first"
+            history.store_string("third")
+            assert history.index.recent(10) == ["third", "second"]
+
+    def test_index_opened_lazily(self):
+        """Test the index is only opened once something asks for it and catches up then"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            history = RotatingFileHistory(str(Path(temp_dir) / "history"), indexed=True)
+            history.store_string("print(1)")
+
+            assert history._index is None
+            assert list(history.load_history_strings()) == ["print(1)"]
+
+    def test_auto_suggest(self):
+        """Test the auto suggestion completes the current line from the index"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            history = self.make_history(temp_dir, ["print('hello')"])
+            suggestion = IndexedAutoSuggest(history).get_suggestion(None, Document("print("))
+
+            assert suggestion is not None
+            assert suggestion.text == "'hello')"
@@ -0,0 +1,110 @@
+import time
+
+import pexpect
+
+from gdrepl.constants import STDOUT_MARKER_END
+from gdrepl.constants import STDOUT_MARKER_START
+from gdrepl.output import MAX_LINE
+from gdrepl.output import OutputParser
+from gdrepl.output import TerminalOutput
+
+
+START = f"{STDOUT_MARKER_START}\r\n".encode()
+END = f"{STDOUT_MARKER_END}\r\n".encode()
+
+VOID_TRACE = (
+    b'SCRIPT ERROR: Cannot get return value of call to "f()" because it returns "void".\r\n' + b"   at: trace\r\n" * 10
+)
+
+
+def parse(*chunks):
+    written = []
+    parser = OutputParser(written.append)
+    for chunk in chunks:
+        parser.feed(chunk)
+    return "".join(written), parser
+
+
+class FakeTerminal:
+    """Hands out chunks like a pexpect spawn, ending once they run out"""
+
+    def __init__(self, chunks):
+        self.chunks = list(chunks)
+
+    def read_nonblocking(self, size, timeout):
+        if not self.chunks:
+            raise pexpect.exceptions.EOF("done")
+        return self.chunks.pop(0)
+
+
+class SlowTerminal:
+    """Waits out the whole timeout when there is nothing to read, missing chunks added meanwhile, and hands
+    out chunks slowly"""
+
+    def __init__(self):
+        self.chunks = []
+
+    def read_nonblocking(self, size, timeout):
+        if not self.chunks:
+            time.sleep(timeout)
+            raise pexpect.exceptions.TIMEOUT("idle")
+        time.sleep(0.01)
+        return self.chunks.pop(0)
+
+
+class TestOutputParser:
+    def test_between_markers(self):
+        """Test only the lines between the markers are written"""
+        output, _ = parse(b"Godot Engine v4.2\r\n", START, b"hello\r\nworld\r\n", END, b"after\r\n")
+        assert output == "hello\nworld\n"
+
+    def test_split_chunks(self):
+        """Test markers and characters split across chunks are still recognized"""
+        data = START + "héllo\r\n".encode() + END + b"after\r\n"
+        output, _ = parse(*(data[i : i + 3] for i in range(0, len(data), 3)))
+        assert output == "héllo\n"
+
+    def test_void_return_errors(self):
+        """Test the errors of calling void functions for their value are left out with their trace"""
+        output, _ = parse(START, VOID_TRACE, b"kept\r\n", END)
+        assert output == "kept\n"
+
+    def test_script_errors(self):
+        """Test script errors outside the markers are written without their prefix"""
+        output, _ = parse(b"SCRIPT ERROR: Parse Error: Unexpected token\r\n", b"   at: reload\r\n", START, END)
+        assert output == "Parse Error: Unexpected token\n"
+
+    def test_huge_output_bounded(self):
+        """Test megabytes of output, even without newlines, go through without being kept"""
+        line = b"x" * 1000 + b"\r\n"
+        chunks = [START] + [line * 1000] * 50 + [b"y" * 1_000_000] * 5 + [b"\r\n", END]
+        sizes = []
+        parser = OutputParser(lambda text: sizes.append(len(text)))
+        for chunk in chunks:
+            parser.feed(chunk)
+            assert len(parser.partial) <= MAX_LINE
+
+        assert sum(sizes) == 50 * 1000 * 1001 + 5_000_000 + 1
+
+
+class TestTerminalOutput:
+    def test_reads_until_eof(self):
+        """Test the terminal is read in a thread and its output written"""
+        written = []
+        output = TerminalOutput(FakeTerminal([START, b"hi\r\n", END]), written.append)
+        output.thread.join()
+        output.settle()
+        assert written == ["hi\n"]
+
+    def test_settle_after_idle_read(self):
+        """Test a read that went idle before the output arrived doesn't end the wait for it"""
+        written = []
+        terminal = SlowTerminal()
+        output = TerminalOutput(terminal, written.append)
+        time.sleep(0.1)
+
+        for _ in range(20):
+            terminal.chunks += [START, b"hi\r\n", END]
+            output.settle()
+            assert written[-1:] == ["hi\n"]
+            written.clear()
@@ -0,0 +1,166 @@
+import shlex
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+import pytest
+
+from gdrepl.constants import PORT
+from gdrepl.pool import ServerPool
+from gdrepl.pool import pool_request
+
+
+# Stands in for godot, prints the engine banner and runs the stand-in server on PORT
+FAKE_SERVER = shlex.join(
+    [
+        sys.executable,
+        "-c",
+        "print('Godot Engine v4.5.1.stable.official - https://godotengine.org', flush=True); "
+        "from gdrepl.standin import main; main()",
+    ]
+)
+
+# Listens on PORT but hangs up on every connection, like a server that doesn't speak the protocol
+PLAIN_SERVER = shlex.join(
+    [
+        sys.executable,
+        "-c",
+        "import os, socket; print('Godot Engine v4.4.stable.official - https://godotengine.org', flush=True); "
+        "s = socket.socket(); s.bind(('127.0.0.1', int(os.environ['PORT']))); s.listen(); "
+        "print('Gdrepl Listening on', s.getsockname()[1], flush=True)\n"
+        "while True: s.accept()[0].close()",
+    ]
+)
+
+
+def wait_for(condition, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "Timed out"
+        time.sleep(0.05)
+
+
+class TestServerPool:
+    def test_fills_pool(self):
+        """Test the pool boots servers until it has size idle ones"""
+        pool = ServerPool(FAKE_SERVER, size=2, max_idle_age=0)
+        try:
+            pool.maintain()
+            wait_for(lambda: len(pool.idle) == 2)
+
+            # The servers bound port 0 and reported the ports they got
+            ports = {s.port for s in pool.idle}
+            assert len(ports) == 2
+            assert 0 not in ports
+            assert all(s.version == "v4.5.1.stable.official" for s in pool.idle)
+        finally:
+            pool.stop()
+
+    def test_probed_ports(self):
+        """Test servers that can't listen on port 0 get a free port probed for them"""
+        pool = ServerPool(FAKE_SERVER, size=2, max_idle_age=0, ephemeral_ports=False)
+        try:
+            pool.maintain()
+            wait_for(lambda: len(pool.idle) == 2)
+
+            assert all(s.port >= PORT for s in pool.idle)
+            assert len({s.port for s in pool.idle}) == 2
+        finally:
+            pool.stop()
+
+    def test_acquire_refills(self):
+        """Test taking a server hands out a ready one and boots its replacement"""
+        pool = ServerPool(FAKE_SERVER, size=1, max_idle_age=0)
+        try:
+            pool.maintain()
+            wait_for(lambda: len(pool.idle) == 1)
+            port = pool.idle[0].port
+
+            server = pool.acquire()
+            assert server is not None
+            assert server["port"] == port
+            assert pool.status()["handed_out"] == 1
+
+            wait_for(lambda: len(pool.idle) == 1)
+            assert pool.idle[0].port != port
+        finally:
+            pool.stop()
+
+    def test_stop_handed_out(self):
+        """Test stopping the pool stops the servers it handed out too"""
+        pool = ServerPool(FAKE_SERVER, size=1, max_idle_age=0)
+        pool.maintain()
+        wait_for(lambda: len(pool.idle) == 1)
+        taken = pool.idle[0]
+        assert pool.acquire() is not None
+
+        pool.stop()
+        wait_for(lambda: taken.proc.poll() is not None)
+
+    def test_acquire_empty(self):
+        """Test nothing is handed out while no server is ready"""
+        pool = ServerPool(FAKE_SERVER, size=0, max_idle_age=0)
+        assert pool.acquire() is None
+
+    def test_acquire_needs_output(self):
+        """Test servers that don't stream their output aren't handed out"""
+        pool = ServerPool(PLAIN_SERVER, size=1, max_idle_age=0)
+        try:
+            pool.maintain()
+            wait_for(lambda: len(pool.idle) == 1)
+
+            assert pool.idle[0].capabilities == []
+            assert pool.acquire() is None
+        finally:
+            pool.stop()
+
+    def test_recycles_old_servers(self):
+        """Test idle servers older than max idle age are replaced"""
+        pool = ServerPool(FAKE_SERVER, size=1, max_idle_age=0.2)
+        try:
+            pool.maintain()
+            wait_for(lambda: len(pool.idle) == 1)
+            old = pool.idle[0]
+
+            time.sleep(0.3)
+            pool.maintain()
+            wait_for(lambda: old.proc.poll() is not None)
+            wait_for(lambda: len(pool.idle) == 1)
+            assert pool.idle[0] is not old
+        finally:
+            pool.stop()
+
+    def test_socket_requests(self):
+        """Test the manager answers status, acquire and stop over its socket"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            socket_path = Path(temp_dir) / "pool.sock"
+            pool = ServerPool(FAKE_SERVER, size=1, max_idle_age=0, socket_path=socket_path)
+            thread = threading.Thread(target=pool.serve, daemon=True)
+            thread.start()
+
+            wait_for(lambda: (pool_request("status", socket_path) or {}).get("idle"))
+            assert pool_request("acquire", socket_path)["port"]
+            assert pool_request("stop", socket_path) == {"stopped": True}
+
+            thread.join(timeout=5)
+            assert not socket_path.exists()
+
+    def test_shared_socket_dir(self):
+        """Test a socket directory others can use is neither listened on nor connected to"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            shared = Path(temp_dir) / "shared"
+            shared.mkdir(mode=0o777)
+            shared.chmod(0o777)
+            socket_path = shared / "pool.sock"
+            pool = ServerPool(FAKE_SERVER, size=0, max_idle_age=0, socket_path=socket_path)
+
+            with pytest.raises(PermissionError):
+                pool.serve()
+            socket_path.touch()
+            assert pool_request("status", socket_path) is None
+
+    def test_not_running(self):
+        """Test requests return None when there is no manager"""
+        assert pool_request("status", Path(tempfile.gettempdir()) / "no-such-pool.sock") is None
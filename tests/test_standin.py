@@ -0,0 +1,66 @@
+import pytest
+from websocket import create_connection
+
+from gdrepl.client import client
+from gdrepl.standin import StandinServer
+
+
+@pytest.fixture
+def server():
+    with StandinServer() as server:
+        yield server
+
+
+class TestStandinServer:
+    def test_handshake(self, server):
+        """Test the client negotiates the structured protocol with the stand-in"""
+        c = client(port=server.port)
+        assert c.protocol
+        assert "output" in c.capabilities
+        assert c.session == "main"
+        c.close()
+
+    def test_eval(self, server):
+        """Test variables, arithmetic and prints are answered like the godot server does"""
+        c = client(port=server.port)
+        output = []
+        assert c.send("var a = 6") == ""
+        assert c.send("a * 7") == "  -> 42"
+        assert c.send("print(a)\n7 / 2", on_output=lambda stream, text: output.append(text)) == "  -> 3"
+        assert output == ["6\n"]
+        assert c.send("symbols") == "var a"
+        c.close()
+
+    def test_sessions(self, server):
+        """Test connections asking for a new session don't share names"""
+        first, second = client(port=server.port, session=""), client(port=server.port, session="")
+        assert first.session != second.session
+        first.send("var mine = 1")
+        assert second.send("symbols") == ""
+        first.close()
+        second.close()
+
+    def test_fork_prefixed_names(self, server):
+        """Test prefixed sessions can't fork and nobody can fork into a prefixed name"""
+        c, victim = client(port=server.port, session="irc:a"), client(port=server.port, session="")
+        assert c.send("fork other").startswith("Error")
+        assert victim.send("fork irc:b").startswith("Error")
+        assert "irc:b" not in server.sessions
+        c.close()
+        victim.close()
+
+    def test_plain_text(self, server):
+        """Test messages that aren't json get plain text replies"""
+        ws = create_connection(f"ws://127.0.0.1:{server.port}")
+        ws.send("1 + 1")
+        assert ws.recv() == ">> 2"
+        ws.send("reset")
+        assert ws.recv() == "Cleared"
+        ws.close()
+
+    def test_large_messages(self, server):
+        """Test messages longer than a 16 bit frame length go through"""
+        c = client(port=server.port)
+        assert c.request("load", code="# " + "x" * 100_000)["error_code"] == 0
+        assert len(c.send("script_global")) == 100_002
+        c.close()
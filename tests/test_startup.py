@@ -0,0 +1,86 @@
+import json
+import os
+import subprocess
+import sys
+import time
+
+import pytest
+
+
+# Cumulative import time of gdrepl.main as reported by -X importtime, in milliseconds.
+# It is around 50ms, the budget leaves room for slower machines.
+IMPORT_BUDGET_MS = 250
+
+# Wall clock of `python -m gdrepl --help`, interpreter startup included
+STARTUP_BUDGET_S = 1.5
+
+# Timings depend on how loaded the machine is, the budgets are only checked when asked for.
+# What gets imported is checked always, it is what keeps startup fast
+timed = pytest.mark.skipif(not os.environ.get("GDREPL_TIMING_TESTS"), reason="Set GDREPL_TIMING_TESTS=1 to check")
+
+HEAVY = ("prompt_toolkit", "pygments", "pexpect", "websocket", "yaml", "sqlite3", "trio", "requests")
+
+
+def loaded_after(code: str) -> set:
+    """Top level packages imported by a fresh interpreter running code"""
+    result = subprocess.run(
+        [sys.executable, "-c", f"{code}\nimport sys, json; print(json.dumps(sorted(sys.modules)))"],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return {name.split(".")[0] for name in json.loads(result.stdout.splitlines()[-1])}
+
+
+def import_time_ms(module: str) -> float:
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    for line in result.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        _, cumulative, name = line.split("|")
+        if name.strip() == module:
+            return int(cumulative) / 1000
+    raise AssertionError(f"{module} not in -X importtime output")
+
+
+class TestStartup:
+    def test_package_import(self):
+        """Test importing gdrepl, like the irc bot does for script_file, loads none of the heavy dependencies"""
+        loaded = loaded_after("import gdrepl")
+
+        assert not loaded & set(HEAVY)
+        assert "click" not in loaded
+
+    def test_cli_import(self):
+        """Test the cli itself doesn't load what only the commands need"""
+        assert not loaded_after("import gdrepl.main") & set(HEAVY)
+
+    def test_server_command(self):
+        """Test gdrepl server doesn't load the prompt or the websocket client"""
+        loaded = loaded_after("from gdrepl.main import cli\ncli(['server', '--godot', ''], standalone_mode=False)")
+
+        assert not loaded & set(HEAVY)
+
+    def test_repl_without_pexpect(self):
+        """Test the prompt used by gdrepl client doesn't load pexpect"""
+        loaded = loaded_after("import gdrepl.repl, gdrepl.client")
+
+        assert "prompt_toolkit" in loaded
+        assert "pexpect" not in loaded
+
+    @timed
+    def test_import_budget(self):
+        """Test the cli imports within its budget"""
+        assert import_time_ms("gdrepl.main") < IMPORT_BUDGET_MS
+
+    @timed
+    def test_startup_budget(self):
+        """Test gdrepl --help answers within its budget"""
+        started = time.perf_counter()
+        subprocess.run([sys.executable, "-m", "gdrepl", "--help"], capture_output=True, check=True)
+
+        assert time.perf_counter() - started < STARTUP_BUDGET_S
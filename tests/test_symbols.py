@@ -0,0 +1,260 @@
+import json
+import stat
+import threading
+import time
+
+import pytest
+from prompt_toolkit.completion import CompleteEvent
+from prompt_toolkit.document import Document
+
+from gdrepl.repl import CustomCompleter
+from gdrepl.symbols import BackgroundIndex
+from gdrepl.symbols import SessionSymbols
+from gdrepl.symbols import SymbolIndex
+from gdrepl.symbols import api_file
+from gdrepl.symbols import load_index
+from gdrepl.symbols import parse_api
+
+
+# A tiny slice of what godot --dump-extension-api writes
+API = {
+    "global_constants": [],
+    "global_enums": [{"name": "Error", "values": [{"name": "OK", "value": 0}, {"name": "FAILED", "value": 1}]}],
+    "utility_functions": [{"name": "print", "return_type": ""}, {"name": "prints"}],
+    "builtin_classes": [
+        {
+            "name": "Vector2",
+            "members": [{"name": "x", "type": "float"}, {"name": "y", "type": "float"}],
+            "methods": [{"name": "normalized", "return_type": "Vector2"}, {"name": "length", "return_type": "float"}],
+        }
+    ],
+    "classes": [
+        {
+            "name": "Object",
+            "inherits": "",
+            "methods": [{"name": "get_class", "return_value": {"type": "String"}}],
+        },
+        {
+            "name": "Node",
+            "inherits": "Object",
+            "methods": [
+                {"name": "get_parent", "return_value": {"type": "Node"}},
+                {"name": "get_children", "return_value": {"type": "typedarray::Node"}},
+                {"name": "_ready", "is_virtual": True},
+            ],
+            "properties": [{"name": "name", "type": "StringName"}],
+            "signals": [{"name": "ready"}],
+            "constants": [{"name": "NOTIFICATION_READY", "value": 13}],
+        },
+        {
+            "name": "Node2D",
+            "inherits": "Node",
+            "properties": [{"name": "position", "type": "Vector2"}],
+        },
+        {
+            "name": "Engine",
+            "inherits": "Object",
+            "is_instantiable": False,
+            "methods": [{"name": "get_main_loop", "return_value": {"type": "Node"}}],
+        },
+    ],
+    "singletons": [{"name": "Engine", "type": "Engine"}],
+}
+
+
+@pytest.fixture
+def index():
+    return SymbolIndex(parse_api(API))
+
+
+def completions(completer, text):
+    return [c.text for c in completer.get_completions(Document(text), CompleteEvent(completion_requested=True))]
+
+
+class TestSymbolIndex:
+    def test_global_prefix(self, index):
+        """Test globals are completed by prefix"""
+        assert index.complete("Node") == ["Node", "Node2D"]
+        assert index.complete("pri") == ["print", "prints"]
+        assert index.complete("FA") == ["FAILED"]
+        assert index.complete("zzz") == []
+
+    def test_class_members(self, index):
+        """Test members of a class include the inherited ones and leave virtual methods out"""
+        assert index.complete_text("Node2D.get_")[1] == ["get_children", "get_class", "get_parent"]
+        assert "_ready" not in index.members("Node")
+
+    def test_instance_members(self, index):
+        """Test the class of X.new() and of chained calls is known"""
+        assert index.resolve("Node2D.new()") == "Node2D"
+        assert index.resolve("Node2D.new().get_parent()") == "Node"
+        assert index.resolve("Node2D.new().position.normalized()") == "Vector2"
+        assert index.resolve("Vector2(1, 2)") == "Vector2"
+        assert index.resolve("Engine.get_main_loop()") == "Node"
+        assert index.resolve("Engine.new()") is None
+        assert index.resolve("something.else") is None
+
+    def test_unknown_receiver(self, index):
+        """Test nothing is completed after a dot when the receiver isn't known"""
+        assert index.complete_text("foo.na") == ("na", [], None)
+
+    def test_describe(self, index):
+        """Test completions say what they are"""
+        assert index.describe(None, "Node") == "class"
+        assert index.describe("Node2D", "get_parent") == "method -> Node"
+        assert index.describe("Node2D", "position") == "property"
+
+
+class TestLoadIndex:
+    def test_dumped_once_per_version(self, tmp_path, monkeypatch):
+        """Test the api is dumped by godot once and read from the cache after"""
+        monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+        calls = tmp_path / "calls"
+        (tmp_path / "api.json").write_text(json.dumps(API))
+        godot = tmp_path / "godot"
+        godot.write_text(
+            "#!/bin/sh\n"
+            'if [ "$1" = "--version" ]; then echo 4.5.1.stable.official; exit; fi\n'
+            f"echo x >> {calls}\n"
+            f"cp {tmp_path / 'api.json'} extension_api.json\n"
+        )
+        godot.chmod(godot.stat().st_mode | stat.S_IEXEC)
+
+        assert load_index(str(godot)).complete("Node") == ["Node", "Node2D"]
+        assert api_file("4.5.1.stable.official").exists()
+        assert load_index(str(godot)).complete("Node") == ["Node", "Node2D"]
+        assert len(calls.read_text().splitlines()) == 1
+
+    def test_no_godot(self):
+        """Test there is no index without godot"""
+        assert load_index("") is None
+
+
+class TestCompleter:
+    def test_api_completions(self, index):
+        """Test the completer offers keywords and api names, and only members after a dot"""
+        api = BackgroundIndex("")
+        api.thread.join()
+        api.index = index
+        completer = CustomCompleter(api)
+
+        assert "Node2D" in completions(completer, "var n = Nod")
+        assert completions(completer, "Node2D.new().posi") == ["position"]
+        assert "func" in completions(completer, "fun")
+
+    def test_without_api(self):
+        """Test the completer still completes keywords while the api isn't loaded"""
+        assert "func" in completions(CustomCompleter(), "fun")
+
+
+class FakeSessionClient:
+    """Answers the symbols command, optionally blocking until released"""
+
+    def __init__(self, output, generation, block=None):
+        self.output = output
+        self.generation = generation
+        self.block = block
+        self.requests = 0
+
+    def request(self, op, on_output=None, **fields):
+        self.requests += 1
+        if self.block:
+            self.block.wait()
+        return {"type": "command", "command": fields["code"], "output": self.output, "generation": self.generation}
+
+    def close(self):
+        pass
+
+
+class TestSessionSymbols:
+    def test_fetched_on_change(self):
+        """Test names are fetched once the generation changes and kept while it doesn't"""
+        fake = FakeSessionClient("var apple\nfunc add\nclass Foo", 3)
+        symbols = SessionSymbols(lambda: fake, debounce=0)
+
+        symbols.update(3)
+        symbols.timer.join()
+        assert symbols.complete("a") == ["add", "apple"]
+        assert symbols.names["add"] == "func"
+
+        symbols.update(3)
+        assert fake.requests == 1
+
+    def test_debounced(self):
+        """Test a burst of changes leads to a single fetch"""
+        fake = FakeSessionClient("var a", 5)
+        symbols = SessionSymbols(lambda: fake, debounce=0.1)
+
+        for generation in range(1, 6):
+            symbols.update(generation)
+        symbols.timer.join()
+
+        assert fake.requests == 1
+        assert symbols.generation == 5
+
+    def test_never_blocks(self):
+        """Test completing while the server is busy answers right away with what was fetched before"""
+        release = threading.Event()
+        fake = FakeSessionClient("var a", 1, block=release)
+        symbols = SessionSymbols(lambda: fake, debounce=0)
+
+        symbols.update(1)
+        time.sleep(0.05)
+        assert fake.requests == 1
+
+        started = time.perf_counter()
+        assert symbols.complete("a") == []
+        assert time.perf_counter() - started < 0.05
+
+        release.set()
+        symbols.timer.join()
+        assert symbols.complete("a") == ["a"]
+
+    def test_session_switch(self):
+        """Test moving to another session reconnects and fetches its names even at the same generation"""
+        fakes = [FakeSessionClient("var a", 1), FakeSessionClient("var b", 1)]
+        symbols = SessionSymbols(lambda: fakes.pop(0), debounce=0)
+
+        symbols.update(1, "first")
+        symbols.timer.join()
+        symbols.update(1, "second")
+        symbols.timer.join()
+
+        assert symbols.complete("") == ["b"]
+        assert not fakes
+
+    def test_switch_during_fetch(self):
+        """Test switching sessions doesn't wait for a fetch in flight and drops the names it gets"""
+        release = threading.Event()
+        fakes = [FakeSessionClient("var a", 1, block=release), FakeSessionClient("var b", 1)]
+        symbols = SessionSymbols(lambda: fakes.pop(0), debounce=0)
+
+        symbols.update(1, "first")
+        time.sleep(0.05)
+        started = time.perf_counter()
+        symbols.update(1, "second")
+        assert time.perf_counter() - started < 0.05
+
+        release.set()
+        symbols.timer.join()
+        assert symbols.complete("") == ["b"]
+
+    def test_connect_exits(self):
+        """Test a connection that can't be made leaves the names empty instead of ending the thread"""
+
+        def connect():
+            raise SystemExit(1)
+
+        symbols = SessionSymbols(connect, debounce=0)
+        symbols.update(1)
+        symbols.timer.join()
+
+        assert symbols.complete("") == []
+        assert symbols.client is None
+
+    def test_completer(self):
+        """Test the completer offers the session names"""
+        symbols = SessionSymbols(lambda: None)
+        symbols.names, symbols.sorted = {"apple": "var"}, ["apple"]
+
+        assert "apple" in completions(CustomCompleter(session=symbols), "print(app")